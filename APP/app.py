@@ -5,8 +5,43 @@ import os
 import sqlite3
 import sys
 import platform
-from datetime import datetime
-from flask import Flask, request, jsonify, render_template
+import time
+import queue
+import select
+import socket
+import ipaddress
+import struct
+import zlib
+import gzip
+import tarfile
+import zipfile
+import urllib.parse
+import urllib.request
+import json
+import base64
+import uuid
+import io
+import csv
+import heapq
+import bisect
+import cProfile
+import pstats
+import tracemalloc
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from functools import lru_cache
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta, timezone
+import click
+from flask import Flask, request, jsonify, render_template, Response, stream_with_context, g
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 # Explicitly register a datetime adapter for sqlite3 (Python 3.12 deprecates default adapter)
 try:
@@ -21,709 +56,4590 @@ HISTORY_DB = 'network_history.db'
 # Отдельная БД для дерева путей (независимая от истории)
 PATHS_DB = 'paths_tree.db'
 
+# Таймаут одной системной команды (секунды)
+COMMAND_TIMEOUT = 120
+# Размер пула потоков пакетной трассировки (работа упирается в ожидание сети, а не в CPU)
+BATCH_MAX_WORKERS = int(os.environ.get('BATCH_MAX_WORKERS', '8'))
+# Общий дедлайн пакетного запроса (секунды)
+BATCH_DEADLINE = float(os.environ.get('BATCH_DEADLINE', '300'))
+# Сколько завершенных трассировок пакета копить до одной транзакции записи
+BATCH_COMMIT_SIZE = int(os.environ.get('BATCH_COMMIT_SIZE', '50'))
+# Движок трассировки: 'system' (утилита traceroute/tracert) или 'probe' (встроенный ProbeEngine)
+TRACE_ENGINE = os.environ.get('TRACE_ENGINE', 'system')
+# Бэкенд встроенного движка: 'socket' (raw ICMP, нужны привилегии) или 'simulated'
+PROBE_BACKEND = os.environ.get('PROBE_BACKEND', 'socket')
+# Топология для бэкенда 'simulated' (см. SimulatedProbeBackend)
+SIMULATED_TOPOLOGY = {}
+
 
 # ============================
-# ИНИЦИАЛИЗАЦИЯ БАЗ ДАННЫХ
+# МЕТРИКИ
 # ============================
 
-def init_paths_database():
-    """Инициализация БД для агрегированного дерева путей."""
-    try:
-        conn = sqlite3.connect(PATHS_DB)
-        cursor = conn.cursor()
-        cursor.execute('PRAGMA foreign_keys = ON;')
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS targets (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT UNIQUE NOT NULL,
-            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        )''')
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS hop_nodes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            target_id INTEGER NOT NULL,
-            hop_number INTEGER NOT NULL,
-            hostname TEXT NOT NULL,
-            UNIQUE(target_id, hop_number, hostname)
-        )''')
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS hop_ips (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            target_id INTEGER NOT NULL,
-            hop_number INTEGER NOT NULL,
-            ip_address TEXT NOT NULL,
-            UNIQUE(target_id, hop_number, ip_address)
-        )''')
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS path_requests (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            command TEXT NOT NULL,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            target TEXT,
-            hops_count INTEGER
-        )''')
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS path_hops (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            request_id INTEGER,
-            hop_number INTEGER,
-            hostname TEXT,
-            ip_address TEXT,
-            rtt1 REAL,
-            rtt2 REAL,
-            rtt3 REAL,
-            FOREIGN KEY (request_id) REFERENCES path_requests (id)
-        )''')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_path_requests_timestamp ON path_requests(timestamp)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_path_hops_request_id ON path_hops(request_id)')
-        
-        conn.commit()
-        conn.close()
-    except Exception:
-        pass
+# Префикс имен метрик в /metrics
+METRICS_PREFIX = 'netvis_'
+# Границы корзин гистограмм длительностей (секунды)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# Границы корзин числа хопов одной трассировки
+HOPS_BUCKETS = (0, 1, 2, 4, 8, 12, 16, 20, 24, 30, 40, 64)
+
+
+def _escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()) -> str:
+    pairs = [f'{n}="{_escape_label(v)}"' for n, v in zip(names, values)]
+    pairs.extend(f'{n}="{_escape_label(v)}"' for n, v in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Монотонный счетчик с метками. Значения меток передаются позиционно в порядке labelnames."""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [(self.name, _format_labels(self.labelnames, labels), value) for labels, value in items]
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами: на наблюдение — bisect и три сложения под блокировкой."""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def count(self, *labels):
+        with self._lock:
+            state = self._values.get(labels)
+            return state[2] if state else 0
+
+    def samples(self):
+        with self._lock:
+            items = sorted((labels, (list(state[0]), state[1], state[2])) for labels, state in self._values.items())
+        out = []
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                out.append((f'{self.name}_bucket', _format_labels(self.labelnames, labels, [('le', _format_value(float(bound)))]),
+                            cumulative))
+            out.append((f'{self.name}_sum', _format_labels(self.labelnames, labels), total))
+            out.append((f'{self.name}_count', _format_labels(self.labelnames, labels), count))
+        return out
+
+
+class MetricsRegistry:
+    """Метрики процесса в текстовом формате Prometheus.
+
+    Счетчики и гистограммы обновляются на месте; значения, которые и так хранятся
+    в других объектах (статистика кэшей), снимают коллекторы в момент выдачи.
+    Коллектор возвращает [(name, kind, help, [(labels dict, value), ...]), ...].
+    """
+
+    def __init__(self, prefix: str = METRICS_PREFIX):
+        self.prefix = prefix
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help_text, labelnames=()):
+        metric = Counter(self.prefix + name, help_text, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(self.prefix + name, help_text, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(f'{name}{labels} {_format_value(value)}' for name, labels, value in metric.samples())
+        for collector in self._collectors:
+            try:
+                families = collector()
+            except Exception as e:
+                app.logger.warning('metrics collector %s failed: %s', getattr(collector, '__name__', collector), e)
+                record_swallowed('metrics_collector')
+                continue
+            for name, kind, help_text, samples in families:
+                name = self.prefix + name
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in samples:
+                    lines.append(f'{name}{_format_labels(labels.keys(), labels.values())} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = MetricsRegistry()
+HTTP_REQUESTS = METRICS.counter('http_requests_total', 'HTTP requests by route and status.', ('method', 'route', 'status'))
+HTTP_LATENCY = METRICS.histogram('http_request_duration_seconds', 'Time to build the HTTP response.', ('method', 'route'))
+SUBPROCESS_LATENCY = METRICS.histogram('subprocess_duration_seconds', 'Wall time of system commands.', ('command',))
+SUBPROCESS_EXITS = METRICS.counter('subprocess_exits_total', 'System command exits by code (timeout, error).', ('command', 'code'))
+PARSE_LATENCY = METRICS.histogram('parse_duration_seconds', 'Time to parse one traceroute output.', ('format',))
+PARSE_HOPS = METRICS.histogram('parse_hops', 'Hops parsed from one traceroute output.', buckets=HOPS_BUCKETS)
+DB_WRITE_LATENCY = METRICS.histogram('db_write_duration_seconds', 'Write transaction time from BEGIN to COMMIT.', ('db',))
+DB_ROWS_WRITTEN = METRICS.counter('db_rows_written_total', 'Rows changed by committed write transactions.', ('db',))
+SWALLOWED_EXCEPTIONS = METRICS.counter('swallowed_exceptions_total', 'Exceptions caught and logged without failing the caller.',
+                                       ('site',))
 
-def init_database():
-    """Инициализация базы данных для хранения истории."""
-    try:
-        conn = sqlite3.connect(HISTORY_DB)
-        cursor = conn.cursor()
-        
-        cursor.execute('PRAGMA foreign_keys = ON;')
-        
-        # Таблица для хранения запросов
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS requests (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            command TEXT NOT NULL,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            target TEXT,
-            hops_count INTEGER
-        )
-        ''')
-        
-        # Таблица для хранения хопов
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS hops (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            request_id INTEGER,
-            hop_number INTEGER,
-            hostname TEXT,
-            ip_address TEXT,
-            rtt1 REAL,
-            rtt2 REAL,
-            rtt3 REAL,
-            FOREIGN KEY (request_id) REFERENCES requests (id)
-        )
-        ''')
-        
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_requests_timestamp ON requests(timestamp)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_hops_request_id ON hops(request_id)')
-        
-        conn.commit()
-        conn.close()
-    except Exception:
-        pass
+
+def record_swallowed(site: str):
+    """Учет перехваченного исключения, после которого работа продолжается."""
+    SWALLOWED_EXCEPTIONS.inc(site)
 
 
 # ============================
-# CRUD ДЛЯ ИСТОРИИ
+# ТРАССИРОВКА ЗАПРОСОВ И ПРОФИЛИРОВАНИЕ
 # ============================
 
-def save_request_to_db(command, hops_data):
-    """Сохраняет запрос и данные о хопах в базу данных."""
-    try:
-        conn = sqlite3.connect(HISTORY_DB)
-        cursor = conn.cursor()
-        
-        cursor.execute('PRAGMA foreign_keys = ON;')
-        
-        target = command.split()[-1] if len(command.split()) > 1 else 'unknown'
-        
-        cursor.execute('''
-        INSERT INTO requests (command, target, hops_count, timestamp)
-        VALUES (?, ?, ?, ?)
-        ''', (command, target, len(hops_data), datetime.now()))
-        
-        request_id = cursor.lastrowid
-        
-        for hop in hops_data:
-            rtt1 = float(hop['rtt1']) if hop['rtt1'] and hop['rtt1'] != 'Нет ответа' else None
-            rtt2 = float(hop['rtt2']) if hop['rtt2'] and hop['rtt2'] != 'Нет ответа' else None
-            rtt3 = float(hop['rtt3']) if hop['rtt3'] and hop['rtt3'] != 'Нет ответа' else None
-            
-            cursor.execute('''
-            INSERT INTO hops (request_id, hop_number, hostname, ip_address, rtt1, rtt2, rtt3)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                request_id,
-                int(hop['hop']),
-                hop['hostname'],
-                hop['ip'],
-                rtt1,
-                rtt2,
-                rtt3
-            ))
-        
-        conn.commit()
-        conn.close()
-        return True
-    except Exception:
-        return False
+# Сколько самых медленных запросов хранить для /api/debug/slow
+SLOW_REQUESTS_SIZE = int(os.environ.get('SLOW_REQUESTS_SIZE', '50'))
+# Профилирование по заголовку X-Debug-Profile: cpu|memory. Заголовок принимается, если
+# X-Debug-Token совпал с DEBUG_PROFILE_TOKEN или включен DEBUG_PROFILE (только для отладки)
+DEBUG_PROFILE = os.environ.get('DEBUG_PROFILE', '0') not in ('0', 'false', 'no', '')
+DEBUG_PROFILE_TOKEN = os.environ.get('DEBUG_PROFILE_TOKEN', '')
+# Сколько последних профилей хранить и сколько строк статистики отдавать
+DEBUG_PROFILE_KEEP = int(os.environ.get('DEBUG_PROFILE_KEEP', '20'))
+DEBUG_PROFILE_LINES = int(os.environ.get('DEBUG_PROFILE_LINES', '40'))
 
-def get_request_history():
-    """Возвращает историю запросов."""
-    try:
-        conn = sqlite3.connect(HISTORY_DB)
-        cursor = conn.cursor()
-        
-        cursor.execute('PRAGMA foreign_keys = ON;')
-        
-        cursor.execute('''
-        SELECT id, command, target, hops_count, timestamp 
-        FROM requests 
-        ORDER BY timestamp DESC 
-        LIMIT 50
-        ''')
-        
-        requests = []
-        for row in cursor.fetchall():
-            requests.append({
-                'id': row[0],
-                'command': row[1],
-                'target': row[2],
-                'hops_count': row[3],
-                'timestamp': row[4]
-            })
-        
-        conn.close()
-        return requests
-    except Exception:
-        return []
+# Трасса текущего запроса. Этапы в потоках пула (пакетная трассировка, мониторинг)
+# сюда не попадают: их видно только в агрегированных метриках
+_trace_local = threading.local()
 
-def get_request_details(request_id):
-    """Возвращает детали конкретного запроса."""
-    try:
-        conn = sqlite3.connect(HISTORY_DB)
-        cursor = conn.cursor()
-        
-        cursor.execute('PRAGMA foreign_keys = ON;')
-        
-        cursor.execute('SELECT command, target FROM requests WHERE id = ?', (request_id,))
-        request_info = cursor.fetchone()
-        if not request_info:
+
+class RequestTrace:
+    """Длительности этапов одного запроса: {этап: [секунды, число вызовов]}."""
+
+    __slots__ = ('started', 'spans')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = {}
+
+    def add(self, name, seconds):
+        entry = self.spans.get(name)
+        if entry is None:
+            self.spans[name] = [seconds, 1]
+        else:
+            entry[0] += seconds
+            entry[1] += 1
+
+    def server_timing(self, total):
+        """Значение заголовка Server-Timing (миллисекунды)."""
+        parts = [f'{name};dur={seconds * 1000:.3f}' + (f';desc="x{count}"' if count > 1 else '')
+                 for name, (seconds, count) in self.spans.items()]
+        parts.append(f'total;dur={total * 1000:.3f}')
+        return ', '.join(parts)
+
+
+def record_span(name: str, seconds: float):
+    """Добавляет уже измеренный этап к трассе текущего запроса (если она есть)."""
+    trace = getattr(_trace_local, 'trace', None)
+    if trace is not None:
+        trace.add(name, seconds)
+
+
+class SlowRequestLog:
+    """N самых медленных запросов (min-куча: вставка и вытеснение за O(log N))."""
+
+    def __init__(self, size: int = SLOW_REQUESTS_SIZE):
+        self.size = max(1, size)
+        self._heap = []
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def add(self, duration: float, record: dict):
+        with self._lock:
+            if len(self._heap) >= self.size and duration <= self._heap[0][0]:
+                return
+            self._seq += 1
+            item = (duration, self._seq, record)
+            if len(self._heap) < self.size:
+                heapq.heappush(self._heap, item)
+            else:
+                heapq.heapreplace(self._heap, item)
+
+    def snapshot(self):
+        with self._lock:
+            items = sorted(self._heap, reverse=True)
+        return [record for _, _, record in items]
+
+    def clear(self):
+        with self._lock:
+            self._heap.clear()
+
+
+SLOW_REQUESTS = SlowRequestLog()
+
+
+class RequestProfiler:
+    """Профилирование одного запроса: cProfile ('cpu') или tracemalloc ('memory').
+
+    Одновременно профилируется не больше одного запроса: и профилировщик, и tracemalloc
+    глобальны для процесса. Чужие потоки в это время тоже попадают в статистику памяти.
+    """
+
+    MODES = ('cpu', 'memory')
+
+    def __init__(self, keep: int = DEBUG_PROFILE_KEEP):
+        self.keep = max(1, keep)
+        self._busy = threading.Lock()
+        self._results = OrderedDict()
+        self._results_lock = threading.Lock()
+
+    def start(self, mode: str):
+        """Возвращает состояние для finish() или None, если уже идет другое профилирование."""
+        if mode not in self.MODES or not self._busy.acquire(blocking=False):
             return None
-        
-        cursor.execute('''
-        SELECT hop_number, hostname, ip_address, rtt1, rtt2, rtt3
-        FROM hops 
-        WHERE request_id = ? 
-        ORDER BY hop_number
-        ''', (request_id,))
-        
-        hops = []
-        for row in cursor.fetchall():
-            hops.append({
-                'hop': str(row[0]),
-                'hostname': row[1],
-                'ip': row[2],
-                'rtt1': str(row[3]) if row[3] is not None else None,
-                'rtt2': str(row[4]) if row[4] is not None else None,
-                'rtt3': str(row[5]) if row[5] is not None else None
-            })
+        try:
+            if mode == 'cpu':
+                profiler = cProfile.Profile()
+                profiler.enable()
+                return {'mode': mode, 'profiler': profiler}
+            started_tracing = not tracemalloc.is_tracing()
+            if started_tracing:
+                tracemalloc.start(25)
+            return {'mode': mode, 'started_tracing': started_tracing, 'before': tracemalloc.take_snapshot()}
+        except Exception:
+            self._busy.release()
+            raise
 
-        # Нормализация таймаутов для исторических записей
-        normalized_hops = []
-        for hop in hops:
-            r1 = hop['rtt1']
-            r2 = hop['rtt2']
-            r3 = hop['rtt3']
-            ip = (hop['ip'] or '').strip() if hop['ip'] is not None else ''
-            hostname = hop['hostname'] or ''
-            def _empty(v):
-                if v is None:
-                    return True
-                s = str(v).strip().lower()
-                return s in ('', 'none', 'null', 'undefined')
-            no_rtts = _empty(r1) and _empty(r2) and _empty(r3)
-            if no_rtts and (ip == '' or ip.upper() == 'N/A'):
-                hop['ip'] = 'Таймаут'
-                hop['hostname'] = '*' if not hostname else hostname
-            normalized_hops.append(hop)
-        
-        conn.close()
-        return {
-            'command': request_info[0],
-            'target': request_info[1],
-            'hops': normalized_hops
-        }
-    except Exception:
-        return None
+    def finish(self, state, lines: int = DEBUG_PROFILE_LINES):
+        """Останавливает профилирование, сохраняет и возвращает (id, текст статистики)."""
+        try:
+            if state['mode'] == 'cpu':
+                state['profiler'].disable()
+                out = io.StringIO()
+                pstats.Stats(state['profiler'], stream=out).sort_stats('cumulative').print_stats(lines)
+                text = out.getvalue()
+            else:
+                after = tracemalloc.take_snapshot()
+                current, peak = tracemalloc.get_traced_memory()
+                if state['started_tracing']:
+                    tracemalloc.stop()
+                stats = after.compare_to(state['before'], 'lineno')[:lines]
+                text = '\n'.join([f'traced current={current} peak={peak} bytes'] + [str(stat) for stat in stats]) + '\n'
+        finally:
+            self._busy.release()
+        profile_id = uuid.uuid4().hex[:12]
+        with self._results_lock:
+            self._results[profile_id] = {'mode': state['mode'], 'stats': text, 'created_at': datetime.now().isoformat()}
+            while len(self._results) > self.keep:
+                self._results.popitem(last=False)
+        return profile_id, text
+
+    def get(self, profile_id):
+        with self._results_lock:
+            return self._results.get(profile_id)
+
+
+PROFILER = RequestProfiler()
+
+
+def profiling_allowed(headers) -> bool:
+    if DEBUG_PROFILE:
+        return True
+    return bool(DEBUG_PROFILE_TOKEN) and headers.get('X-Debug-Token', '') == DEBUG_PROFILE_TOKEN
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """JSON Flask с учетом времени сериализации в трассе запроса."""
+
+    def dumps(self, obj, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            record_span('json', time.perf_counter() - started)
+
+
+app.json = TimedJSONProvider(app)
 
 
 # ============================
-# ФУНКЦИИ ДЛЯ ДЕРЕВА ПУТЕЙ
+# ПОДКЛЮЧЕНИЯ К БАЗАМ ДАННЫХ
 # ============================
 
-# CRUD для независимой истории путей (paths_tree.db)
+# Сколько SQLite ждет снятия блокировки до SQLITE_BUSY (мс)
+DB_BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', '5000'))
+# Повторы захвата блокировки записи после исчерпания busy_timeout
+DB_LOCK_RETRIES = 3
 
-def save_path_request_to_db(command, hops_data):
-    """Сохраняет запрос пути и хопы в отдельную БД paths_tree.db."""
-    try:
-        conn = sqlite3.connect(PATHS_DB)
-        cursor = conn.cursor()
-        cursor.execute('PRAGMA foreign_keys = ON;')
-        target = command.split()[-1] if len(command.split()) > 1 else 'unknown'
-        cursor.execute('''
-        INSERT INTO path_requests (command, target, hops_count, timestamp)
-        VALUES (?, ?, ?, ?)
-        ''', (command, target, len(hops_data), datetime.now()))
-        request_id = cursor.lastrowid
-        for hop in hops_data or []:
-            def _to_float(v):
-                try:
-                    return float(v) if v not in (None, '', 'Нет ответа') else None
-                except Exception:
-                    return None
-            rtt1 = _to_float(hop.get('rtt1'))
-            rtt2 = _to_float(hop.get('rtt2'))
-            rtt3 = _to_float(hop.get('rtt3'))
-            cursor.execute('''
-            INSERT INTO path_hops (request_id, hop_number, hostname, ip_address, rtt1, rtt2, rtt3)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                request_id,
-                int(str(hop.get('hop', '0')).strip() or 0),
-                hop.get('hostname'),
-                hop.get('ip'),
-                rtt1, rtt2, rtt3
-            ))
-        conn.commit()
-        conn.close()
-        return True
-    except Exception:
-        return False
+# Соединения живут в пределах потока: {(abspath, readonly): sqlite3.Connection}
+_db_local = threading.local()
 
-def get_path_request_history():
-    """Возвращает историю запросов для страницы путей."""
-    try:
-        conn = sqlite3.connect(PATHS_DB)
-        cursor = conn.cursor()
-        cursor.execute('PRAGMA foreign_keys = ON;')
-        cursor.execute('''
-        SELECT id, command, target, hops_count, timestamp
-        FROM path_requests
-        ORDER BY timestamp DESC
-        LIMIT 50
-        ''')
-        items = []
-        for row in cursor.fetchall():
-            items.append({
-                'id': row[0],
-                'command': row[1],
-                'target': row[2],
-                'hops_count': row[3],
-                'timestamp': row[4]
-            })
-        conn.close()
-        return items
-    except Exception:
-        return []
 
-def get_path_request_details(request_id):
-    """Возвращает детали конкретного запроса для страницы путей."""
-    try:
-        conn = sqlite3.connect(PATHS_DB)
-        cursor = conn.cursor()
-        cursor.execute('PRAGMA foreign_keys = ON;')
-        cursor.execute('SELECT command, target FROM path_requests WHERE id = ?', (request_id,))
-        info = cursor.fetchone()
-        if not info:
+def _open_connection(path: str, readonly: bool = False, attach=()):
+    """Открывает и настраивает соединение (WAL, synchronous=NORMAL, busy_timeout).
+
+    attach — пары (схема, путь) баз, подключаемых через ATTACH к этому же соединению.
+    """
+    if readonly:
+        uri = f'file:{urllib.parse.quote(os.path.abspath(path))}?mode=ro'
+        conn = sqlite3.connect(uri, uri=True, timeout=DB_BUSY_TIMEOUT_MS / 1000.0)
+    else:
+        conn = sqlite3.connect(path, timeout=DB_BUSY_TIMEOUT_MS / 1000.0)
+        conn.execute('PRAGMA journal_mode = WAL;')
+        conn.execute('PRAGMA synchronous = NORMAL;')
+    # Транзакциями управляем явно (BEGIN IMMEDIATE / COMMIT)
+    conn.isolation_level = None
+    conn.execute(f'PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS};')
+    conn.execute('PRAGMA foreign_keys = ON;')
+    for schema, attached_path in attach:
+        conn.execute(f'ATTACH DATABASE ? AS {schema}', (attached_path,))
+        conn.execute(f'PRAGMA {schema}.journal_mode = WAL;')
+        conn.execute(f'PRAGMA {schema}.synchronous = NORMAL;')
+    return conn
+
+
+def get_connection(path: str, readonly: bool = False, attach=None):
+    """Возвращает соединение текущего потока для базы path (создает при первом обращении).
+
+    attach — {схема: путь}; соединение с подключенными базами кэшируется отдельно.
+    """
+    connections = getattr(_db_local, 'connections', None)
+    if connections is None:
+        connections = _db_local.connections = {}
+    attached = tuple(sorted((schema, os.path.abspath(p)) for schema, p in (attach or {}).items()))
+    key = (os.path.abspath(path), readonly, attached)
+    conn = connections.get(key)
+    if conn is None:
+        conn = _open_connection(path, readonly=readonly, attach=attached)
+        connections[key] = conn
+    return conn
+
+
+def close_connections():
+    """Закрывает все соединения текущего потока."""
+    connections = getattr(_db_local, 'connections', None) or {}
+    for conn in connections.values():
+        try:
             conn.close()
-            return None
-        cursor.execute('''
-        SELECT hop_number, hostname, ip_address, rtt1, rtt2, rtt3
-        FROM path_hops
-        WHERE request_id = ?
-        ORDER BY hop_number
-        ''', (request_id,))
-        hops = []
-        for row in cursor.fetchall():
-            hops.append({
-                'hop': str(row[0]),
-                'hostname': row[1],
-                'ip': row[2],
-                'rtt1': str(row[3]) if row[3] is not None else None,
-                'rtt2': str(row[4]) if row[4] is not None else None,
-                'rtt3': str(row[5]) if row[5] is not None else None
-            })
-        # Нормализация таймаутов (как в истории)
-        normalized_hops = []
-        for hop in hops:
-            r1, r2, r3 = hop['rtt1'], hop['rtt2'], hop['rtt3']
-            ip = (hop['ip'] or '').strip() if hop['ip'] is not None else ''
-            hostname = hop['hostname'] or ''
-            def _empty(v):
-                if v is None:
-                    return True
-                s = str(v).strip().lower()
-                return s in ('', 'none', 'null', 'undefined')
-            no_rtts = _empty(r1) and _empty(r2) and _empty(r3)
-            if no_rtts and (ip == '' or ip.upper() == 'N/A'):
-                hop['ip'] = 'Таймаут'
-                hop['hostname'] = '*' if not hostname else hostname
-            normalized_hops.append(hop)
-        conn.close()
-        return {
-            'command': info[0],
-            'target': info[1],
-            'hops': normalized_hops
-        }
-    except Exception:
-        return None
+        except Exception:
+            pass
+    connections.clear()
 
-def _ensure_target_id(target: str) -> int:
-    conn = sqlite3.connect(PATHS_DB)
-    cursor = conn.cursor()
-    cursor.execute('PRAGMA foreign_keys = ON;')
-    cursor.execute('INSERT OR IGNORE INTO targets(name) VALUES (?)', (target,))
-    conn.commit()
-    cursor.execute('SELECT id FROM targets WHERE name = ?', (target,))
-    row = cursor.fetchone()
-    conn.close()
-    return row[0] if row else None
 
+def _is_busy_error(e: Exception) -> bool:
+    message = str(e).lower()
+    return 'locked' in message or 'busy' in message
 
-def update_paths_aggregate(command: str, hops_data: list):
-    """Обновляет агрегированную БД путей на основании результата traceroute."""
+
+# Версия данных хранится в самой базе (строка data_version) и увеличивается в каждой
+# транзакции записи с изменениями — в том числе из CLI-команд и других процессов.
+# epoch меняется при пересоздании файла базы, чтобы счетчики разных баз не совпали.
+_DATA_VERSION_DDL = '''
+CREATE TABLE IF NOT EXISTS data_version (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    epoch TEXT NOT NULL,
+    counter INTEGER NOT NULL,
+    modified TEXT NOT NULL
+)'''
+
+
+def _ensure_data_version_table(cursor):
+    cursor.execute(_DATA_VERSION_DDL)
+    cursor.execute('INSERT OR IGNORE INTO data_version (id, epoch, counter, modified) VALUES (1, ?, 0, ?)',
+                   (uuid.uuid4().hex[:8], datetime.now(timezone.utc).replace(microsecond=0).isoformat()))
+
+
+def _bump_data_versions(cursor, schemas):
+    """Увеличивает версии баз {схема: путь} в текущей транзакции; возвращает {abspath: (epoch, counter)}."""
+    modified = datetime.now(timezone.utc).replace(microsecond=0).isoformat()
+    versions = {}
+    for schema, path in schemas.items():
+        try:
+            row = cursor.execute(f'UPDATE {schema}.data_version SET counter = counter + 1, modified = ? '
+                                 'RETURNING epoch, counter', (modified,)).fetchone()
+        except sqlite3.OperationalError:
+            # База еще не инициализирована (нет таблицы версий)
+            continue
+        if row:
+            versions[os.path.abspath(path)] = tuple(row)
+    return versions
+
+
+def read_data_version(path: str):
+    """Текущая версия базы: ((epoch, counter), last_modified); (None, None), если версии нет.
+
+    Прочитанная строка запоминается для read-only соединения потока вместе с его
+    PRAGMA data_version. Эта прагма меняется при любом коммите другого соединения
+    (в том числе из другого процесса) и не читает страниц базы, поэтому, пока данные
+    не менялись, проверка версии стоит одной прагмы, а не запроса к таблице.
+    """
+    key = os.path.abspath(path)
+    cache = getattr(_db_local, 'data_versions', None)
+    if cache is None:
+        cache = _db_local.data_versions = {}
     try:
-        parts = command.split()
-        target = parts[-1] if parts else 'unknown'
-        target_id = _ensure_target_id(target)
-        if target_id is None:
+        conn = get_connection(path, readonly=True)
+        marker = conn.execute('PRAGMA data_version').fetchone()[0]
+        cached = cache.get(key)
+        if cached is not None and cached[0] is conn and cached[1] == marker:
+            return cached[2], cached[3]
+        row = conn.execute('SELECT epoch, counter, modified FROM data_version').fetchone()
+    except sqlite3.Error:
+        row = None
+    if row is None:
+        # Без строки версии (база старой сборки, не прошедшая init_*) валидатор не выдается
+        cache.pop(key, None)
+        return None, None
+    version, last_modified = (row[0], row[1]), datetime.fromisoformat(row[2])
+    cache[key] = (conn, marker, version, last_modified)
+    return version, last_modified
+
+
+def committed_data_version(path: str):
+    """Версия, которую записала последняя транзакция текущего потока в базу path (или None)."""
+    return (getattr(_db_local, 'committed_versions', None) or {}).get(os.path.abspath(path))
+
+
+def get_data_version(path: str):
+    """Возвращает (etag, last_modified) для текущего состояния базы; (None, None) без версии."""
+    version, last_modified = read_data_version(path)
+    if version is None:
+        return None, None
+    return f'{version[0]}-{version[1]}', last_modified
+
+
+@contextmanager
+def write_transaction(path: str, attach=None):
+    """Транзакция записи: BEGIN IMMEDIATE с повтором при SQLITE_BUSY, COMMIT/ROLLBACK.
+
+    Вложенный вызов для той же базы в том же потоке присоединяется к внешней транзакции,
+    если у внешней подключены все нужные ему базы (attach — подмножество внешнего).
+    Иначе понадобилось бы второе соединение, которое ждало бы блокировку, уже взятую
+    этим же потоком, поэтому такой вызов сразу завершается RuntimeError.
+    С attach={схема: путь} транзакция охватывает и подключенные базы: таблицы с
+    уникальными именами доступны без префикса схемы, ROLLBACK откатывает все базы.
+    """
+    main = os.path.abspath(path)
+    attached = {schema: os.path.abspath(p) for schema, p in (attach or {}).items()}
+    active = getattr(_db_local, 'active_writes', None)
+    if active is None:
+        active = _db_local.active_writes = []
+    for outer_main, outer_attached, outer_conn in active:
+        if outer_main == main and attached.items() <= outer_attached.items():
+            yield outer_conn.cursor()
             return
-        conn = sqlite3.connect(PATHS_DB)
+    held = {p for outer_main, outer_attached, _ in active for p in (outer_main, *outer_attached.values())}
+    busy = ({main} | set(attached.values())) & held
+    if busy:
+        raise RuntimeError(f"write_transaction({path!r}, attach={attach!r}) is nested in a transaction "
+                           f"on another connection that already holds {', '.join(sorted(busy))}; "
+                           f"open the outer transaction with every database the nested call needs")
+    conn = get_connection(path, attach=attach)
+    if conn.in_transaction:
+        yield conn.cursor()
+        return
+    started = time.perf_counter()
+    for attempt in range(DB_LOCK_RETRIES + 1):
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            break
+        except sqlite3.OperationalError as e:
+            if not _is_busy_error(e) or attempt == DB_LOCK_RETRIES:
+                raise
+            time.sleep(0.05 * (2 ** attempt))
+    _db_local.committed_versions = {}
+    changes_before = conn.total_changes
+    entry = (main, attached, conn)
+    active.append(entry)
+    try:
         cursor = conn.cursor()
-        cursor.execute('PRAGMA foreign_keys = ON;')
-        for hop in hops_data or []:
-            try:
-                hop_num = int(str(hop.get('hop', '')).strip())
-            except Exception:
-                continue
-            hostname = (hop.get('hostname') or '').strip()
-            ip = (hop.get('ip') or '').strip()
-            if hostname and hostname not in ('*', 'Неизвестный узел'):
-                cursor.execute('INSERT OR IGNORE INTO hop_nodes(target_id, hop_number, hostname) VALUES (?, ?, ?)',
-                               (target_id, hop_num, hostname))
-            if ip and ip not in ('Таймаут', 'N/A'):
-                cursor.execute('INSERT OR IGNORE INTO hop_ips(target_id, hop_number, ip_address) VALUES (?, ?, ?)',
-                               (target_id, hop_num, ip))
-        conn.commit()
-        conn.close()
-    except Exception:
-        pass
+        yield cursor
+        changed = conn.total_changes - changes_before
+        versions = {}
+        if changed:
+            # total_changes общий для соединения: версии подключенных баз меняются вместе с основной
+            versions = _bump_data_versions(cursor, dict({'main': path}, **(attach or {})))
+        conn.execute('COMMIT')
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    finally:
+        active.remove(entry)
+    _db_local.committed_versions = versions
+    db = os.path.basename(path)
+    elapsed = time.perf_counter() - started
+    DB_WRITE_LATENCY.observe(elapsed, db)
+    record_span('db', elapsed)
+    if changed:
+        DB_ROWS_WRITTEN.inc(db, amount=changed)
 
 
-def get_all_paths():
-    """Возвращает все пути из независимой БД paths_tree.db."""
+@contextmanager
+def read_cursor(path: str):
+    """Курсор на отдельном read-only соединении (читатели WAL не блокируют писателей)."""
+    cursor = get_connection(path, readonly=True).cursor()
     try:
-        conn = sqlite3.connect(PATHS_DB)
-        cursor = conn.cursor()
-        cursor.execute('PRAGMA foreign_keys = ON;')
-        cursor.execute('''
-            SELECT t.name, n.hop_number, n.hostname
-            FROM hop_nodes n
-            JOIN targets t ON n.target_id = t.id
-        ''')
-        paths = {}
-        for target, hop_number, hostname in cursor.fetchall():
-            paths.setdefault(target, [])
-            hop = next((h for h in paths[target] if h['hop_number'] == hop_number), None)
-            if not hop:
-                hop = {'hop_number': hop_number, 'nodes': set(), 'ips': set()}
-                paths[target].append(hop)
-            if hostname:
-                hop['nodes'].add(hostname)
-        cursor.execute('''
-            SELECT t.name, i.hop_number, i.ip_address
-            FROM hop_ips i
-            JOIN targets t ON i.target_id = t.id
-        ''')
-        for target, hop_number, ip in cursor.fetchall():
-            paths.setdefault(target, [])
-            hop = next((h for h in paths[target] if h['hop_number'] == hop_number), None)
-            if not hop:
-                hop = {'hop_number': hop_number, 'nodes': set(), 'ips': set()}
-                paths[target].append(hop)
-            if ip:
-                hop['ips'].add(ip)
-        for target in paths:
-            paths[target].sort(key=lambda x: x['hop_number'])
-            for hop in paths[target]:
-                hop['nodes'] = list(hop['nodes'])
-                hop['ips'] = list(hop['ips'])
-        conn.close()
-        return paths
-    except Exception:
-        return {}
+        yield cursor
+    finally:
+        cursor.close()
+
+
+# ============================
+# IP-КЛЮЧИ
+# ============================
+
+_IPV4_MAPPED_PREFIX = b'\x00' * 10 + b'\xff\xff'
+
+
+@lru_cache(maxsize=65536)
+def ip_key(text):
+    """Упакованный 16-байтовый ключ IP для индекса: IPv6 как есть, IPv4 — в виде ::ffff:a.b.c.d.
+
+    Для нечисловых значений ('Таймаут', 'N/A', имен) возвращает None. Одни и те же адреса
+    повторяются в каждой трассировке к цели, поэтому результат кэшируется.
+    """
+    if not text:
+        return None
+    try:
+        addr = ipaddress.ip_address(str(text).strip().split('%', 1)[0])
+    except ValueError:
+        return None
+    if addr.version == 4:
+        return _IPV4_MAPPED_PREFIX + addr.packed
+    return addr.packed
+
+
+def ip_prefix_range(prefix):
+    """Границы (lo, hi) ключей ip_key для префикса вида '10.0.0.0/8' или '2001:db8::/32'.
+
+    Запрос `ip_key BETWEEN lo AND hi` выполняется как диапазонный просмотр индекса.
+    """
+    net = ipaddress.ip_network(str(prefix).strip(), strict=False)
+    lo, hi = net.network_address.packed, net.broadcast_address.packed
+    if net.version == 4:
+        return _IPV4_MAPPED_PREFIX + lo, _IPV4_MAPPED_PREFIX + hi
+    return lo, hi
+
+
+def _ensure_ip_key_column(cursor, table):
+    """Добавляет колонку ip_key в существующую таблицу и заполняет ее по тексту IP."""
+    columns = {row[1] for row in cursor.execute(f'PRAGMA table_info({table})')}
+    if 'ip_key' not in columns:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN ip_key BLOB')
+    rows = cursor.execute(
+        f"SELECT id, ip_address FROM {table} WHERE ip_key IS NULL AND ip_address GLOB '*[.:]*'"
+    ).fetchall()
+    updates = [(key, row_id) for row_id, ip in rows for key in (ip_key(ip),) if key is not None]
+    if updates:
+        cursor.executemany(f'UPDATE {table} SET ip_key = ? WHERE id = ?', updates)
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_ip_key ON {table}(ip_key)')
+
+
+def _ensure_history_indexes(cursor, table):
+    """Составные покрывающие индексы для постраничной истории по ключу (timestamp, id).
+
+    id указан явно, чтобы порядок индекса совпадал с ORDER BY timestamp DESC, id DESC
+    и при равных timestamp; остальные колонки делают выборку страницы без чтения таблицы.
+    """
+    cursor.execute(f'DROP INDEX IF EXISTS idx_{table}_timestamp')
+    cursor.execute(f'''CREATE INDEX IF NOT EXISTS idx_{table}_ts_id
+                      ON {table}(timestamp, id, target, hops_count, command)''')
+    cursor.execute(f'''CREATE INDEX IF NOT EXISTS idx_{table}_target_ts_id
+                      ON {table}(target, timestamp, id, hops_count, command)''')
+
+
+def _ensure_incremental_vacuum(path, vacuum=False):
+    """Включает auto_vacuum=INCREMENTAL. Возвращает True, если режим действует.
+
+    Новая (пустая) база переходит в режим сразу. Существующей нужен полный VACUUM
+    (vacuum=True, команда flask vacuum): на больших базах он долгий и держит блокировку.
+    """
+    conn = get_connection(path)
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        return True
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    # VACUUM пустой базы (еще без таблиц) мгновенный
+    if vacuum or conn.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()[0] == 0:
+        conn.execute('VACUUM')
+    return conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+
+
+def _prepare_incremental_vacuum(path):
+    """Шаг инициализации без гарантий: ошибка (например, база занята) не мешает созданию схемы."""
+    try:
+        if not _ensure_incremental_vacuum(path):
+            app.logger.info('%s: auto_vacuum=INCREMENTAL takes effect after `flask vacuum`', path)
+    except Exception as e:
+        app.logger.warning('incremental vacuum setup failed for %s: %s', path, e)
+        record_swallowed('incremental_vacuum_setup')
+
+
+# ============================
+# ИНИЦИАЛИЗАЦИЯ БАЗ ДАННЫХ
+# ============================
+
+def init_paths_database():
+    """Инициализация БД для агрегированного дерева путей."""
+    _prepare_incremental_vacuum(PATHS_DB)
+    try:
+        with write_transaction(PATHS_DB) as cursor:
+            _ensure_data_version_table(cursor)
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS targets (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT UNIQUE NOT NULL,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )''')
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS hop_nodes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                target_id INTEGER NOT NULL,
+                hop_number INTEGER NOT NULL,
+                hostname TEXT NOT NULL,
+                UNIQUE(target_id, hop_number, hostname)
+            )''')
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS hop_ips (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                target_id INTEGER NOT NULL,
+                hop_number INTEGER NOT NULL,
+                ip_address TEXT NOT NULL,
+                ip_key BLOB,
+                UNIQUE(target_id, hop_number, ip_address)
+            )''')
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS path_requests (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                command TEXT NOT NULL,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                target TEXT,
+                hops_count INTEGER
+            )''')
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS path_hops (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                request_id INTEGER,
+                hop_number INTEGER,
+                hostname TEXT,
+                ip_address TEXT,
+                rtt1 REAL,
+                rtt2 REAL,
+                rtt3 REAL,
+                ip_key BLOB,
+                FOREIGN KEY (request_id) REFERENCES path_requests (id)
+            )''')
+            _ensure_history_indexes(cursor, 'path_requests')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_path_hops_request_id ON path_hops(request_id)')
+            # Наблюдавшиеся связи между IP соседних хопов (по целям)
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'hop_edges'")
+            edges_exist = cursor.fetchone() is not None
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS hop_edges (
+                target_id INTEGER NOT NULL,
+                src_ip TEXT NOT NULL,
+                dst_ip TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                last_seen DATETIME NOT NULL,
+                PRIMARY KEY (target_id, src_ip, dst_ip)
+            ) WITHOUT ROWID''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_hop_edges_src ON hop_edges(src_ip)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_hop_edges_dst ON hop_edges(dst_ip)')
+            if not edges_exist:
+                rebuild_hop_edges(cursor)
+            # Бинарные ключи IP: префиксные запросы как диапазон по индексу
+            for table in ('path_hops', 'hop_ips'):
+                _ensure_ip_key_column(cursor, table)
+    except Exception as e:
+        app.logger.warning('init_paths_database failed: %s', e)
+        record_swallowed('init_paths_database')
+
+def init_database():
+    """Инициализация базы данных для хранения истории."""
+    _prepare_incremental_vacuum(HISTORY_DB)
+    try:
+        with write_transaction(HISTORY_DB) as cursor:
+            _ensure_data_version_table(cursor)
+            # Таблица для хранения запросов
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS requests (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                command TEXT NOT NULL,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                target TEXT,
+                hops_count INTEGER
+            )
+            ''')
+
+            # Таблица для хранения хопов
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS hops (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                request_id INTEGER,
+                hop_number INTEGER,
+                hostname TEXT,
+                ip_address TEXT,
+                rtt1 REAL,
+                rtt2 REAL,
+                rtt3 REAL,
+                ip_key BLOB,
+                FOREIGN KEY (request_id) REFERENCES requests (id)
+            )
+            ''')
+
+            _ensure_history_indexes(cursor, 'requests')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_hops_request_id ON hops(request_id)')
+            _ensure_ip_key_column(cursor, 'hops')
+
+            # Предагрегированные RTT по (цель, хоп, IP) в корзинах 1 мин / 1 ч / 1 сутки
+            rollups_exist = cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'rtt_rollups'").fetchone()
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS rtt_rollups (
+                target TEXT NOT NULL,
+                resolution INTEGER NOT NULL,
+                hop_number INTEGER NOT NULL,
+                ip_address TEXT NOT NULL,
+                bucket INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                loss INTEGER NOT NULL,
+                rtt_min REAL,
+                rtt_max REAL,
+                rtt_sum REAL NOT NULL,
+                rtt_sumsq REAL NOT NULL,
+                PRIMARY KEY (target, resolution, hop_number, ip_address, bucket)
+            ) WITHOUT ROWID
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_rtt_rollups_resolution_bucket ON rtt_rollups(resolution, bucket)')
+            if not rollups_exist:
+                rebuild_rtt_rollups(cursor)
+    except Exception as e:
+        app.logger.warning('init_database failed: %s', e)
+        record_swallowed('init_database')
+
+
+# ============================
+# CRUD ДЛЯ ИСТОРИИ
+# ============================
+
+def _rtt_value(v):
+    try:
+        return float(v) if v not in (None, '', 'Нет ответа') else None
+    except (TypeError, ValueError):
+        return None
+
+def normalize_trace(command, hops_data):
+    """Нормализует одну трассировку для пакетной записи: строки хопов, узлы и IP для агрегата."""
+    rows = []
+    nodes = []
+    ips = []
+    for hop in hops_data or []:
+        try:
+            hop_num = int(str(hop.get('hop', '')).strip())
+        except (TypeError, ValueError):
+            continue
+        hostname = hop.get('hostname')
+        ip = hop.get('ip')
+        rows.append((hop_num, hostname, ip,
+                     _rtt_value(hop.get('rtt1')), _rtt_value(hop.get('rtt2')), _rtt_value(hop.get('rtt3')),
+                     ip_key(ip)))
+        hostname = (hostname or '').strip()
+        ip = (ip or '').strip()
+        if hostname and hostname not in ('*', 'Неизвестный узел'):
+            nodes.append((hop_num, hostname))
+        if ip and ip not in ('Таймаут', 'N/A'):
+            ips.append((hop_num, ip))
+    parts = command.split()
+    return {
+        'command': command,
+        'target': parts[-1] if len(parts) > 1 else 'unknown',
+        'hops_count': len(hops_data or []),
+        'timestamp': datetime.now(),
+        'rows': rows,
+        'nodes': nodes,
+        'ips': ips,
+        'edges': hop_edges(ips)
+    }
+
+def hop_edges(ips):
+    """Связи (IP хопа N, IP хопа N+1) трассировки; через таймауты связь не проводится."""
+    by_hop = {}
+    for hop_num, ip in ips:
+        by_hop.setdefault(hop_num, []).append(ip)
+    edges = set()
+    for hop_num, sources in by_hop.items():
+        for dst in by_hop.get(hop_num + 1, ()):
+            edges.update((src, dst) for src in sources if src != dst)
+    return sorted(edges)
+
+def _insert_history(cursor, traces):
+    """Строки истории (requests, hops) и агрегаты RTT в транзакции вызывающего."""
+    for trace in traces:
+        cursor.execute('''
+        INSERT INTO requests (command, target, hops_count, timestamp)
+        VALUES (?, ?, ?, ?)
+        ''', (trace['command'], trace['target'], trace['hops_count'], trace['timestamp']))
+        request_id = cursor.lastrowid
+        cursor.executemany('''
+        INSERT INTO hops (request_id, hop_number, hostname, ip_address, rtt1, rtt2, rtt3, ip_key)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [(request_id,) + row for row in trace['rows']])
+    update_rtt_rollups(cursor, traces)
+
+def save_request_to_db(command, hops_data):
+    """Сохраняет запрос и данные о хопах в базу данных."""
+    return store_traces([normalize_trace(command, hops_data)], aggregate=False)
+
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 500
+
+
+def _db_timestamp(value):
+    """Граница интервала в том же текстовом виде, в котором пишется datetime (адаптер isoformat)."""
+    dt = datetime.fromisoformat(str(value).strip().replace('Z', '+00:00'))
+    if dt.tzinfo is not None:
+        dt = dt.astimezone().replace(tzinfo=None)
+    return dt.isoformat()
+
+
+def encode_history_cursor(timestamp, row_id):
+    """Непрозрачный токен позиции (timestamp, id) для следующей страницы."""
+    raw = json.dumps([str(timestamp), int(row_id)], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_history_cursor(token):
+    """Обратное к encode_history_cursor; ValueError на поврежденном токене."""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        timestamp, row_id = json.loads(raw.decode('utf-8'))
+        return str(timestamp), int(row_id)
+    except Exception as e:
+        raise ValueError(f'Invalid cursor: {e}')
+
+
+def parse_history_filters(args):
+    """Фильтры и позиция страницы из query string; ValueError на некорректных значениях."""
+    filters = {}
+    target = (args.get('target') or '').strip()
+    if target:
+        filters['target'] = target
+    for key in ('since', 'until'):
+        if args.get(key):
+            filters[key] = _db_timestamp(args[key])
+    for key in ('min_hops', 'max_hops'):
+        if args.get(key) not in (None, ''):
+            filters[key] = int(args[key])
+    limit = int(args.get('limit', HISTORY_PAGE_SIZE))
+    if not 1 <= limit <= HISTORY_MAX_PAGE_SIZE:
+        raise ValueError(f'limit must be between 1 and {HISTORY_MAX_PAGE_SIZE}')
+    cursor = decode_history_cursor(args['cursor']) if args.get('cursor') else None
+    return filters, cursor, limit
+
+
+def query_request_page(db_path, table, filters=None, cursor=None, limit=HISTORY_PAGE_SIZE):
+    """Страница истории (новые сначала) по ключу (timestamp, id): (items, next_cursor).
+
+    Фильтры: target, since (включительно), until (не включительно), min_hops, max_hops.
+    Каждая следующая страница — диапазон по индексу от позиции курсора, без OFFSET.
+    """
+    filters = filters or {}
+    where = []
+    params = []
+    if 'target' in filters:
+        where.append('target = ?')
+        params.append(filters['target'])
+    if 'since' in filters:
+        where.append('timestamp >= ?')
+        params.append(filters['since'])
+    if 'until' in filters:
+        where.append('timestamp < ?')
+        params.append(filters['until'])
+    if 'min_hops' in filters:
+        where.append('hops_count >= ?')
+        params.append(filters['min_hops'])
+    if 'max_hops' in filters:
+        where.append('hops_count <= ?')
+        params.append(filters['max_hops'])
+    if cursor is not None:
+        where.append('(timestamp, id) < (?, ?)')
+        params.extend(cursor)
+    sql = f'SELECT id, command, target, hops_count, timestamp FROM {table}'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY timestamp DESC, id DESC LIMIT ?'
+    params.append(limit + 1)
+    with read_cursor(db_path) as cur:
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+    items = [{
+        'id': row[0],
+        'command': row[1],
+        'target': row[2],
+        'hops_count': row[3],
+        'timestamp': row[4]
+    } for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_history_cursor(last[4], last[0])
+    return items, next_cursor
+
+
+def get_request_history_page(filters=None, cursor=None, limit=HISTORY_PAGE_SIZE):
+    """Страница истории запросов: (items, next_cursor)."""
+    return query_request_page(HISTORY_DB, 'requests', filters, cursor, limit)
+
+
+def get_request_history():
+    """Возвращает историю запросов."""
+    try:
+        return get_request_history_page()[0]
+    except Exception as e:
+        app.logger.warning('get_request_history failed: %s', e)
+        record_swallowed('get_request_history')
+        return []
+
+def _normalize_timeout_hops(hops):
+    """Нормализация таймаутов для исторических записей."""
+    def _empty(v):
+        if v is None:
+            return True
+        s = str(v).strip().lower()
+        return s in ('', 'none', 'null', 'undefined')
+
+    normalized_hops = []
+    for hop in hops:
+        ip = (hop['ip'] or '').strip() if hop['ip'] is not None else ''
+        hostname = hop['hostname'] or ''
+        no_rtts = _empty(hop['rtt1']) and _empty(hop['rtt2']) and _empty(hop['rtt3'])
+        if no_rtts and (ip == '' or ip.upper() == 'N/A'):
+            hop['ip'] = 'Таймаут'
+            hop['hostname'] = '*' if not hostname else hostname
+        normalized_hops.append(hop)
+    return normalized_hops
+
+def _hop_from_row(row):
+    return {
+        'hop': str(row[0]),
+        'hostname': row[1],
+        'ip': row[2],
+        'rtt1': str(row[3]) if row[3] is not None else None,
+        'rtt2': str(row[4]) if row[4] is not None else None,
+        'rtt3': str(row[5]) if row[5] is not None else None
+    }
+
+def get_request_details(request_id):
+    """Возвращает детали конкретного запроса."""
+    try:
+        with read_cursor(HISTORY_DB) as cursor:
+            cursor.execute('SELECT command, target FROM requests WHERE id = ?', (request_id,))
+            request_info = cursor.fetchone()
+            if not request_info:
+                return None
+
+            cursor.execute('''
+            SELECT hop_number, hostname, ip_address, rtt1, rtt2, rtt3
+            FROM hops 
+            WHERE request_id = ? 
+            ORDER BY hop_number
+            ''', (request_id,))
+            hops = [_hop_from_row(row) for row in cursor.fetchall()]
+
+        return {
+            'command': request_info[0],
+            'target': request_info[1],
+            'hops': _normalize_timeout_hops(hops)
+        }
+    except Exception as e:
+        app.logger.warning('get_request_details failed: %s', e)
+        record_swallowed('get_request_details')
+        return None
+
+def find_hops_by_prefix(prefix, limit=500):
+    """Хопы истории, IP которых лежит внутри префикса (диапазон по индексу ip_key)."""
+    lo, hi = ip_prefix_range(prefix)
+    with read_cursor(HISTORY_DB) as cursor:
+        cursor.execute('''
+        SELECT h.hop_number, h.hostname, h.ip_address, h.rtt1, h.rtt2, h.rtt3,
+               r.id, r.target, r.timestamp
+        FROM hops h
+        JOIN requests r ON r.id = h.request_id
+        WHERE h.ip_key BETWEEN ? AND ?
+        ORDER BY h.ip_key, h.id DESC
+        LIMIT ?
+        ''', (lo, hi, limit))
+        return [dict(_hop_from_row(row), request_id=row[6], target=row[7], timestamp=row[8])
+                for row in cursor.fetchall()]
+
+
+# ============================
+# RTT-АГРЕГАТЫ
+# ============================
+
+# Разрешения корзин в секундах; корзина — начало интервала в unix time (выровнено по UTC)
+RTT_RESOLUTIONS = {'1m': 60, '1h': 3600, '1d': 86400}
+RTT_PROBES_PER_HOP = 3
+RTT_SERIES_MAX_POINTS = 5000
+
+_RTT_ROLLUP_UPSERT = '''
+INSERT INTO rtt_rollups (target, resolution, hop_number, ip_address, bucket,
+                         count, loss, rtt_min, rtt_max, rtt_sum, rtt_sumsq)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (target, resolution, hop_number, ip_address, bucket) DO UPDATE SET
+    count = count + excluded.count,
+    loss = loss + excluded.loss,
+    rtt_min = CASE WHEN rtt_min IS NULL OR excluded.rtt_min < rtt_min THEN excluded.rtt_min ELSE rtt_min END,
+    rtt_max = CASE WHEN rtt_max IS NULL OR excluded.rtt_max > rtt_max THEN excluded.rtt_max ELSE rtt_max END,
+    rtt_sum = rtt_sum + excluded.rtt_sum,
+    rtt_sumsq = rtt_sumsq + excluded.rtt_sumsq
+'''
+
+
+def _rollup_ip(ip):
+    """IP для ключа агрегата: потерянные хопы без адреса собираются под пустой строкой."""
+    ip = (ip or '').strip()
+    return '' if ip in ('', '*', 'Таймаут', 'N/A') else ip
+
+
+def _accumulate_rollups(acc, target, when, hop_num, ip, rtts):
+    """Добавляет один хоп (до трех RTT) во все разрешения словаря acc."""
+    values = [v for v in rtts if v is not None]
+    loss = max(RTT_PROBES_PER_HOP - len(values), 0)
+    epoch = int(when.timestamp()) if isinstance(when, datetime) else int(when)
+    ip = _rollup_ip(ip)
+    for resolution in RTT_RESOLUTIONS.values():
+        key = (target, resolution, hop_num, ip, epoch - epoch % resolution)
+        agg = acc.get(key)
+        if agg is None:
+            agg = acc[key] = [0, 0, None, None, 0.0, 0.0]
+        agg[0] += len(values)
+        agg[1] += loss
+        for v in values:
+            if agg[2] is None or v < agg[2]:
+                agg[2] = v
+            if agg[3] is None or v > agg[3]:
+                agg[3] = v
+            agg[4] += v
+            agg[5] += v * v
+
+
+def _write_rollups(cursor, acc):
+    cursor.executemany(_RTT_ROLLUP_UPSERT, [key + tuple(agg) for key, agg in acc.items()])
+
+
+def update_rtt_rollups(cursor, traces):
+    """Инкрементально обновляет rtt_rollups по нормализованным трассировкам (в транзакции писателя).
+
+    Хопы пачки сначала сводятся в памяти, поэтому на корзину приходится один UPSERT.
+    """
+    acc = {}
+    for trace in traces:
+        for hop_num, _hostname, ip, rtt1, rtt2, rtt3, _key in trace['rows']:
+            _accumulate_rollups(acc, trace['target'], trace['timestamp'], hop_num, ip, (rtt1, rtt2, rtt3))
+    if acc:
+        _write_rollups(cursor, acc)
+
+
+def rebuild_rtt_rollups(cursor):
+    """Пересчитывает rtt_rollups по всей истории hops (первичное заполнение существующей БД)."""
+    cursor.execute('DELETE FROM rtt_rollups')
+    cursor.execute('''
+    SELECT r.target, r.timestamp, h.hop_number, h.ip_address, h.rtt1, h.rtt2, h.rtt3
+    FROM hops h
+    JOIN requests r ON r.id = h.request_id
+    ''')
+    acc = {}
+    for target, timestamp, hop_num, ip, rtt1, rtt2, rtt3 in cursor.fetchall():
+        try:
+            when = datetime.fromisoformat(str(timestamp))
+        except (TypeError, ValueError):
+            continue
+        _accumulate_rollups(acc, target or 'unknown', when, hop_num, ip, (rtt1, rtt2, rtt3))
+    if acc:
+        _write_rollups(cursor, acc)
+
+
+def _epoch_param(value):
+    """Граница интервала: unix time или ISO-время (локальное, если без зоны)."""
+    value = str(value).strip()
+    try:
+        return int(float(value))
+    except ValueError:
+        return int(datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp())
+
+
+def _auto_resolution(since, until):
+    span = until - since
+    if span <= 6 * 3600:
+        return RTT_RESOLUTIONS['1m']
+    if span <= 14 * 86400:
+        return RTT_RESOLUTIONS['1h']
+    return RTT_RESOLUTIONS['1d']
+
+
+def get_rtt_series(target, since, until, resolution, hop_number=None, ip=None):
+    """Ряды RTT из rtt_rollups: [{'hop_number', 'ip', 'points': [...]}, ...], без чтения hops."""
+    sql = '''
+    SELECT hop_number, ip_address, bucket, count, loss, rtt_min, rtt_max, rtt_sum, rtt_sumsq
+    FROM rtt_rollups
+    WHERE target = ? AND resolution = ?'''
+    params = [target, resolution]
+    if hop_number is not None:
+        sql += ' AND hop_number = ?'
+        params.append(hop_number)
+    if ip is not None:
+        sql += ' AND ip_address = ?'
+        params.append(ip)
+    sql += ''' AND bucket >= ? AND bucket < ?
+    ORDER BY hop_number, ip_address, bucket
+    LIMIT ?'''
+    params.extend([since - since % resolution, until, RTT_SERIES_MAX_POINTS])
+    series = []
+    current = None
+    with read_cursor(HISTORY_DB) as cursor:
+        cursor.execute(sql, params)
+        for hop_num, ip_address, bucket, count, loss, rtt_min, rtt_max, rtt_sum, rtt_sumsq in cursor:
+            if current is None or (current['hop_number'], current['ip']) != (hop_num, ip_address):
+                current = {'hop_number': hop_num, 'ip': ip_address or None, 'points': []}
+                series.append(current)
+            avg = rtt_sum / count if count else None
+            stddev = (max(rtt_sumsq / count - avg * avg, 0.0) ** 0.5) if count else None
+            current['points'].append({
+                't': bucket,
+                'count': count,
+                'loss': loss,
+                'loss_pct': round(100.0 * loss / (count + loss), 2) if count + loss else None,
+                'min': rtt_min,
+                'max': rtt_max,
+                'avg': round(avg, 3) if avg is not None else None,
+                'stddev': round(stddev, 3) if stddev is not None else None
+            })
+    return series
+
+
+# ============================
+# ФУНКЦИИ ДЛЯ ДЕРЕВА ПУТЕЙ
+# ============================
+
+# CRUD для независимой истории путей (paths_tree.db)
+
+def _insert_path_history(cursor, traces):
+    """Строки истории путей (path_requests, path_hops) в транзакции вызывающего."""
+    for trace in traces:
+        cursor.execute('''
+        INSERT INTO path_requests (command, target, hops_count, timestamp)
+        VALUES (?, ?, ?, ?)
+        ''', (trace['command'], trace['target'], trace['hops_count'], trace['timestamp']))
+        request_id = cursor.lastrowid
+        cursor.executemany('''
+        INSERT INTO path_hops (request_id, hop_number, hostname, ip_address, rtt1, rtt2, rtt3, ip_key)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [(request_id,) + row for row in trace['rows']])
+
+def save_path_request_to_db(command, hops_data):
+    """Сохраняет запрос пути и хопы в отдельную БД paths_tree.db."""
+    return store_traces([normalize_trace(command, hops_data)], history=False, path_history=True, aggregate=False)
+
+def get_path_request_history_page(filters=None, cursor=None, limit=HISTORY_PAGE_SIZE):
+    """Страница истории запросов путей: (items, next_cursor)."""
+    return query_request_page(PATHS_DB, 'path_requests', filters, cursor, limit)
+
+
+def get_path_request_history():
+    """Возвращает историю запросов для страницы путей."""
+    try:
+        return get_path_request_history_page()[0]
+    except Exception as e:
+        app.logger.warning('get_path_request_history failed: %s', e)
+        record_swallowed('get_path_request_history')
+        return []
+
+def get_path_request_details(request_id):
+    """Возвращает детали конкретного запроса для страницы путей."""
+    try:
+        with read_cursor(PATHS_DB) as cursor:
+            cursor.execute('SELECT command, target FROM path_requests WHERE id = ?', (request_id,))
+            info = cursor.fetchone()
+            if not info:
+                return None
+            cursor.execute('''
+            SELECT hop_number, hostname, ip_address, rtt1, rtt2, rtt3
+            FROM path_hops
+            WHERE request_id = ?
+            ORDER BY hop_number
+            ''', (request_id,))
+            hops = [_hop_from_row(row) for row in cursor.fetchall()]
+        # Нормализация таймаутов (как в истории)
+        return {
+            'command': info[0],
+            'target': info[1],
+            'hops': _normalize_timeout_hops(hops)
+        }
+    except Exception as e:
+        app.logger.warning('get_path_request_details failed: %s', e)
+        record_swallowed('get_path_request_details')
+        return None
+
+def _ensure_target_ids(cursor, names) -> dict:
+    """Создает недостающие цели и возвращает {name: id} в рамках текущей транзакции."""
+    names = sorted(set(names))
+    cursor.executemany('INSERT OR IGNORE INTO targets(name) VALUES (?)', [(n,) for n in names])
+    ids = {}
+    # Ограничение SQLite на число параметров в одном запросе
+    for i in range(0, len(names), 500):
+        chunk = names[i:i + 500]
+        cursor.execute(f"SELECT name, id FROM targets WHERE name IN ({','.join('?' * len(chunk))})", chunk)
+        ids.update(cursor.fetchall())
+    return ids
+
+
+def _insert_aggregate(cursor, traces):
+    """Узлы и IP агрегата путей (INSERT OR IGNORE) в транзакции вызывающего."""
+    target_ids = _ensure_target_ids(cursor, [t['target'] for t in traces])
+    cursor.executemany(
+        'INSERT OR IGNORE INTO hop_nodes(target_id, hop_number, hostname) VALUES (?, ?, ?)',
+        [(target_ids[t['target']], hop_num, hostname) for t in traces for hop_num, hostname in t['nodes']]
+    )
+    cursor.executemany(
+        'INSERT OR IGNORE INTO hop_ips(target_id, hop_number, ip_address, ip_key) VALUES (?, ?, ?, ?)',
+        [(target_ids[t['target']], hop_num, ip, ip_key(ip)) for t in traces for hop_num, ip in t['ips']]
+    )
+    # Ребра пачки сводятся в памяти: один UPSERT на ребро цели
+    acc = {}
+    for t in traces:
+        for src, dst in t.get('edges', ()):
+            key = (target_ids[t['target']], src, dst)
+            entry = acc.get(key)
+            if entry is None:
+                acc[key] = [1, t['timestamp']]
+            else:
+                entry[0] += 1
+                entry[1] = max(entry[1], t['timestamp'])
+    if acc:
+        cursor.executemany(_HOP_EDGE_UPSERT, [key + (count, last_seen) for key, (count, last_seen) in acc.items()])
+
+
+_HOP_EDGE_UPSERT = '''
+INSERT INTO hop_edges (target_id, src_ip, dst_ip, count, last_seen) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (target_id, src_ip, dst_ip) DO UPDATE SET
+    count = count + excluded.count,
+    last_seen = max(last_seen, excluded.last_seen)
+'''
+
+
+def rebuild_hop_edges(cursor):
+    """Заполняет hop_edges по истории путей path_hops (первичное заполнение существующей БД)."""
+    cursor.execute('DELETE FROM hop_edges')
+    cursor.execute('''
+    SELECT r.id, r.target, r.timestamp, h.hop_number, h.ip_address
+    FROM path_requests r
+    JOIN path_hops h ON h.request_id = r.id
+    ORDER BY r.id
+    ''')
+    traces = {}
+    for request_id, target, timestamp, hop_num, ip in cursor.fetchall():
+        ip = (ip or '').strip()
+        trace = traces.setdefault(request_id, {'target': target or 'unknown', 'timestamp': str(timestamp), 'ips': []})
+        if ip and ip not in ('Таймаут', 'N/A'):
+            trace['ips'].append((hop_num, ip))
+    traces = [dict(t, edges=hop_edges(t['ips'])) for t in traces.values() if t['ips']]
+    if traces:
+        target_ids = _ensure_target_ids(cursor, [t['target'] for t in traces])
+        cursor.executemany(_HOP_EDGE_UPSERT, [(target_ids[t['target']], src, dst, 1, t['timestamp'])
+                                             for t in traces for src, dst in t['edges']])
+
+
+def update_paths_aggregate(command: str, hops_data: list):
+    """Обновляет агрегированную БД путей на основании результата traceroute."""
+    return store_traces([normalize_trace(command, hops_data)], history=False)
+
+
+def store_traces(traces, history=True, path_history=False, aggregate=True):
+    """Единственный путь записи нормализованных трассировок: одна транзакция на вызов.
+
+    history — requests/hops и агрегаты RTT (network_history.db), path_history — path_requests/
+    path_hops, aggregate — агрегат путей (paths_tree.db). Если нужны обе базы, paths_tree.db
+    подключается к соединению истории через ATTACH: один BEGIN IMMEDIATE и один COMMIT,
+    ошибка любой записи до COMMIT откатывает обе базы. Атомарность самого COMMIT в режиме
+    WAL — только по каждому файлу: при сбое процесса во время COMMIT одна база может
+    зафиксироваться без другой. Строки хопов нормализуются один раз для всех таблиц.
+    Запись, вложенная во внешнюю транзакцию, сбрасывает кэши агрегата вместо дополнения.
+    """
+    if not traces:
+        return False
+    uses_paths = path_history or aggregate
+    if history:
+        main, attach = HISTORY_DB, ({'paths': PATHS_DB} if uses_paths else None)
+    else:
+        main, attach = PATHS_DB, None
+    try:
+        with write_transaction(main, attach=attach) as cursor:
+            if history:
+                _insert_history(cursor, traces)
+            if path_history:
+                _insert_path_history(cursor, traces)
+            if aggregate:
+                _insert_aggregate(cursor, traces)
+    except Exception as e:
+        app.logger.warning('store_traces failed: %s', e)
+        record_swallowed('store_traces')
+        return False
+    if aggregate:
+        version = committed_data_version(PATHS_DB)
+        PATHS_CACHE.merge(os.path.abspath(PATHS_DB), traces, version)
+        TOPOLOGY.merge(os.path.abspath(PATHS_DB), traces, version)
+    return True
+
+
+def persist_traces(traces):
+    """Сохраняет трассировки (command, hops) в историю и агрегат путей одной транзакцией."""
+    normalized = [normalize_trace(command, hops) for command, hops in traces if hops]
+    return store_traces(normalized)
+
+
+def _follows(version, previous):
+    """version — следующая за previous версия той же базы (между ними не было чужих записей)."""
+    return (version is not None and previous is not None
+            and version[0] == previous[0] and version[1] == previous[1] + 1)
+
+
+class PathsAggregateCache:
+    """Кэш агрегата путей в памяти процесса.
+
+    Снимок {target: [hop, ...]} не изменяется на месте: инкрементальное обновление
+    копирует только затронутые цели, поэтому отданный клиенту снимок безопасно
+    сериализовать параллельно. Поколение защищает от записи устаревшей загрузки.
+    Снимок привязан к версии базы (data_version): запись другого процесса меняет
+    версию, и следующее обращение перечитывает агрегат.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._db = None
+        self._version = None
+        self._paths = None
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, db, loader):
+        # Версия читается до загрузки: снимок не старше версии, с которой сохранен
+        version, _ = read_data_version(db)
+        with self._lock:
+            if self._paths is not None and self._db == db and self._version == version and version is not None:
+                self.hits += 1
+                return self._paths
+            self.misses += 1
+            generation = self._generation
+        paths = loader()
+        with self._lock:
+            # Без версии снимок не кэшируется: изменения нечем было бы заметить
+            if self._generation == generation and version is not None:
+                self._db = db
+                self._version = version
+                self._paths = paths
+        return paths
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._paths = None
+
+    def merge(self, db, traces, version):
+        """Добавляет в снимок узлы и IP нормализованных трассировок (как INSERT OR IGNORE).
+
+        version — версия базы после записи traces; если снимок не предыдущей версии,
+        он сбрасывается.
+        """
+        with self._lock:
+            self._generation += 1
+            if self._paths is None or self._db != db:
+                return
+            if not _follows(version, self._version):
+                self._paths = None
+                return
+            self._version = version
+            paths = dict(self._paths)
+            for trace in traces:
+                if not trace['nodes'] and not trace['ips']:
+                    continue
+                hops = {h['hop_number']: {'hop_number': h['hop_number'], 'nodes': list(h['nodes']), 'ips': list(h['ips'])}
+                        for h in paths.get(trace['target'], [])}
+                for key, values in (('nodes', trace['nodes']), ('ips', trace['ips'])):
+                    for hop_number, value in values:
+                        hop = hops.get(hop_number)
+                        if hop is None:
+                            hop = hops[hop_number] = {'hop_number': hop_number, 'nodes': [], 'ips': []}
+                        if value not in hop[key]:
+                            hop[key].append(value)
+                paths[trace['target']] = [hops[n] for n in sorted(hops)]
+            self._paths = paths
+
+
+PATHS_CACHE = PathsAggregateCache()
+
+
+# Ограничения ответа /api/topology
+TOPOLOGY_MAX_DEPTH = 6
+TOPOLOGY_DEFAULT_LIMIT = 5000
+TOPOLOGY_MAX_LIMIT = 100000
+
+
+class TopologyIndex:
+    """Индекс смежности по hop_edges в памяти процесса.
+
+    edges: {(src, dst): {target: [count, last_seen]}}; adjacency: {ip: {сосед, ...}}
+    (без направления); by_target: {target: {(src, dst), ...}}. Загрузка ленивая,
+    сохраненные трассировки добавляются инкрементально (как в PathsAggregateCache).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._db = None
+        self._version = None
+        self._loaded = False
+        self._generation = 0
+        self._reset()
+
+    def _reset(self):
+        self.edges = {}
+        self.adjacency = {}
+        self.by_target = {}
+
+    def _add(self, target, src, dst, count, last_seen):
+        per_target = self.edges.setdefault((src, dst), {})
+        entry = per_target.get(target)
+        if entry is None:
+            per_target[target] = [count, last_seen]
+        else:
+            entry[0] += count
+            entry[1] = max(entry[1], last_seen)
+        self.adjacency.setdefault(src, set()).add(dst)
+        self.adjacency.setdefault(dst, set()).add(src)
+        self.by_target.setdefault(target, set()).add((src, dst))
+
+    def _ensure_loaded(self, db):
+        version, _ = read_data_version(db)
+        with self._lock:
+            if self._loaded and self._db == db and self._version == version and version is not None:
+                return
+            generation = self._generation
+        with read_cursor(db) as cursor:
+            cursor.execute('''
+            SELECT t.name, e.src_ip, e.dst_ip, e.count, e.last_seen
+            FROM hop_edges e
+            JOIN targets t ON t.id = e.target_id
+            ''')
+            rows = cursor.fetchall()
+        with self._lock:
+            if self._generation != generation:
+                return
+            self._reset()
+            for target, src, dst, count, last_seen in rows:
+                self._add(target, src, dst, count, str(last_seen))
+            self._db = db
+            self._version = version
+            self._loaded = True
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._loaded = False
+            self._reset()
+
+    def merge(self, db, traces, version):
+        """Добавляет ребра нормализованных трассировок (как UPSERT в hop_edges) для версии базы version."""
+        with self._lock:
+            self._generation += 1
+            if not self._loaded or self._db != db:
+                return
+            if not _follows(version, self._version):
+                self._loaded = False
+                self._reset()
+                return
+            self._version = version
+            for trace in traces:
+                last_seen = _db_timestamp(trace['timestamp'])
+                for src, dst in trace.get('edges', ()):
+                    self._add(trace['target'], src, dst, 1, last_seen)
+
+    def target_edges(self, db, target):
+        """Копия множества ребер (src, dst) цели."""
+        self._ensure_loaded(db)
+        with self._lock:
+            return frozenset(self.by_target.get(target, ()))
+
+    def query(self, db, targets=None, node=None, depth=1, min_degree=0, min_count=1, limit=TOPOLOGY_DEFAULT_LIMIT):
+        """Подграф: ребра целей targets, окрестность node радиуса depth, k-ядро по min_degree.
+
+        Вес ребра — сумма наблюдений по выбранным целям. Узел node при прореживании
+        по степени сохраняется. Ребра упорядочены по весу, не больше limit.
+        """
+        self._ensure_loaded(db)
+        with self._lock:
+            if targets:
+                candidate = set()
+                for target in targets:
+                    candidate |= self.by_target.get(target, set())
+            else:
+                candidate = None
+            if node is not None:
+                adjacency = self.adjacency
+                if candidate is not None:
+                    # Обход только по ребрам выбранных целей
+                    adjacency = {}
+                    for src, dst in candidate:
+                        adjacency.setdefault(src, set()).add(dst)
+                        adjacency.setdefault(dst, set()).add(src)
+                visited = {node} if node in adjacency else set()
+                frontier = set(visited)
+                for _ in range(depth):
+                    frontier = {n for ip in frontier for n in adjacency.get(ip, ())} - visited
+                    if not frontier:
+                        break
+                    visited |= frontier
+                keys = [(src, dst) for src in visited for dst in adjacency.get(src, ())
+                        if dst in visited and (src, dst) in self.edges
+                        and (candidate is None or (src, dst) in candidate)]
+            else:
+                keys = candidate if candidate is not None else self.edges.keys()
+            selected = {}
+            for key in keys:
+                per_target = self.edges[key]
+                entries = [per_target[t] for t in targets if t in per_target] if targets else per_target.values()
+                count = sum(e[0] for e in entries)
+                if count >= min_count:
+                    selected[key] = {'count': count, 'last_seen': max(e[1] for e in entries),
+                                     'targets': sorted(t for t in per_target if not targets or t in targets)}
+
+        # k-ядро: повторно убираем узлы со степенью ниже min_degree
+        degree = {}
+        for src, dst in selected:
+            degree[src] = degree.get(src, 0) + 1
+            degree[dst] = degree.get(dst, 0) + 1
+        while min_degree > 1:
+            weak = {ip for ip, d in degree.items() if d < min_degree and ip != node}
+            if not weak:
+                break
+            for key in [k for k in selected if k[0] in weak or k[1] in weak]:
+                del selected[key]
+                for ip in key:
+                    degree[ip] -= 1
+            for ip in weak:
+                degree.pop(ip, None)
+
+        ordered = sorted(selected.items(), key=lambda item: (-item[1]['count'], item[0]))
+        truncated = len(ordered) > limit
+        ordered = ordered[:limit]
+        nodes = {}
+        for (src, dst), _ in ordered:
+            nodes[src] = nodes.get(src, 0) + 1
+            nodes[dst] = nodes.get(dst, 0) + 1
+        return {
+            'nodes': [{'id': ip, 'degree': d} for ip, d in sorted(nodes.items())],
+            'edges': [dict(info, source=src, target=dst) for (src, dst), info in ordered],
+            'truncated': truncated
+        }
+
+
+TOPOLOGY = TopologyIndex()
+
+
+def _load_all_paths():
+    """Строит агрегат одним проходом по hop_nodes и hop_ips с доступом по ключу (target, hop)."""
+    paths = {}
+    index = {}
+    with read_cursor(PATHS_DB) as cursor:
+        cursor.execute('''
+            SELECT t.name, n.hop_number, n.hostname, NULL
+            FROM hop_nodes n
+            JOIN targets t ON n.target_id = t.id
+            UNION ALL
+            SELECT t.name, i.hop_number, NULL, i.ip_address
+            FROM hop_ips i
+            JOIN targets t ON i.target_id = t.id
+        ''')
+        for target, hop_number, hostname, ip in cursor:
+            hop = index.get((target, hop_number))
+            if hop is None:
+                hop = index[(target, hop_number)] = {'hop_number': hop_number, 'nodes': {}, 'ips': {}}
+                paths.setdefault(target, []).append(hop)
+            if hostname:
+                hop['nodes'][hostname] = None
+            if ip:
+                hop['ips'][ip] = None
+    for target in paths:
+        paths[target].sort(key=lambda x: x['hop_number'])
+        for hop in paths[target]:
+            hop['nodes'] = list(hop['nodes'])
+            hop['ips'] = list(hop['ips'])
+    return paths
+
+
+def find_path_ips_by_prefix(prefix, limit=500):
+    """IP агрегата путей внутри префикса: [{'target', 'hop_number', 'ip'}, ...]."""
+    lo, hi = ip_prefix_range(prefix)
+    with read_cursor(PATHS_DB) as cursor:
+        cursor.execute('''
+        SELECT t.name, i.hop_number, i.ip_address
+        FROM hop_ips i
+        JOIN targets t ON t.id = i.target_id
+        WHERE i.ip_key BETWEEN ? AND ?
+        ORDER BY i.ip_key
+        LIMIT ?
+        ''', (lo, hi, limit))
+        return [{'target': target, 'hop_number': hop_number, 'ip': ip} for target, hop_number, ip in cursor.fetchall()]
+
+
+def get_all_paths():
+    """Возвращает все пути из независимой БД paths_tree.db (через кэш агрегата)."""
+    try:
+        return PATHS_CACHE.get(os.path.abspath(PATHS_DB), _load_all_paths)
+    except Exception as e:
+        app.logger.warning('get_all_paths failed: %s', e)
+        record_swallowed('get_all_paths')
+        return {}
+
+
+# ============================
+# РАСКЛАДКА ДЕРЕВА ПУТЕЙ
+# ============================
+
+# Параметры раскладки по умолчанию и допустимый диапазон (пиксели)
+PATHS_LAYOUT_DEFAULTS = {'x_gap': 180, 'y_gap': 40, 'group_gap': 60}
+PATHS_LAYOUT_RANGE = (10, 1000)
+# Сколько готовых ответов (версия данных, параметры) держать в памяти
+PATHS_LAYOUT_CACHE_SIZE = int(os.environ.get('PATHS_LAYOUT_CACHE_SIZE', '8'))
+
+
+def parse_layout_params(args):
+    """Параметры раскладки из query string; ValueError при неверном значении."""
+    params = {}
+    lo, hi = PATHS_LAYOUT_RANGE
+    for name, default in PATHS_LAYOUT_DEFAULTS.items():
+        value = int(args.get(name, default))
+        if not lo <= value <= hi:
+            raise ValueError(f'{name} must be between {lo} and {hi}')
+        params[name] = value
+    return params
+
+
+def _layout_order(ips, predecessors, previous_rows, existing=()):
+    """Порядок IP в колонке: сначала уже размещенные (existing), затем новые по барицентру.
+
+    Барицентр — средняя строка предшественников в предыдущей колонке; узлы без
+    предшественников идут в конец, равные — по адресу.
+    """
+    def barycenter(ip):
+        rows = [previous_rows[src] for src in predecessors.get(ip, ()) if src in previous_rows]
+        return sum(rows) / len(rows) if rows else float('inf')
+
+    present = set(ips)
+    kept = [ip for ip in existing if ip in present]
+    placed = set(kept)
+    fresh = sorted((ip for ip in ips if ip not in placed), key=lambda ip: (barycenter(ip), ip_key(ip) or b'', ip))
+    return kept + fresh
+
+
+def compute_target_layout(hops, edges, previous=None):
+    """Раскладка одной цели в единицах сетки: колонка — номер хопа, строка — позиция в колонке.
+
+    hops — список хопов агрегата цели, edges — ребра (IP хопа N, IP хопа N+1) из hop_edges.
+    С предыдущей раскладкой (previous) уже размещенные узлы сохраняют порядок, а новые
+    добавляются в конец своих колонок: узлы не прыгают при дозаписи трассировки.
+    Возвращает {'columns': [(hop_number, [(ip, label), ...]), ...], 'links': [(col, row, col, row), ...], 'rows': N}.
+    """
+    predecessors = {}
+    for src, dst in edges:
+        predecessors.setdefault(dst, []).append(src)
+    old_columns = {hop_number: [ip for ip, _ in column] for hop_number, column in (previous or {}).get('columns', ())}
+
+    columns = []
+    positions = {}
+    previous_rows = {}
+    previous_hop = None
+    for hop in hops:
+        if not hop['ips']:
+            continue
+        hop_number = hop['hop_number']
+        # Ребра есть только между соседними хопами
+        rows_before = previous_rows if previous_hop == hop_number - 1 else {}
+        order = _layout_order(hop['ips'], predecessors, rows_before, old_columns.get(hop_number, ()))
+        # Имя хоста однозначно относится к IP, только если в хопе по одному значению
+        label = hop['nodes'][0] if len(order) == 1 and len(hop['nodes']) == 1 else ''
+        previous_rows = {ip: row for row, ip in enumerate(order)}
+        for ip, row in previous_rows.items():
+            positions[(hop_number, ip)] = (len(columns), row)
+        columns.append((hop_number, [(ip, label) for ip in order]))
+        previous_hop = hop_number
+
+    hops_by_ip = {}
+    for hop_number, ip in positions:
+        hops_by_ip.setdefault(ip, []).append(hop_number)
+    links = []
+    for src, dst in edges:
+        for hop_number in hops_by_ip.get(src, ()):
+            dst_position = positions.get((hop_number + 1, dst))
+            if dst_position is not None:
+                links.append(positions[(hop_number, src)] + dst_position)
+    links.sort()
+    return {'columns': columns, 'links': links, 'rows': max((len(c) for _, c in columns), default=0)}
+
+
+class SingleFlight:
+    """Объединение одинаковых одновременных вызовов: выполняется один, остальные ждут его результат."""
+
+    class _Call:
+        __slots__ = ('event', 'result', 'error')
+
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def do(self, key, fn, timeout=None):
+        """Возвращает (result, shared). shared=True — результат чужого вызова; TimeoutError при ожидании дольше timeout."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+            else:
+                self.coalesced += 1
+        if leader:
+            try:
+                call.result = fn()
+            except BaseException as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.event.set()
+        elif not call.event.wait(timeout):
+            raise TimeoutError(f'Timed out waiting for in-flight call {key!r}')
+        if call.error is not None:
+            raise call.error
+        return call.result, not leader
+
+    def inflight(self):
+        with self._lock:
+            return len(self._calls)
+
+
+class PathsLayoutCache:
+    """Готовые раскладки дерева путей.
+
+    Ответы хранятся по ключу (версия данных paths_tree.db, параметры раскладки).
+    Раскладка цели в единицах сетки от параметров не зависит и пересчитывается, только
+    если сменился снимок ее хопов в PathsAggregateCache (merge копирует лишь затронутые
+    цели), поэтому новая трассировка перестраивает одну цель, а остальные берутся готовыми.
+
+    Расчет (в т.ч. чтение ребер из базы) идет вне блокировки: одинаковые одновременные
+    запросы объединяются через SingleFlight, а блокировка берется только для чтения
+    готовых ответов и установки результата.
+    """
+
+    def __init__(self, size=PATHS_LAYOUT_CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._flights = SingleFlight()
+        self._size = size
+        self._payloads = OrderedDict()
+        self._targets = {}
+        self.hits = 0
+        self.misses = 0
+        self.targets_reused = 0
+        self.targets_computed = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._payloads.clear()
+            self._targets.clear()
+
+    def get(self, db, version, params, paths, edges_for):
+        """Ответ для версии version; paths — снимок агрегата, edges_for(target) — ребра цели."""
+        if version is None:
+            # База без версии: ответ не кэшируется
+            payload = assemble_paths_layout(self._target_layouts(paths, edges_for), params)
+            payload['version'] = None
+            return payload
+        key = (db, version, tuple(sorted(params.items())))
+        with self._lock:
+            payload = self._payloads.get(key)
+            if payload is not None:
+                self._payloads.move_to_end(key)
+                self.hits += 1
+                return payload
+        payload, shared = self._flights.do(key, lambda: self._build(key, db, version, params, paths, edges_for))
+        if shared:
+            with self._lock:
+                self.hits += 1
+        return payload
+
+    def _build(self, key, db, version, params, paths, edges_for):
+        with self._lock:
+            self.misses += 1
+        # Раскладки целей общие для всех параметров одной версии
+        layouts, _ = self._flights.do((db, version), lambda: self._target_layouts(paths, edges_for))
+        payload = assemble_paths_layout(layouts, params)
+        payload['version'] = version
+        with self._lock:
+            self._payloads[key] = payload
+            while len(self._payloads) > self._size:
+                self._payloads.popitem(last=False)
+        return payload
+
+    def _target_layouts(self, paths, edges_for):
+        with self._lock:
+            previous = dict(self._targets)
+        layouts = {}
+        computed = {}
+        for target in sorted(paths):
+            hops = paths[target]
+            cached = previous.get(target)
+            if cached is not None and cached[0] is hops:
+                layouts[target] = cached[1]
+                continue
+            layout = compute_target_layout(hops, edges_for(target), cached[1] if cached else None)
+            computed[target] = (hops, layout)
+            layouts[target] = layout
+        # Параллельный расчет другой версии может перезаписать цели: это лишь
+        # лишний пересчет позже, т.к. раскладка берется только для того же снимка хопов
+        with self._lock:
+            self.targets_reused += len(layouts) - len(computed)
+            self.targets_computed += len(computed)
+            self._targets.update(computed)
+            for target in [t for t in self._targets if t not in paths]:
+                del self._targets[target]
+        return layouts
+
+
+def assemble_paths_layout(layouts, params):
+    """Переводит раскладки целей в пиксели и ставит группы целей друг под другом.
+
+    Компактный ответ: groups — [target, y, height], nodes — [group, hop, ip, label, x, y],
+    links — [индекс узла-источника, индекс узла-приемника].
+    """
+    x_gap, y_gap, group_gap = params['x_gap'], params['y_gap'], params['group_gap']
+    groups, nodes, links = [], [], []
+    top = 0
+    width = 0
+    for group, (target, layout) in enumerate(layouts.items()):
+        if not layout['columns']:
+            continue
+        height = layout['rows'] * y_gap
+        index = {}
+        for col, (hop_number, column) in enumerate(layout['columns']):
+            # Колонка центрируется по высоте группы
+            offset = (layout['rows'] - len(column)) / 2
+            x = (hop_number - 1) * x_gap
+            width = max(width, x)
+            for row, (ip, label) in enumerate(column):
+                index[(col, row)] = len(nodes)
+                nodes.append([len(groups), hop_number, ip, label, x, round(top + (offset + row + 0.5) * y_gap, 1)])
+        links.extend([index[(c1, r1)], index[(c2, r2)]] for c1, r1, c2, r2 in layout['links'])
+        groups.append([target, top, height])
+        top += height + group_gap
+    return {
+        'params': dict(params),
+        'width': width,
+        'height': max(top - group_gap, 0),
+        'groups': groups,
+        'nodes': nodes,
+        'links': links
+    }
+
+
+PATHS_LAYOUT = PathsLayoutCache()
+
+
+def get_paths_layout(params):
+    """Раскладка дерева путей для текущей версии агрегата."""
+    db = os.path.abspath(PATHS_DB)
+    # Версия берется до снимка: ответ не старее версии, под которой он сохранен
+    version, _ = get_data_version(PATHS_DB)
+    paths = get_all_paths()
+    return PATHS_LAYOUT.get(db, version, params, paths, lambda target: TOPOLOGY.target_edges(db, target))
+
+#
+
+
+# ============================
+# ОС-СПЕЦИФИКА
+# ============================
+
+def is_windows():
+    return os.name == 'nt' or sys.platform.startswith('win')
+
+def is_linux():
+    return sys.platform.startswith('linux')
+
+
+# Флаги traceroute/tracert, за которыми следует значение (не цель)
+_VALUE_FLAGS = ('-m', '-h', '-w', '-q')
+
+
+def command_target(args):
+    """Цель команды: первый аргумент, не являющийся флагом или значением -m/-h/-w/-q."""
+    skip = {i + 1 for i, a in enumerate(args) if a in _VALUE_FLAGS}
+    return next((a for i, a in enumerate(args) if not a.startswith('-') and i not in skip), None)
+
+
+def build_command_args(user_command: str):
+    """Построение аргументов для OS-специфичных команд/флагов (поддерживаются только traceroute/tracert)."""
+    try:
+        tokens = user_command.strip().split()
+        if not tokens:
+            return []
+        cmd = tokens[0].lower()
+        args = tokens[1:]
+        if is_windows():
+            if cmd in ('traceroute', 'tracert'):
+                out = ['tracert']
+                if '-n' in args or '-d' in args:
+                    out.append('-d')
+                if '-6' in args or '-4' in args:
+                    out.append('-6' if '-6' in args else '-4')
+                if '-m' in args:
+                    try:
+                        i = args.index('-m'); out.extend(['-h', args[i+1]])
+                    except Exception:
+                        pass
+                if '-w' in args:
+                    try:
+                        i = args.index('-w'); val = args[i+1]; ms = max(1, int(float(val) * 1000))
+                        out.extend(['-w', str(ms)])
+                    except Exception:
+                        pass
+                target = command_target(args)
+                if target:
+                    out.append(target)
+                return out
+        else:
+            if cmd in ('tracert', 'traceroute'):
+                out = ['traceroute']
+                if '-d' in args or '-n' in args:
+                    out.append('-n')
+                if '-6' in args or '-4' in args:
+                    out.append('-6' if '-6' in args else '-4')
+                if '-h' in args or '-m' in args:
+                    try:
+                        if '-h' in args:
+                            i = args.index('-h'); out.extend(['-m', args[i+1]])
+                        else:
+                            i = args.index('-m'); out.extend(['-m', args[i+1]])
+                    except Exception:
+                        pass
+                if '-w' in args:
+                    try:
+                        i = args.index('-w'); ms = int(args[i+1]); s = max(1, int(round(ms / 1000.0)))
+                        out.extend(['-w', str(s)])
+                    except Exception:
+                        pass
+                target = command_target(args)
+                if target:
+                    out.append(target)
+                return out
+        return tokens
+    except Exception:
+        return user_command.strip().split()
+
+
+def run_command(command, timeout=None):
+    """Безопасное выполнение системной команды (Windows/Linux)."""
+    started = time.perf_counter()
+    args = build_command_args(command)
+    record_span('args', time.perf_counter() - started)
+    if not args:
+        return "", "Empty command", 1
+    name = os.path.basename(args[0])
+    code = 'error'
+    started = time.perf_counter()
+    try:
+        result = subprocess.run(
+            args,
+            capture_output=True,
+            text=True,
+            timeout=timeout if timeout is not None else COMMAND_TIMEOUT
+        )
+        code = str(result.returncode)
+        return result.stdout, result.stderr, result.returncode
+    except subprocess.TimeoutExpired:
+        code = 'timeout'
+        return None, "Command timed out", -1
+    except Exception as e:
+        return None, str(e), -1
+    finally:
+        elapsed = time.perf_counter() - started
+        SUBPROCESS_LATENCY.observe(elapsed, name)
+        SUBPROCESS_EXITS.inc(name, code)
+        record_span('subprocess', elapsed)
+
+
+def stream_command(command, timeout=None):
+    """Построчное выполнение системной команды через Popen.
+
+    Генератор отдает ('line', text) для каждой строки stdout по мере появления
+    и в конце ('exit', (stderr, returncode)).
+    """
+    args = build_command_args(command)
+    if not args:
+        yield 'exit', ("Empty command", 1)
+        return
+    try:
+        proc = subprocess.Popen(
+            args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            bufsize=1
+        )
+    except Exception as e:
+        yield 'exit', (str(e), -1)
+        return
+
+    # Сторожевой таймер: readline блокируется, поэтому таймаут обеспечиваем kill()
+    expired = threading.Event()
+
+    def _kill():
+        expired.set()
+        try:
+            proc.kill()
+        except Exception:
+            pass
+
+    watchdog = threading.Timer(timeout if timeout is not None else COMMAND_TIMEOUT, _kill)
+    watchdog.daemon = True
+    watchdog.start()
+    try:
+        for line in proc.stdout:
+            yield 'line', line.rstrip('\n')
+        stderr = proc.stderr.read()
+        returncode = proc.wait()
+    finally:
+        watchdog.cancel()
+        if proc.poll() is None:
+            # Клиент отключился раньше завершения команды
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+        proc.stderr.close()
+    if expired.is_set():
+        yield 'exit', ("Command timed out", -1)
+    else:
+        yield 'exit', (stderr, returncode)
+
+
+# ============================
+# ПАРСИНГ ВЫВОДА
+# ============================
+
+# Все шаблоны компилируются один раз при импорте
+_RE_WIN_TIMEOUT = re.compile(r'^\s*(\d+).*(Request timed out\.|Превышен.*ожидания|Время ожидания истекло)', re.IGNORECASE)
+_RE_WIN_HOP = re.compile(r'^\s*(\d+)\s+([<\d\s]+)ms\s+([<\d\s]+)ms\s+([<\d\s]+)ms\s+(.+)$')
+_RE_WIN_MS = re.compile(r'(\d+)')
+_RE_WIN_IP_BRACKETS = re.compile(r'\[([\d\.]+)\]')
+_RE_WIN_IP_LAST = re.compile(r'(\d{1,3}(?:\.\d{1,3}){3})(?!.*\d)')
+_RE_LINUX_TIMEOUT = re.compile(r'^\s*(\d+)\s+\*\s+\*\s+\*')
+_RE_LINUX_NAMED3 = re.compile(r'^\s*(\d+)\s+([\w\.-]+)\s+\(([\d\.]+)\)\s+([\d\.]+)\s+ms\s+([\d\.]+)\s+ms\s+([\d\.]+)\s+ms')
+_RE_LINUX_MIXED = re.compile(r'^\s*(\d+)\s+(\*|[\w\.-]+)\s+(\*|\([\d\.]+\)|[\w\.-]+\s+\([\d\.]+\))\s+([\d\.*]+)\s+ms\s+([\d\.*]+)\s+ms\s+([\d\.*]+)\s+ms')
+_RE_LINUX_NAMED1 = re.compile(r'^\s*(\d+)\s+([\w\.-]+)\s+\(([\d\.]+)\)\s+([\d\.]+)\s+ms')
+_RE_LINUX_NUMERIC = re.compile(r'^\s*(\d+)\s+([\d\.]+)\s+([\d\.]+)\s+ms')
+_RE_FALLBACK = re.compile(r'^\s*(\d+)\s+(.*)$')
+_RE_FALLBACK_IP = re.compile(r'(\d{1,3}(?:\.\d{1,3}){3})')
+_RE_FALLBACK_RTT = re.compile(r'([\d\.]+)\s*ms\b')
+# Кандидат в IPv6 (в т.ч. с встроенным IPv4); проверяется через ipaddress
+_RE_IPV6_CANDIDATE = re.compile(r'[0-9A-Fa-f.]*:[0-9A-Fa-f:.]+')
+# Первый непробельный символ после номера хопа — ключ диспетчеризации строки
+_RE_HOP_LEAD = re.compile(r'\s*\d+\s+(\S)')
+
+TRACEROUTE_FORMATS = ('linux', 'linux_numeric', 'windows', 'windows_ru', 'generic')
+
+
+def _timeout_hop(hop_num):
+    return {
+        'hop': hop_num,
+        'hostname': '*',
+        'ip': 'Таймаут',
+        'rtt1': None,
+        'rtt2': None,
+        'rtt3': None
+    }
+
+
+def _find_ipv6(text):
+    """Первый корректный IPv6-адрес в тексте: (адрес, начало, конец) или None."""
+    for m in _RE_IPV6_CANDIDATE.finditer(text):
+        try:
+            ipaddress.IPv6Address(m.group(0))
+            return m.group(0), m.start(), m.end()
+        except ValueError:
+            continue
+    return None
+
+
+def _parse_win_timeout(raw_line, line):
+    # Windows: таймаут строки
+    m = _RE_WIN_TIMEOUT.match(raw_line)
+    return _timeout_hop(m.group(1)) if m else None
+
+
+def _parse_win_hop(raw_line, line):
+    # Windows: обычная строка с 3 значениями ms и узлом
+    m = _RE_WIN_HOP.match(raw_line)
+    if not m:
+        return None
+    def _ms_val(s: str):
+        v = _RE_WIN_MS.search(s)
+        return v.group(1) if v else None
+    host_part = m.group(5).strip()
+    ip_br = _RE_WIN_IP_BRACKETS.search(host_part)
+    if ip_br:
+        ip = ip_br.group(1)
+        hostname = host_part.split('[')[0].strip().rstrip('.')
+        hostname = hostname if hostname else '*'
+    else:
+        ip_m = _RE_WIN_IP_LAST.search(host_part)
+        ip = ip_m.group(1) if ip_m else None
+        v6 = None if ip else _find_ipv6(host_part)
+        if v6:
+            # tracert -6: "host [2001:db8::1]" или голый адрес
+            ip, start, _ = v6
+            if start > 0 and host_part[start - 1] == '[':
+                host_part = host_part[:start - 1].strip().rstrip('.') or ip
+        if ip and host_part.strip() == ip:
+            hostname = '*'
+        else:
+            hostname = host_part.strip()
+    return {
+        'hop': m.group(1),
+        'hostname': hostname or '*',
+        'ip': ip or 'N/A',
+        'rtt1': _ms_val(m.group(2)),
+        'rtt2': _ms_val(m.group(3)),
+        'rtt3': _ms_val(m.group(4))
+    }
+
+
+def _parse_linux_timeout(raw_line, line):
+    # Linux: полный таймаут "N  * * *"
+    m = _RE_LINUX_TIMEOUT.match(line)
+    return _timeout_hop(m.group(1)) if m else None
+
+
+def _linux_hop_from_groups(groups):
+    hop_num = groups[0]
+    if groups[1] == '*' and groups[2] == '*':
+        return _timeout_hop(hop_num)
+    hostname = groups[1]
+    # IP
+    if groups[2].startswith('(') and groups[2].endswith(')'):
+        ip = groups[2][1:-1]
+    elif '.' in groups[2] and groups[2] != '*':
+        ip = groups[2]
+    else:
+        ip = 'N/A'
+    # RTT
+    rtt_values = [g for g in groups[3:7] if g and g != '*']
+    if not rtt_values and ip and ip != 'N/A':
+        rtt_values = [None, None, None]
+    return {
+        'hop': hop_num,
+        'hostname': hostname,
+        'ip': ip,
+        'rtt1': rtt_values[0] if len(rtt_values) > 0 else None,
+        'rtt2': rtt_values[1] if len(rtt_values) > 1 else None,
+        'rtt3': rtt_values[2] if len(rtt_values) > 2 else None
+    }
+
+
+def _linux_rule(pattern):
+    def _parse(raw_line, line):
+        m = pattern.match(line)
+        return _linux_hop_from_groups(m.groups()) if m else None
+    return _parse
+
+
+_parse_linux_named3 = _linux_rule(_RE_LINUX_NAMED3)
+_parse_linux_mixed = _linux_rule(_RE_LINUX_MIXED)
+_parse_linux_named1 = _linux_rule(_RE_LINUX_NAMED1)
+
+
+def _parse_linux_numeric(raw_line, line):
+    # Linux -n: "N  10.0.0.1  0.512 ms  0.498 ms  0.470 ms" — имени нет, узел называется по IP
+    m = _RE_LINUX_NUMERIC.match(line)
+    if not m:
+        return None
+    ip = m.group(2)
+    rtts = _RE_FALLBACK_RTT.findall(line[m.start(3):])
+    return {
+        'hop': m.group(1),
+        'hostname': ip,
+        'ip': ip,
+        'rtt1': rtts[0] if len(rtts) > 0 else None,
+        'rtt2': rtts[1] if len(rtts) > 1 else None,
+        'rtt3': rtts[2] if len(rtts) > 2 else None
+    }
+
+
+def _hostname_before(rest, start, ip):
+    # Имя узла перед "(ip)" или "[ip]"; для голого адреса — сам адрес
+    if start > 0 and rest[start - 1] in '([':
+        before = rest[:start - 1].split()
+        if before and before[-1] != '*' and not before[-1].endswith('ms'):
+            return before[-1]
+    return ip
+
+
+def _parse_ipv6_hop(hop_num, rest):
+    # IPv6 (traceroute -6): "host (2001:db8::1)  1.2 ms ...", голый адрес или "* host (...)"
+    v6 = _find_ipv6(rest)
+    if v6 is None:
+        return None
+    ip, start, end = v6
+    hostname = _hostname_before(rest, start, ip)
+    rtts = _RE_FALLBACK_RTT.findall(rest[end:])
+    return {
+        'hop': hop_num,
+        'hostname': hostname,
+        'ip': ip,
+        'rtt1': rtts[0] if len(rtts) > 0 else None,
+        'rtt2': rtts[1] if len(rtts) > 1 else None,
+        'rtt3': rtts[2] if len(rtts) > 2 else None
+    }
+
+
+def _parse_fallback(raw_line, line):
+    # Универсальный fallback
+    m = _RE_FALLBACK.match(line)
+    if not m:
+        return None
+    hop_num = m.group(1)
+    rest = m.group(2)
+    # Шаблоны выше знают только IPv4, поэтому IPv6-хопы доходят сюда
+    if ':' in rest:
+        hop = _parse_ipv6_hop(hop_num, rest)
+        if hop is not None:
+            return hop
+    ip_match = _RE_FALLBACK_IP.search(rest)
+    if '*' in rest and not ip_match:
+        return _timeout_hop(hop_num)
+    # Частичный таймаут с адресом ("3  * 10.0.0.1  4.2 ms") — хоп ответил
+    ip = ip_match.group(1) if ip_match else 'N/A'
+    if ip_match and '*' in rest:
+        hostname = _hostname_before(rest, ip_match.start(1), ip)
+        rtts = _RE_FALLBACK_RTT.findall(rest[ip_match.end(1):])
+    else:
+        hostname = ip if ip != 'N/A' else '*'
+        rtts = _RE_FALLBACK_RTT.findall(rest)
+    return {
+        'hop': hop_num,
+        'hostname': hostname,
+        'ip': ip,
+        'rtt1': rtts[0] if len(rtts) > 0 else None,
+        'rtt2': rtts[1] if len(rtts) > 1 else None,
+        'rtt3': rtts[2] if len(rtts) > 2 else None
+    }
+
+
+# Порядок правил для строки по первому символу после номера хопа и формату вывода.
+# Исходная цепочка: win_timeout, win_hop, linux_timeout, named3, mixed, named1, numeric, fallback.
+# Переставлены только правила с непересекающимися множествами строк, поэтому первое
+# совпавшее правило (и результат) то же, что в исходной цепочке:
+#  - win_hop требует после номера символ из '<', цифр или 'm', linux_timeout — '*';
+#  - named3/named1/mixed требуют '(' или '*' раньше третьего "N ms", а win_hop — нет;
+#  - numeric и named*/mixed расходятся на токене после адреса ('(' против "ms").
+# numeric пересекается с win_hop ("1  2  3 ms  4 ms  5 ms x"), поэтому всегда идет после него.
+_RULES_STAR = (_parse_linux_timeout, _parse_linux_mixed, _parse_fallback)
+_RULES_LT = (_parse_win_hop, _parse_fallback)
+_RULES_OTHER = (_parse_fallback,)
+_RULES_BY_FORMAT = {
+    'linux': (_parse_linux_named3, _parse_linux_mixed, _parse_linux_named1,
+              _parse_win_hop, _parse_linux_numeric, _parse_fallback),
+    'linux_numeric': (_parse_win_hop, _parse_linux_numeric, _parse_linux_named3,
+                      _parse_linux_mixed, _parse_linux_named1, _parse_fallback),
+    'generic': (_parse_win_hop, _parse_linux_named3, _parse_linux_mixed,
+                _parse_linux_named1, _parse_linux_numeric, _parse_fallback),
+}
+_RULES_BY_FORMAT['windows'] = _RULES_BY_FORMAT['generic']
+_RULES_BY_FORMAT['windows_ru'] = _RULES_BY_FORMAT['generic']
+# Для буквы/'.'/'-' win_hop возможен только при 'm' (строка "N  ms ..."), numeric — только при '.'
+_RULES_WORD = (_parse_linux_named3, _parse_linux_mixed, _parse_linux_named1, _parse_fallback)
+_RULES_WORD_M = (_parse_win_hop, _parse_linux_named3, _parse_linux_mixed, _parse_linux_named1, _parse_fallback)
+_RULES_DOT = (_parse_linux_named3, _parse_linux_mixed, _parse_linux_named1, _parse_linux_numeric, _parse_fallback)
+
+
+def detect_traceroute_format(output: str) -> str:
+    """Определяет формат вывода по заголовку (и первой строке хопа для Linux -n)."""
+    fmt = 'generic'
+    for raw_line in output.splitlines():
+        line = raw_line.strip()
+        if not line:
+            continue
+        lower = line.lower()
+        if fmt == 'generic':
+            if line.startswith('traceroute'):
+                fmt = 'linux'
+                continue
+            if lower.startswith('tracing route to'):
+                return 'windows'
+            if lower.startswith('трассировка маршрута'):
+                return 'windows_ru'
+            if line[0].isdecimal():
+                return 'generic'
+            continue
+        # Linux: по первой строке с ответом отличаем "host (ip)" от вывода -n
+        if 'ms' in line:
+            return 'linux' if '(' in line else 'linux_numeric'
+    return fmt
+
+
+def parse_traceroute_line(raw_line: str, fmt: str = 'generic'):
+    """Парсинг одной строки вывода traceroute/tracert. Возвращает хоп или None.
+
+    fmt — формат из detect_traceroute_format; влияет только на порядок проверки
+    правил, но не на результат.
+    """
+    line = raw_line.strip()
+    if not line:
+        return None
+    # Заголовки Linux/Windows
+    if line.startswith('traceroute'):
+        return None
+    lower = line.lower()
+    if lower.startswith('tracing route to') or lower.startswith('over a maximum'):
+        return None
+    # Все правила начинаются с номера хопа
+    if not line[0].isdecimal():
+        return None
+
+    # Таймаут Windows проверяется первым; для ASCII-строки он возможен только с этой фразой
+    if not line.isascii() or 'request timed out.' in lower:
+        hop = _parse_win_timeout(raw_line, line)
+        if hop is not None:
+            return hop
+
+    lead = _RE_HOP_LEAD.match(line)
+    if lead is None:
+        # Номер хопа без продолжения (например, "3" или "3 "): подходит только fallback
+        return _parse_fallback(raw_line, line)
+    c = lead.group(1)
+    if c == '*':
+        rules = _RULES_STAR
+    elif c == '<':
+        rules = _RULES_LT
+    elif c.isdecimal():
+        rules = _RULES_BY_FORMAT.get(fmt, _RULES_BY_FORMAT['generic'])
+    elif c == 'm':
+        rules = _RULES_WORD_M
+    elif c == '.':
+        rules = _RULES_DOT
+    elif c.isalnum() or c in '_-':
+        rules = _RULES_WORD
+    else:
+        rules = _RULES_OTHER
+    for rule in rules:
+        hop = rule(raw_line, line)
+        if hop is not None:
+            return hop
+    return None
+
+
+def parse_traceroute(output: str):
+    """Парсинг вывода traceroute/tracert для извлечения хопов (Linux/Windows)."""
+    started = time.perf_counter()
+    fmt = detect_traceroute_format(output)
+    hops = []
+    for raw_line in output.splitlines():
+        hop = parse_traceroute_line(raw_line, fmt)
+        if hop is not None:
+            hops.append(hop)
+    elapsed = time.perf_counter() - started
+    PARSE_LATENCY.observe(elapsed, fmt)
+    record_span('parse', elapsed)
+    PARSE_HOPS.observe(len(hops))
+    return hops
+
+
+# ============================
+# ОБРАТНЫЙ DNS
+# ============================
+
+# Трассировки выполняются с -n, имена хопов заполняются после (одной пачкой и из общего кэша)
+RDNS_ENABLED = os.environ.get('RDNS_ENABLED', '1') not in ('0', 'false', 'no', '')
+# DNS-сервер для PTR-запросов "host[:port]"; пусто — системный резолвер (gethostbyaddr)
+RDNS_SERVER = os.environ.get('RDNS_SERVER', '')
+RDNS_TIMEOUT = float(os.environ.get('RDNS_TIMEOUT', '2.0'))
+RDNS_MAX_WORKERS = int(os.environ.get('RDNS_MAX_WORKERS', '16'))
+RDNS_CACHE_SIZE = int(os.environ.get('RDNS_CACHE_SIZE', '4096'))
+RDNS_TTL = float(os.environ.get('RDNS_TTL', '3600'))
+# Отрицательные ответы (нет PTR, таймаут) живут меньше
+RDNS_NEGATIVE_TTL = float(os.environ.get('RDNS_NEGATIVE_TTL', '300'))
+
+
+class TTLCache:
+    """Ограниченный LRU-кэш с временем жизни записей (потокобезопасный).
+
+    get() возвращает (True, value) при попадании и (False, None) при промахе,
+    поэтому значение None можно хранить как отрицательный ответ.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, clock=time.monotonic):
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        self._clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > self._clock():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self._data[key]
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value, ttl: float = None):
+        with self._lock:
+            self._data[key] = (value, self._clock() + (self.ttl if ttl is None else ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+
+
+def _dns_ptr_query(query_id: int, ip: str) -> bytes:
+    name = ipaddress.ip_address(ip).reverse_pointer
+    qname = b''.join(bytes([len(label)]) + label.encode('ascii') for label in name.split('.')) + b'\x00'
+    # RD=1, один вопрос; QTYPE=PTR(12), QCLASS=IN(1)
+    return struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0) + qname + struct.pack('!HH', 12, 1)
+
+
+def _dns_read_name(message: bytes, offset: int):
+    """Имя из DNS-сообщения (со сжатием). Возвращает (name, offset после имени в исходном месте)."""
+    labels = []
+    end = None
+    for _ in range(128):
+        length = message[offset]
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            offset = ((length & 0x3F) << 8) | message[offset + 1]
+            continue
+        if length == 0:
+            return '.'.join(labels), (end if end is not None else offset + 1)
+        labels.append(message[offset + 1:offset + 1 + length].decode('ascii', 'replace'))
+        offset += 1 + length
+    raise ValueError('DNS name loop')
+
+
+def _dns_parse_ptr_response(message: bytes):
+    """(query_id, hostname | None) из ответа на PTR-запрос; None — NXDOMAIN или нет записи."""
+    query_id, flags, qdcount, ancount, _, _ = struct.unpack('!HHHHHH', message[:12])
+    offset = 12
+    for _ in range(qdcount):
+        _, offset = _dns_read_name(message, offset)
+        offset += 4
+    if flags & 0x000F:
+        return query_id, None
+    for _ in range(ancount):
+        _, offset = _dns_read_name(message, offset)
+        rtype, _, _, rdlength = struct.unpack('!HHIH', message[offset:offset + 10])
+        offset += 10
+        if rtype == 12:
+            return query_id, _dns_read_name(message, offset)[0].rstrip('.') or None
+        offset += rdlength
+    return query_id, None
+
+
+def _udp_ptr_lookup_many(ips, server: str, timeout: float):
+    """PTR для всех ips одним UDP-сокетом: запросы уходят сразу, ответы собираются до таймаута.
+
+    Возвращает {ip: hostname | None} только для ответивших адресов.
+    """
+    # "host", "host:port", "[v6]:port" или голый IPv6
+    if server.startswith('['):
+        host, _, port = server[1:].partition(']:')
+        host = host.rstrip(']')
+    elif server.count(':') == 1:
+        host, _, port = server.partition(':')
+    else:
+        host, port = server, ''
+    port = int(port) if port else 53
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    results = {}
+    pending = {}
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    try:
+        sock.setblocking(False)
+        base = int.from_bytes(os.urandom(2), 'big')
+        for i, ip in enumerate(ips):
+            query_id = (base + i) & 0xFFFF
+            pending[query_id] = ip
+            sock.sendto(_dns_ptr_query(query_id, ip), (host, port))
+        deadline = time.monotonic() + timeout
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            ready, _, _ = select.select([sock], [], [], remaining)
+            if not ready:
+                break
+            try:
+                message, _ = sock.recvfrom(4096)
+                query_id, hostname = _dns_parse_ptr_response(message)
+            except (OSError, ValueError, struct.error, IndexError):
+                continue
+            ip = pending.pop(query_id, None)
+            if ip is not None:
+                results[ip] = hostname
+    finally:
+        sock.close()
+    return results
+
+
+def _system_ptr_lookup(ip: str):
+    try:
+        return socket.gethostbyaddr(ip)[0]
+    except (socket.herror, socket.gaierror):
+        return None
+
+
+class ReverseDNSResolver:
+    """Пакетное обратное разрешение IP с общим LRU+TTL кэшем (включая отрицательные ответы).
+
+    С RDNS_SERVER все промахи пачки уходят одновременно одним UDP-сокетом; без него —
+    параллельно через пул потоков поверх системного резолвера. Не уложившиеся в
+    таймаут адреса остаются без имени и кэшируются как отрицательные на negative_ttl.
+    """
+
+    def __init__(self, server: str = RDNS_SERVER, timeout: float = RDNS_TIMEOUT,
+                 cache_size: int = RDNS_CACHE_SIZE, ttl: float = RDNS_TTL,
+                 negative_ttl: float = RDNS_NEGATIVE_TTL, max_workers: int = RDNS_MAX_WORKERS):
+        self.server = server
+        self.timeout = timeout
+        self.negative_ttl = negative_ttl
+        self.max_workers = max(1, max_workers)
+        self.cache = TTLCache(cache_size, ttl)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def _lookup_system(self, ips):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='rdns')
+        futures = {self._executor.submit(_system_ptr_lookup, ip): ip for ip in ips}
+        done, _ = wait(futures, timeout=self.timeout)
+        return {futures[f]: f.result() for f in done}
+
+    def resolve_many(self, ips):
+        """{ip: hostname | None} для всех ips; промахи кэша разрешаются одной пачкой."""
+        result = {}
+        misses = []
+        for ip in dict.fromkeys(ips):
+            hit, value = self.cache.get(ip)
+            if hit:
+                result[ip] = value
+            else:
+                misses.append(ip)
+        if misses:
+            try:
+                if self.server:
+                    found = _udp_ptr_lookup_many(misses, self.server, self.timeout)
+                else:
+                    found = self._lookup_system(misses)
+            except Exception as e:
+                app.logger.warning('reverse DNS batch failed: %s', e)
+                record_swallowed('reverse_dns')
+                found = {}
+            for ip in misses:
+                hostname = found.get(ip)
+                self.cache.set(ip, hostname, None if hostname else self.negative_ttl)
+                result[ip] = hostname
+        return result
+
+    def resolve(self, ip):
+        return self.resolve_many([ip]).get(ip)
+
+
+RDNS = ReverseDNSResolver()
+
+
+def unnamed_hop_ip(hop):
+    """IP хопа, которому нужно PTR-имя (hostname — '*' или сам IP), иначе None."""
+    ip = (hop.get('ip') or '').strip()
+    if hop.get('hostname') not in (None, '', '*', ip) or ip_key(ip) is None:
+        return None
+    return ip
+
+
+def fill_hop_hostnames(hops, resolver=None):
+    """Подставляет PTR-имена хопам без имени (hostname — '*' или сам IP). Изменяет hops на месте."""
+    resolver = resolver or RDNS
+    unnamed = [hop for hop in hops or [] if unnamed_hop_ip(hop)]
+    if not unnamed:
+        return hops
+    names = resolver.resolve_many([hop['ip'].strip() for hop in unnamed])
+    for hop in unnamed:
+        hostname = names.get(hop['ip'].strip())
+        if hostname:
+            hop['hostname'] = hostname
+    return hops
+
+
+def _is_numeric_command(command: str) -> bool:
+    args = command.strip().split()[1:]
+    return '-n' in args or '-d' in args
+
+
+# ============================
+# ВСТРОЕННЫЙ ДВИЖОК ЗОНДИРОВАНИЯ
+# ============================
+
+class ProbeBackend:
+    """Интерфейс бэкенда зондирования для ProbeEngine.
+
+    send_probe отправляет один зонд с заданным TTL, recv_reply возвращает
+    (probe_id, responder_ip, reached, rtt_ms) или None по таймауту.
+    probe_id=None означает постороннее сообщение, которое нужно пропустить;
+    rtt_ms=None — RTT измеряет сам движок по времени отправки.
+    """
+
+    def resolve(self, target: str) -> str:
+        raise NotImplementedError
+
+    def send_probe(self, dest: str, ttl: int, probe_id: int) -> None:
+        raise NotImplementedError
+
+    def recv_reply(self, timeout: float):
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class SocketProbeBackend(ProbeBackend):
+    """UDP-зонды с IP_TTL и прием ICMP через raw-сокет (нужен root/CAP_NET_RAW, только IPv4)."""
+
+    BASE_PORT = 33434
+
+    def __init__(self):
+        self._recv = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+        self._send = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._send.bind(('', 0))
+        self._sport = self._send.getsockname()[1]
+
+    def resolve(self, target: str) -> str:
+        return socket.gethostbyname(target)
+
+    def send_probe(self, dest: str, ttl: int, probe_id: int) -> None:
+        self._send.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, ttl)
+        # probe_id кодируется в порт назначения и возвращается в цитате ICMP
+        self._send.sendto(b'', (dest, self.BASE_PORT + probe_id))
+
+    def recv_reply(self, timeout: float):
+        ready, _, _ = select.select([self._recv], [], [], max(0.0, timeout))
+        if not ready:
+            return None
+        packet, addr = self._recv.recvfrom(1500)
+        try:
+            ihl = (packet[0] & 0x0f) * 4
+            icmp_type = packet[ihl]
+            # 11 — Time Exceeded (промежуточный узел), 3 — Destination Unreachable (цель)
+            if icmp_type not in (11, 3):
+                return None, None, False, None
+            inner = packet[ihl + 8:]
+            inner_ihl = (inner[0] & 0x0f) * 4
+            if inner[9] != socket.IPPROTO_UDP:
+                return None, None, False, None
+            sport, dport = struct.unpack('!HH', inner[inner_ihl:inner_ihl + 4])
+            if sport != self._sport:
+                return None, None, False, None
+            return dport - self.BASE_PORT, addr[0], icmp_type == 3, None
+        except (IndexError, struct.error):
+            return None, None, False, None
+
+    def close(self) -> None:
+        self._send.close()
+        self._recv.close()
+
+
+class SimulatedProbeBackend(ProbeBackend):
+    """Имитация топологии для тестов без привилегий и сети.
+
+    topology: {target: {'ip': dest_ip, 'hops': [ip | None, ...], 'rtt_ms': [...]}},
+    где None — узел, не отвечающий на зонды; последний хоп — сама цель.
+    """
+
+    def __init__(self, topology: dict):
+        self.topology = topology or {}
+        self._by_ip = {route.get('ip'): route for route in self.topology.values()}
+        self._replies = queue.Queue()
+
+    def resolve(self, target: str) -> str:
+        route = self.topology.get(target)
+        if route is None:
+            raise OSError(f'Unknown simulated target: {target}')
+        return route.get('ip') or target
+
+    def send_probe(self, dest: str, ttl: int, probe_id: int) -> None:
+        route = self._by_ip.get(dest)
+        if not route:
+            return
+        hops = route.get('hops') or []
+        rtts = route.get('rtt_ms') or []
+        index = min(ttl, len(hops)) - 1
+        if index < 0 or hops[index] is None:
+            return
+        rtt = rtts[index] if index < len(rtts) else float(index + 1)
+        self._replies.put((probe_id, hops[index], index == len(hops) - 1, rtt))
+
+    def recv_reply(self, timeout: float):
+        try:
+            return self._replies.get(timeout=max(0.0, timeout))
+        except queue.Empty:
+            return None
+
+
+class ProbeEngine:
+    """Трассировка без внешнего процесса: зонды для всех TTL отправляются сразу,
+    ответы сопоставляются по probe_id. Результат — хопы в формате parse_traceroute."""
+
+    def __init__(self, backend: ProbeBackend, probes_per_hop: int = 3, timeout: float = 3.0):
+        self.backend = backend
+        self.probes_per_hop = probes_per_hop
+        self.timeout = timeout
+
+    def trace(self, target: str, max_hops: int = 30):
+        dest = self.backend.resolve(target)
+        sent = {}
+        probe_id = 0
+        for attempt in range(self.probes_per_hop):
+            for ttl in range(1, max_hops + 1):
+                sent[probe_id] = (ttl, attempt, time.monotonic())
+                self.backend.send_probe(dest, ttl, probe_id)
+                probe_id += 1
+
+        replies = {}
+        reached_ttl = None
+        deadline_at = time.monotonic() + self.timeout
+        while len(replies) < len(sent):
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                break
+            # Все ответы до цели уже получены — дальше ждать нечего
+            if reached_ttl is not None and all(
+                (ttl, attempt) in replies
+                for ttl in range(1, reached_ttl + 1)
+                for attempt in range(self.probes_per_hop)
+            ):
+                break
+            reply = self.backend.recv_reply(remaining)
+            if reply is None:
+                continue
+            pid, responder, reached, rtt = reply
+            if pid not in sent:
+                continue
+            ttl, attempt, sent_at = sent[pid]
+            if rtt is None:
+                rtt = (time.monotonic() - sent_at) * 1000.0
+            replies.setdefault((ttl, attempt), (responder, rtt))
+            if reached or responder == dest:
+                reached_ttl = ttl if reached_ttl is None else min(reached_ttl, ttl)
+
+        last_ttl = reached_ttl or max_hops
+        hops = []
+        for ttl in range(1, last_ttl + 1):
+            answers = [replies[(ttl, a)] for a in range(self.probes_per_hop) if (ttl, a) in replies]
+            if not answers:
+                hops.append({
+                    'hop': str(ttl),
+                    'hostname': '*',
+                    'ip': 'Таймаут',
+                    'rtt1': None,
+                    'rtt2': None,
+                    'rtt3': None
+                })
+                continue
+            ip = answers[0][0]
+            rtt_values = ['%.3f' % rtt for _, rtt in answers]
+            hops.append({
+                'hop': str(ttl),
+                'hostname': ip,
+                'ip': ip,
+                'rtt1': rtt_values[0] if len(rtt_values) > 0 else None,
+                'rtt2': rtt_values[1] if len(rtt_values) > 1 else None,
+                'rtt3': rtt_values[2] if len(rtt_values) > 2 else None
+            })
+        # Отбрасываем хвост из таймаутов, если цель так и не ответила
+        while reached_ttl is None and hops and hops[-1]['ip'] == 'Таймаут' and len(hops) > 1 and hops[-2]['ip'] == 'Таймаут':
+            hops.pop()
+        return hops
+
+
+def format_traceroute(target: str, hops: list) -> str:
+    """Текстовое представление хопов в стиле вывода traceroute для raw_stdout."""
+    lines = [f'traceroute to {target}, {len(hops)} hops (probe engine)']
+    for hop in hops:
+        if hop['ip'] == 'Таймаут':
+            lines.append(f"{hop['hop']:>2}  * * *")
+            continue
+        rtts = '  '.join(f'{r} ms' for r in (hop['rtt1'], hop['rtt2'], hop['rtt3']) if r is not None)
+        lines.append(f"{hop['hop']:>2}  {hop['hostname']} ({hop['ip']})  {rtts}")
+    return '\n'.join(lines) + '\n'
+
+
+def make_probe_backend() -> ProbeBackend:
+    """Создает бэкенд зондирования согласно PROBE_BACKEND."""
+    if PROBE_BACKEND == 'simulated':
+        return SimulatedProbeBackend(SIMULATED_TOPOLOGY)
+    return SocketProbeBackend()
+
+
+def _probe_options_from_command(command: str):
+    """Извлекает цель, -m/-h (макс. хопов) и -w (мс, как в build_command_args) из команды."""
+    tokens = command.strip().split()
+    args = tokens[1:]
+    max_hops = 30
+    wait_s = 3.0
+    for flag in ('-m', '-h'):
+        if flag in args:
+            try:
+                max_hops = max(1, min(64, int(args[args.index(flag) + 1])))
+            except (IndexError, ValueError):
+                pass
+    if '-w' in args:
+        try:
+            wait_s = max(0.1, float(args[args.index('-w') + 1]) / 1000.0)
+        except (IndexError, ValueError):
+            pass
+    return command_target(args), max_hops, wait_s
+
+
+def run_probe_trace(command: str):
+    """Трассировка встроенным движком. Возвращает (stdout, stderr, returncode, hops)."""
+    target, max_hops, wait_s = _probe_options_from_command(command)
+    if not target:
+        return "", "No target", 1, None
+    backend = None
+    try:
+        backend = make_probe_backend()
+        hops = ProbeEngine(backend, timeout=wait_s).trace(target, max_hops=max_hops)
+        return format_traceroute(target, hops), "", 0, hops
+    except Exception as e:
+        return None, str(e), -1, None
+    finally:
+        if backend is not None:
+            backend.close()
+
+
+# Сколько секунд результат трассировки переиспользуется для той же нормализованной команды
+TRACE_CACHE_TTL = float(os.environ.get('TRACE_CACHE_TTL', '10'))
+TRACE_CACHE_SIZE = int(os.environ.get('TRACE_CACHE_SIZE', '256'))
+
+
+TRACE_FLIGHTS = SingleFlight()
+TRACE_RESULTS = TTLCache(TRACE_CACHE_SIZE, TRACE_CACHE_TTL)
+
+
+def _trace_key(command: str):
+    """Ключ одинаковых трассировок: движок и нормализованный вектор аргументов."""
+    return (TRACE_ENGINE, RDNS_ENABLED, tuple(build_command_args(command)))
+
+
+def _copy_trace_result(result):
+    # Вызывающие сохраняют и сериализуют хопы независимо — отдаем каждому свою копию
+    stdout, stderr, returncode, hops = result
+    return stdout, stderr, returncode, [dict(h) for h in hops] if hops is not None else None
+
+
+def _execute_traceroute(command: str, timeout=None):
+    # Если пользователь не просил -n, имена подставляются после трассировки из резолвера
+    resolve_names = RDNS_ENABLED and not _is_numeric_command(command)
+    if TRACE_ENGINE == 'probe':
+        stdout, stderr, returncode, hops = run_probe_trace(command)
+    else:
+        run_as = f'{command} -n' if resolve_names else command
+        stdout, stderr, returncode = run_command(run_as, timeout=timeout)
+        hops = parse_traceroute(stdout) if stdout else None
+    if resolve_names and hops:
+        fill_hop_hostnames(hops)
+    return stdout, stderr, returncode, hops
+
+
+def run_traceroute(command: str, timeout=None, cache: bool = True):
+    """Трассировка выбранным движком (TRACE_ENGINE). Возвращает (stdout, stderr, returncode, hops, fresh).
+
+    Одинаковые (по build_command_args) одновременные трассировки выполняются один раз,
+    завершенный результат переиспользуется TRACE_CACHE_TTL секунд. cache=False —
+    только объединение одновременных вызовов (для периодических замеров).
+    fresh=True только у вызова, который сам выполнил трассировку: результат из кэша
+    или чужого вызова уже сохранен им, и повторно в историю не пишется.
+    """
+    key = _trace_key(command)
+    if cache and TRACE_CACHE_TTL > 0:
+        hit, result = TRACE_RESULTS.get(key)
+        if hit:
+            return _copy_trace_result(result) + (False,)
+    wait_timeout = (timeout if timeout is not None else COMMAND_TIMEOUT) + 5
+    try:
+        result, shared = TRACE_FLIGHTS.do(key, lambda: _execute_traceroute(command, timeout), timeout=wait_timeout)
+    except TimeoutError:
+        return None, 'Command timed out waiting for an identical trace', -1, None, False
+    # Ошибки запуска и таймауты (returncode -1) не кэшируются
+    if not shared and result[2] != -1 and TRACE_CACHE_TTL > 0:
+        TRACE_RESULTS.set(key, result)
+    return _copy_trace_result(result) + (not shared,)
+
+
+def stream_traceroute(command: str, timeout=None):
+    """Потоковая трассировка с той же нормализацией, что и run_traceroute.
+
+    Генератор отдает ('line', text) и ('hop', hop) по мере появления и в конце
+    ('exit', (stdout, stderr, returncode, hops, fresh)). Как и в run_traceroute,
+    системная утилита запускается с -n, а имена хопов берутся из резолвера: хоп
+    отдается сразу с IP, его адрес разрешается в фоне, и найденное имя приходит
+    отдельным ('hostname', {'hop', 'ip', 'hostname'}) между следующими строками
+    (оставшиеся — до 'exit', не дольше таймаута резолвера). Движок
+    'probe' и готовый результат из TRACE_RESULTS отдаются целиком (строки, затем хопы),
+    fresh=False у результата из кэша. Отличие: живая трассировка не объединяется с
+    одновременной такой же — процесс нужен свой, чтобы отдавать строки по мере вывода, —
+    но ее результат кэшируется для следующих запросов.
+    """
+    key = _trace_key(command)
+    result = None
+    fresh = False
+    if TRACE_CACHE_TTL > 0:
+        hit, result = TRACE_RESULTS.get(key)
+        result = _copy_trace_result(result) if hit else None
+    if result is None and TRACE_ENGINE == 'probe':
+        *result, fresh = run_traceroute(command, timeout=timeout, cache=False)
+    if result is not None:
+        stdout, stderr, returncode, hops = result
+        for line in (stdout or '').splitlines():
+            yield 'line', line
+        for hop in hops or []:
+            yield 'hop', hop
+        yield 'exit', (stdout, stderr, returncode, hops, fresh)
+        return
+
+    resolve_names = RDNS_ENABLED and not _is_numeric_command(command)
+    run_as = f'{command} -n' if resolve_names else command
+    hops = []
+    stdout_lines = []
+    # Разрешение имен не задерживает строки: каждый адрес уходит в резолвер сразу
+    lookups = {}
+    resolver = RDNS
+    executor = ThreadPoolExecutor(max_workers=RDNS_MAX_WORKERS, thread_name_prefix='rdns-stream') \
+        if resolve_names else None
+
+    def _hostnames(timeout=0):
+        done, _ = wait(list(lookups), timeout=timeout)
+        for future in done:
+            hop, ip = lookups.pop(future)
+            hostname = future.result().get(ip)
+            if hostname:
+                hop['hostname'] = hostname
+                yield 'hostname', {'hop': hop['hop'], 'ip': ip, 'hostname': hostname}
+
+    try:
+        for kind, value in stream_command(run_as, timeout=timeout):
+            if kind == 'line':
+                stdout_lines.append(value)
+                yield 'line', value
+                hop = parse_traceroute_line(value)
+                if hop is not None:
+                    hops.append(hop)
+                    yield 'hop', dict(hop)
+                    ip = unnamed_hop_ip(hop) if resolve_names else None
+                    if ip:
+                        lookups[executor.submit(resolver.resolve_many, [ip])] = (hop, ip)
+                yield from _hostnames()
+            else:
+                stderr, returncode = value
+                yield from _hostnames(resolver.timeout + 1 if lookups else 0)
+                stdout = '\n'.join(stdout_lines)
+                result = (stdout, stderr, returncode, hops or None)
+                if returncode != -1 and TRACE_CACHE_TTL > 0:
+                    TRACE_RESULTS.set(key, _copy_trace_result(result))
+                yield 'exit', result + (True,)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+# ============================
+# ПАКЕТНАЯ ТРАССИРОВКА
+# ============================
+
+def build_batch_command(target: str, options: dict) -> str:
+    """Собирает команду traceroute для одной цели пакета из общих опций."""
+    numeric = bool(options.get('numeric'))
+    max_hops = options.get('max_hops')
+    wait_ms = options.get('wait_ms')
+    parts = ['traceroute']
+    if numeric:
+        parts.append('-n')
+    if isinstance(max_hops, int) and max_hops > 0:
+        parts.extend(['-m', str(max_hops)])
+    if isinstance(wait_ms, int) and wait_ms > 0:
+        parts.extend(['-w', str(wait_ms)])
+    parts.append(target)
+    return ' '.join(parts)
+
+
+def _trace_batch_target(target: str, user_command: str, deadline_at: float) -> dict:
+    """Трассировка одной цели пакета: выполнение и парсинг (запись делает run_batch_traceroute)."""
+    # Таймаут процесса не выходит за общий дедлайн пакета
+    remaining = max(1.0, deadline_at - time.monotonic())
+    stdout, stderr, returncode, parsed, fresh = run_traceroute(user_command, timeout=min(COMMAND_TIMEOUT, remaining))
+
+    return {
+        'target': target,
+        'command': user_command,
+        'status': 'done',
+        'raw_stdout': stdout,
+        'raw_stderr': stderr,
+        'returncode': returncode,
+        'hops': parsed,
+        # Результат из кэша или одновременной такой же трассировки (уже сохранен)
+        'shared': not fresh
+    }
+
+
+def _batch_placeholder(target: str, command: str, status: str, message: str) -> dict:
+    """Результат для цели, которая не была выполнена (дедлайн, отмена, ошибка)."""
+    return {
+        'target': target,
+        'command': command,
+        'status': status,
+        'raw_stdout': None,
+        'raw_stderr': message,
+        'returncode': -1,
+        'hops': None,
+        'shared': False
+    }
+
+
+def _store_late_result(future):
+    """Сохраняет результат цели, досчитавшей после отмены или дедлайна пакета."""
+    if future.cancelled():
+        return
+    try:
+        item = future.result()
+        if item.get('hops') and not item.get('shared'):
+            persist_traces([(item['command'], item['hops'])])
+    except Exception:
+        record_swallowed('batch_late_result')
+
+
+def run_batch_traceroute(jobs, max_workers=None, deadline=None, on_result=None, cancel_event=None):
+    """Параллельно выполняет пакет трассировок в ограниченном пуле потоков.
+
+    jobs — список пар (target, command). Результаты возвращаются в порядке входа;
+    цели, не успевшие завершиться к дедлайну, помечаются статусом 'deadline_exceeded',
+    а после установки cancel_event — статусом 'cancelled'. Цели из очереди при этом
+    не запускаются, а уже запущенные трассировки досчитываются в фоне (их процессы
+    ограничены дедлайном и COMMAND_TIMEOUT) и сохраняются в историю по завершении.
+    on_result(index, result) вызывается по мере завершения каждой цели.
+    Успешные трассировки пишутся в историю и агрегат путей пачками по BATCH_COMMIT_SIZE
+    (по умолчанию весь пакет одной транзакцией на БД). Возвращает (results, timed_out).
+    """
+    if not jobs:
+        return [], False
+    workers = max(1, min(max_workers or BATCH_MAX_WORKERS, BATCH_MAX_WORKERS, len(jobs)))
+    deadline = BATCH_DEADLINE if deadline is None else min(deadline, BATCH_DEADLINE)
+    deadline_at = time.monotonic() + deadline
+
+    results = [None] * len(jobs)
+    timed_out = False
+    cancelled = False
+    pending_writes = []
+
+    def _flush():
+        if pending_writes:
+            persist_traces(list(pending_writes))
+            pending_writes.clear()
+
+    def _finish(i, item):
+        results[i] = item
+        if item.get('hops') and not item.get('shared'):
+            # Сохраняем в основную историю и агрегат путей (без per-request записи в PATHS DB)
+            pending_writes.append((item['command'], item['hops']))
+            if len(pending_writes) >= BATCH_COMMIT_SIZE:
+                _flush()
+        if on_result:
+            try:
+                on_result(i, item)
+            except Exception:
+                record_swallowed('batch_on_result')
+
+    futures = {}
+    pending = set()
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='batch-trace')
+    try:
+        futures = {
+            executor.submit(_trace_batch_target, target, command, deadline_at): i
+            for i, (target, command) in enumerate(jobs)
+        }
+        pending = set(futures)
+        while pending:
+            if cancel_event is not None and cancel_event.is_set():
+                cancelled = True
+                break
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                timed_out = True
+                break
+            # Короткий шаг ожидания, чтобы вовремя заметить отмену
+            done, pending = wait(pending, timeout=min(remaining, 0.5), return_when=FIRST_COMPLETED)
+            for future in done:
+                i = futures[future]
+                try:
+                    _finish(i, future.result())
+                except Exception as e:
+                    target, command = jobs[i]
+                    _finish(i, _batch_placeholder(target, command, 'error', str(e)))
+    finally:
+        # Не ждем зависшие процессы: их таймаут уже ограничен дедлайном
+        executor.shutdown(wait=False, cancel_futures=True)
+        _flush()
+
+    # Очередь снята; запущенные трассировки сохранят результат сами, когда завершатся
+    in_flight = set()
+    for future in pending:
+        if not future.cancelled():
+            in_flight.add(futures[future])
+            future.add_done_callback(_store_late_result)
+
+    for i, item in enumerate(results):
+        if item is None:
+            target, command = jobs[i]
+            status, message = ('cancelled', 'Batch cancelled') if cancelled else \
+                ('deadline_exceeded', 'Batch deadline exceeded')
+            if i in in_flight:
+                message += '; trace still running, its result will be saved to history'
+            _finish(i, _batch_placeholder(target, command, status, message))
+    return results, timed_out
+
+
+# ============================
+# ФОНОВЫЕ ПАКЕТНЫЕ ЗАДАНИЯ
+# ============================
+
+# Максимальное число заданий в памяти (завершенные вытесняются первыми)
+MAX_JOBS = int(os.environ.get('MAX_JOBS', '100'))
+
+
+class BatchJob:
+    """Фоновое пакетное задание: статус и результаты в порядке завершения целей."""
+
+    def __init__(self, jobs, max_workers=None, deadline=None):
+        self.id = uuid.uuid4().hex
+        self.jobs = list(jobs)
+        self.max_workers = max_workers
+        self.deadline = deadline
+        self.status = 'queued'
+        self.created_at = datetime.now().isoformat()
+        self.finished_at = None
+        self.results = []
+        self.cancel_event = threading.Event()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'timed_out', 'cancelled', 'error')
+
+    def start(self):
+        self.status = 'running'
+        self._thread = threading.Thread(target=self._run, name=f'batch-job-{self.id[:8]}', daemon=True)
+        self._thread.start()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def _add_result(self, index, result):
+        with self._cond:
+            item = dict(result)
+            item['index'] = index
+            self.results.append(item)
+            self._cond.notify_all()
+
+    def _run(self):
+        status = 'done'
+        try:
+            _, timed_out = run_batch_traceroute(
+                self.jobs,
+                max_workers=self.max_workers,
+                deadline=self.deadline,
+                on_result=self._add_result,
+                cancel_event=self.cancel_event
+            )
+            if self.cancel_event.is_set():
+                status = 'cancelled'
+            elif timed_out:
+                status = 'timed_out'
+        except Exception:
+            record_swallowed('batch_job')
+            status = 'error'
+        with self._cond:
+            self.status = status
+            self.finished_at = datetime.now().isoformat()
+            self._cond.notify_all()
+
+    def iter_results(self, poll_interval=1.0):
+        """Генератор результатов: отдает готовые и ждет новые до завершения задания."""
+        sent = 0
+        while True:
+            with self._cond:
+                while sent >= len(self.results) and not self.finished:
+                    self._cond.wait(poll_interval)
+                batch = self.results[sent:]
+                sent += len(batch)
+                finished = self.finished and sent >= len(self.results)
+            for item in batch:
+                yield item
+            if finished:
+                return
+
+    def snapshot(self):
+        with self._cond:
+            completed = [
+                {
+                    'index': r['index'],
+                    'target': r['target'],
+                    'status': r['status'],
+                    'returncode': r['returncode'],
+                    'hops_count': len(r['hops']) if r['hops'] else 0
+                }
+                for r in self.results
+            ]
+            return {
+                'job_id': self.id,
+                'status': self.status,
+                'total': len(self.jobs),
+                'completed': len(completed),
+                'created_at': self.created_at,
+                'finished_at': self.finished_at,
+                'targets': completed
+            }
+
+
+# Таблица заданий: id -> BatchJob (порядок вставки для вытеснения)
+JOBS = OrderedDict()
+JOBS_LOCK = threading.Lock()
+
+
+def submit_batch_job(jobs, max_workers=None, deadline=None):
+    """Регистрирует и запускает фоновое задание. Возвращает None, если таблица заполнена активными."""
+    job = BatchJob(jobs, max_workers=max_workers, deadline=deadline)
+    with JOBS_LOCK:
+        while len(JOBS) >= MAX_JOBS:
+            victim = next((jid for jid, j in JOBS.items() if j.finished), None)
+            if victim is None:
+                return None
+            del JOBS[victim]
+        JOBS[job.id] = job
+    job.start()
+    return job
+
+
+def get_batch_job(job_id):
+    with JOBS_LOCK:
+        return JOBS.get(job_id)
+
+
+# ============================
+# НЕПРЕРЫВНЫЙ МОНИТОРИНГ (MTR-РЕЖИМ)
+# ============================
+
+# Число одновременных прогонов мониторинга
+MONITOR_MAX_WORKERS = int(os.environ.get('MONITOR_MAX_WORKERS', '4'))
+# Минимальный интервал между прогонами одной цели (секунды)
+MONITOR_MIN_INTERVAL = 10
+
+
+class MonitorTarget:
+    """Цель мониторинга: расписание, счетчики и запись о последнем прогоне."""
+
+    def __init__(self, target: str, interval: float, options: dict):
+        self.target = target
+        self.interval = interval
+        self.options = options
+        self.command = build_batch_command(target, options)
+        self.next_run = None
+        self.running = False
+        self.runs = 0
+        self.overruns = 0
+        self.deferred = 0
+        self.last_run = None
+
+    def to_dict(self):
+        return {
+            'target': self.target,
+            'interval_s': self.interval,
+            'options': self.options,
+            'command': self.command,
+            'running': self.running,
+            'next_run_in_s': round(max(0.0, self.next_run - time.monotonic()), 1) if self.next_run else None,
+            'runs': self.runs,
+            'overruns': self.overruns,
+            'deferred': self.deferred,
+            'last_run': self.last_run
+        }
+
+
+class MonitorScheduler:
+    """Фоновый планировщик периодических трассировок.
+
+    Первые запуски целей разнесены по фазе внутри интервала (crc32 имени цели),
+    чтобы цели с одинаковым интервалом не срабатывали одновременно. Обратное давление:
+    не более max_workers прогонов одновременно; если прошлый прогон цели еще идет,
+    очередной слот пропускается (overruns), а не ставится в очередь.
+    """
+
+    def __init__(self, max_workers: int = MONITOR_MAX_WORKERS):
+        self.max_workers = max(1, max_workers)
+        self._targets = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._executor = None
+        self._inflight = 0
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def add(self, target: str, interval: float, options: dict = None) -> MonitorTarget:
+        item = MonitorTarget(target, max(MONITOR_MIN_INTERVAL, interval), options or {})
+        phase = (zlib.crc32(target.encode('utf-8')) % 1000) / 1000.0
+        item.next_run = time.monotonic() + phase * item.interval
+        with self._lock:
+            self._targets[target] = item
+        self._wakeup.set()
+        return item
+
+    def remove(self, target: str) -> bool:
+        with self._lock:
+            return self._targets.pop(target, None) is not None
+
+    def list(self):
+        with self._lock:
+            return [t.to_dict() for t in sorted(self._targets.values(), key=lambda t: t.target)]
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='monitor')
+        self._thread = threading.Thread(target=self._loop, name='monitor-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self._thread = None
+        if self._executor is not None:
+            # Очереди в пуле нет (не более max_workers прогонов), текущие дорабатывают
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _loop(self):
+        while not self._stop.is_set():
+            delay = self.run_pending()
+            self._wakeup.wait(min(delay, 1.0))
+            self._wakeup.clear()
+
+    def run_pending(self, now=None):
+        """Запускает просроченные цели. Возвращает время (сек) до ближайшего запуска."""
+        now = time.monotonic() if now is None else now
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='monitor')
+        with self._lock:
+            due = sorted((t for t in self._targets.values() if t.next_run <= now), key=lambda t: t.next_run)
+            for item in due:
+                if item.running:
+                    # Прогон не уложился в интервал — пропускаем слот
+                    item.overruns += 1
+                    item.next_run = self._next_slot(item, now)
+                    continue
+                if self._inflight >= self.max_workers:
+                    # Пул занят — цель ждет, но не дольше одного интервала
+                    if now - item.next_run >= item.interval:
+                        item.deferred += 1
+                        item.next_run = self._next_slot(item, now)
+                    continue
+                item.running = True
+                self._inflight += 1
+                item.next_run = self._next_slot(item, now)
+                self._executor.submit(self._run_target, item)
+            upcoming = [t.next_run for t in self._targets.values()]
+        return max(0.0, min(upcoming) - now) if upcoming else 1.0
+
+    @staticmethod
+    def _next_slot(item: MonitorTarget, now: float) -> float:
+        # Следующий слот строго в будущем, без "догоняющей" пачки запусков
+        next_run = item.next_run + item.interval
+        if next_run <= now:
+            next_run += ((now - next_run) // item.interval + 1) * item.interval
+        return next_run
+
+    def _run_target(self, item: MonitorTarget):
+        started = time.monotonic()
+        record = {'started_at': datetime.now().isoformat()}
+        try:
+            stdout, stderr, returncode, hops, fresh = run_traceroute(item.command, cache=False)
+            saved = persist_traces([(item.command, hops)]) if hops and fresh else False
+            record.update({
+                'returncode': returncode,
+                'hops_count': len(hops) if hops else 0,
+                'saved': saved,
+                'error': None if returncode == 0 else (stderr or '').strip()[:500]
+            })
+        except Exception as e:
+            record.update({'returncode': -1, 'hops_count': 0, 'saved': False, 'error': str(e)})
+        finally:
+            record['finished_at'] = datetime.now().isoformat()
+            record['duration_ms'] = int((time.monotonic() - started) * 1000)
+            with self._lock:
+                item.last_run = record
+                item.runs += 1
+                item.running = False
+                self._inflight -= 1
+            self._wakeup.set()
+
+
+MONITOR = MonitorScheduler()
+
+
+# ============================
+# ХРАНЕНИЕ: РЕТЕНШН И АРХИВ
+# ============================
+
+# Правила хранения по таблицам (JSON), например:
+# {"requests": {"max_age_days": 90}, "path_requests": {"max_rows": 100000}, "rtt_rollups_1m": {"max_age_days": 2}}
+try:
+    RETENTION_POLICIES = json.loads(os.environ.get('RETENTION_POLICIES') or '{}')
+except ValueError as e:
+    app.logger.warning('RETENTION_POLICIES ignored: %s', e)
+    RETENTION_POLICIES = {}
+# Период фонового прохода (секунды)
+RETENTION_INTERVAL = float(os.environ.get('RETENTION_INTERVAL', '3600'))
+# Строк родительской таблицы на одну короткую транзакцию удаления
+RETENTION_BATCH_SIZE = int(os.environ.get('RETENTION_BATCH_SIZE', '500'))
+# Пауза между пачками, чтобы писатели трассировок успевали взять блокировку
+RETENTION_BATCH_PAUSE = float(os.environ.get('RETENTION_BATCH_PAUSE', '0.05'))
+# Сколько свободных страниц возвращать ОС за проход (PRAGMA incremental_vacuum)
+RETENTION_VACUUM_PAGES = int(os.environ.get('RETENTION_VACUUM_PAGES', '2000'))
+# Каталог архива удаленных строк (gzip NDJSON по дням); пусто — без архива
+RETENTION_ARCHIVE_DIR = os.environ.get('RETENTION_ARCHIVE_DIR') or None
+
+# Таблицы с правилами: история запросов (с хопами) и агрегаты RTT по разрешениям
+_RETENTION_REQUEST_TABLES = {
+    'requests': (lambda: HISTORY_DB, 'hops'),
+    'path_requests': (lambda: PATHS_DB, 'path_hops'),
+}
+_RETENTION_ROLLUP_TABLES = {f'rtt_rollups_{name}': resolution for name, resolution in RTT_RESOLUTIONS.items()}
+RETENTION_TABLES = tuple(_RETENTION_REQUEST_TABLES) + tuple(_RETENTION_ROLLUP_TABLES)
+
+_HOP_COLUMNS = ('hop_number', 'hostname', 'ip_address', 'rtt1', 'rtt2', 'rtt3')
+_ROLLUP_COLUMNS = ('target', 'resolution', 'hop_number', 'ip_address', 'bucket',
+                   'count', 'loss', 'rtt_min', 'rtt_max', 'rtt_sum', 'rtt_sumsq')
+
+
+def validate_retention_policies(policies):
+    """Проверяет правила; ValueError на неизвестной таблице или значении."""
+    for table, policy in policies.items():
+        if table not in RETENTION_TABLES:
+            raise ValueError(f'Unknown retention table: {table}')
+        if not isinstance(policy, dict) or not policy:
+            raise ValueError(f'Empty retention policy for {table}')
+        for key, value in policy.items():
+            if key not in ('max_age_days', 'max_rows'):
+                raise ValueError(f'Unknown retention rule {key} for {table}')
+            if key == 'max_rows' and table in _RETENTION_ROLLUP_TABLES:
+                raise ValueError(f'{table} supports max_age_days only')
+            if not isinstance(value, (int, float)) or value < 0:
+                raise ValueError(f'Invalid {key} for {table}: {value}')
+
+
+def _archive_records(table, records):
+    """Дописывает записи в {RETENTION_ARCHIVE_DIR}/{table}/{YYYY-MM-DD}.ndjson.gz.
+
+    Каждый вызов добавляет отдельный gzip-член; gzip.open читает файл целиком.
+    """
+    if not RETENTION_ARCHIVE_DIR or not records:
+        return
+    by_day = {}
+    for day, record in records:
+        by_day.setdefault(day, []).append(record)
+    directory = os.path.join(RETENTION_ARCHIVE_DIR, table)
+    os.makedirs(directory, exist_ok=True)
+    for day, items in by_day.items():
+        with gzip.open(os.path.join(directory, f'{day}.ndjson.gz'), 'at', encoding='utf-8') as f:
+            for record in items:
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+
+
+def _expire_requests_batch(table, policy, now, batch_size):
+    """Удаляет (и архивирует) одну пачку устаревших запросов с их хопами. Возвращает число запросов."""
+    get_db, child = _RETENTION_REQUEST_TABLES[table]
+    with write_transaction(get_db()) as cursor:
+        ids = []
+        if policy.get('max_age_days') is not None:
+            cutoff = (now - timedelta(days=policy['max_age_days'])).isoformat()
+            cursor.execute(f'SELECT id FROM {table} WHERE timestamp < ? ORDER BY timestamp, id LIMIT ?',
+                           (cutoff, batch_size))
+            ids.extend(row[0] for row in cursor.fetchall())
+        if policy.get('max_rows') is not None and len(ids) < batch_size:
+            excess = cursor.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0] - len(ids) - int(policy['max_rows'])
+            if excess > 0:
+                # Самые старые строки сверх лимита (уже выбранные по возрасту идут первыми)
+                cursor.execute(f'SELECT id FROM {table} ORDER BY timestamp, id LIMIT ?',
+                               (len(ids) + min(excess, batch_size - len(ids)),))
+                seen = set(ids)
+                ids.extend(row[0] for row in cursor.fetchall() if row[0] not in seen)
+        if not ids:
+            return 0
+        placeholders = ','.join('?' * len(ids))
+        if RETENTION_ARCHIVE_DIR:
+            cursor.execute(f'SELECT request_id, {", ".join(_HOP_COLUMNS)} FROM {child} '
+                           f'WHERE request_id IN ({placeholders}) ORDER BY request_id, id', ids)
+            hops = {}
+            for row in cursor.fetchall():
+                hops.setdefault(row[0], []).append(dict(zip(_HOP_COLUMNS, row[1:])))
+            cursor.execute(f'SELECT id, command, target, hops_count, timestamp FROM {table} '
+                           f'WHERE id IN ({placeholders})', ids)
+            _archive_records(table, [
+                (str(ts)[:10], {'table': table, 'id': row_id, 'command': command, 'target': target,
+                                'hops_count': hops_count, 'timestamp': ts, 'hops': hops.get(row_id, [])})
+                for row_id, command, target, hops_count, ts in cursor.fetchall()
+            ])
+        cursor.execute(f'DELETE FROM {child} WHERE request_id IN ({placeholders})', ids)
+        cursor.execute(f'DELETE FROM {table} WHERE id IN ({placeholders})', ids)
+        return len(ids)
+
+
+def _expire_rollups_batch(table, policy, now, batch_size):
+    """Удаляет (и архивирует) одну пачку корзин RTT старше max_age_days. Возвращает число корзин."""
+    if policy.get('max_age_days') is None:
+        return 0
+    resolution = _RETENTION_ROLLUP_TABLES[table]
+    cutoff = int((now - timedelta(days=policy['max_age_days'])).timestamp())
+    with write_transaction(HISTORY_DB) as cursor:
+        cursor.execute(f'SELECT {", ".join(_ROLLUP_COLUMNS)} FROM rtt_rollups '
+                       'WHERE resolution = ? AND bucket < ? ORDER BY bucket LIMIT ?',
+                       (resolution, cutoff, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            return 0
+        _archive_records(table, [
+            (datetime.fromtimestamp(row[4], timezone.utc).date().isoformat(),
+             dict(zip(_ROLLUP_COLUMNS, row), table='rtt_rollups'))
+            for row in rows
+        ])
+        cursor.executemany('DELETE FROM rtt_rollups WHERE target = ? AND resolution = ? AND hop_number = ? '
+                           'AND ip_address = ? AND bucket = ?', [row[:5] for row in rows])
+        return len(rows)
+
+
+def incremental_vacuum(path, pages=None):
+    """Возвращает ОС до pages свободных страниц. Возвращает остаток freelist."""
+    conn = get_connection(path)
+    conn.execute(f'PRAGMA incremental_vacuum({int(pages if pages is not None else RETENTION_VACUUM_PAGES)})').fetchall()
+    return conn.execute('PRAGMA freelist_count').fetchone()[0]
+
+
+def apply_retention(policies=None, now=None, batch_size=None, stop_event=None):
+    """Применяет правила хранения короткими пачками и делает incremental_vacuum затронутых баз.
+
+    Возвращает {'deleted': {table: n}, 'freelist': {db: pages}, 'duration_ms': ...}.
+    """
+    policies = RETENTION_POLICIES if policies is None else policies
+    validate_retention_policies(policies)
+    now = now or datetime.now()
+    batch_size = batch_size or RETENTION_BATCH_SIZE
+    started = time.monotonic()
+    deleted = {}
+    touched = set()
+    for table, policy in policies.items():
+        expire = _expire_requests_batch if table in _RETENTION_REQUEST_TABLES else _expire_rollups_batch
+        total = 0
+        while not (stop_event is not None and stop_event.is_set()):
+            n = expire(table, policy, now, batch_size)
+            total += n
+            if n < batch_size:
+                break
+            time.sleep(RETENTION_BATCH_PAUSE)
+        deleted[table] = total
+        if total:
+            touched.add(_RETENTION_REQUEST_TABLES[table][0]() if table in _RETENTION_REQUEST_TABLES else HISTORY_DB)
+    freelist = {os.path.basename(db): incremental_vacuum(db) for db in sorted(touched)}
+    return {'deleted': deleted, 'freelist': freelist, 'duration_ms': int((time.monotonic() - started) * 1000)}
+
+
+def _import_request_record(cursor, table, child, record):
+    exists = cursor.execute(f'SELECT 1 FROM {table} WHERE timestamp = ? AND command = ? AND target IS ?',
+                            (record['timestamp'], record['command'], record.get('target'))).fetchone()
+    if exists:
+        return False
+    cursor.execute(f'INSERT INTO {table} (command, target, hops_count, timestamp) VALUES (?, ?, ?, ?)',
+                   (record['command'], record.get('target'), record.get('hops_count'), record['timestamp']))
+    request_id = cursor.lastrowid
+    cursor.executemany(
+        f'INSERT INTO {child} (request_id, {", ".join(_HOP_COLUMNS)}, ip_key) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        [(request_id,) + tuple(h.get(c) for c in _HOP_COLUMNS) + (ip_key(h.get('ip_address')),)
+         for h in record.get('hops', [])])
+    return True
+
+
+def import_archive(path):
+    """Возвращает строки из архивного файла (.ndjson.gz) в базы. Повторный импорт ничего не дублирует.
+
+    Записи истории вставляются с исходным временем под новыми id (агрегаты RTT не пересчитываются),
+    корзины RTT — только если такой корзины еще нет.
+    """
+    counts = {}
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    groups = {}
+    for record in records:
+        groups.setdefault(record.get('table'), []).append(record)
+    for table, items in groups.items():
+        if table in _RETENTION_REQUEST_TABLES:
+            get_db, child = _RETENTION_REQUEST_TABLES[table]
+            with write_transaction(get_db()) as cursor:
+                counts[table] = sum(_import_request_record(cursor, table, child, r) for r in items)
+        elif table == 'rtt_rollups':
+            with write_transaction(HISTORY_DB) as cursor:
+                before = cursor.connection.total_changes
+                cursor.executemany(
+                    f'INSERT OR IGNORE INTO rtt_rollups ({", ".join(_ROLLUP_COLUMNS)}) '
+                    f'VALUES ({", ".join("?" * len(_ROLLUP_COLUMNS))})',
+                    [tuple(r.get(c) for c in _ROLLUP_COLUMNS) for r in items])
+                counts[table] = cursor.connection.total_changes - before
+        else:
+            raise ValueError(f'Unknown archive table: {table}')
+    return counts
+
+
+class RetentionWorker:
+    """Фоновый поток, периодически применяющий RETENTION_POLICIES."""
+
+    def __init__(self, interval: float = RETENTION_INTERVAL):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.last_run = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name='retention', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self._thread = None
+
+    def run_once(self, policies=None):
+        started_at = datetime.now().isoformat()
+        try:
+            record = apply_retention(policies, stop_event=self._stop)
+            record['error'] = None
+        except Exception as e:
+            app.logger.warning('retention pass failed: %s', e)
+            record_swallowed('retention')
+            record = {'error': str(e)}
+        record['started_at'] = started_at
+        with self._lock:
+            self.last_run = record
+        return record
+
+    def status(self):
+        with self._lock:
+            last_run = self.last_run
+        return {
+            'running': self.running,
+            'interval_s': self.interval,
+            'policies': RETENTION_POLICIES,
+            'archive_dir': RETENTION_ARCHIVE_DIR,
+            'last_run': last_run
+        }
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+
+RETENTION = RetentionWorker()
+
+
+@app.cli.command('import-archive')
+@click.argument('paths', nargs=-1, required=True)
+def import_archive_command(paths):
+    """Импорт архивов ретеншна (*.ndjson.gz) обратно в базы."""
+    for path in paths:
+        click.echo(f'{path}: {import_archive(path)}')
+
+
+@app.cli.command('vacuum')
+def vacuum_command():
+    """Полный VACUUM баз с переходом на auto_vacuum=INCREMENTAL (однократно для старых баз)."""
+    for path in (HISTORY_DB, PATHS_DB):
+        mode = 'INCREMENTAL' if _ensure_incremental_vacuum(path, vacuum=True) else 'unchanged'
+        click.echo(f'{path}: auto_vacuum={mode}')
+
+
+@app.cli.command('retention')
+def retention_command():
+    """Один проход ретеншна по RETENTION_POLICIES (для запуска по расписанию вместо фонового потока)."""
+    record = RETENTION.run_once()
+    if record.get('error'):
+        raise click.ClickException(f"Retention failed: {record['error']}")
+    click.echo(json.dumps(record, ensure_ascii=False, default=str))
+
+
+# ============================
+# ЭКСПОРТ
+# ============================
+
+# Строк на один fetchmany и на один фрагмент ответа
+EXPORT_FETCH_SIZE = int(os.environ.get('EXPORT_FETCH_SIZE', '1000'))
+EXPORT_FORMATS = ('ndjson', 'csv')
+
+# Источник истории: (таблица запросов, таблица хопов); база выбирается при выгрузке
+_EXPORT_HISTORY_SOURCES = {
+    'history': ('requests', 'hops'),
+    'paths': ('path_requests', 'path_hops'),
+}
+# Колонки CSV; NDJSON истории — запрос с вложенным списком хопов
+EXPORT_COLUMNS = {
+    'history': ('request_id', 'timestamp', 'target', 'command', 'hops_count') + _HOP_COLUMNS,
+    'paths': ('target', 'hop_number', 'kind', 'value'),
+    'rollups': _ROLLUP_COLUMNS,
+}
+
+
+def parse_export_filters(kind, args):
+    """Фильтры выгрузки из query string; ValueError на некорректных значениях.
+
+    history: target, since/until (время запроса), source=history|paths;
+    paths: target; rollups: target, since/until (начало корзины), resolution=1m|1h|1d.
+    """
+    filters = {}
+    target = (args.get('target') or '').strip()
+    if target:
+        filters['target'] = target
+    if kind == 'history':
+        for key in ('since', 'until'):
+            if args.get(key):
+                filters[key] = _db_timestamp(args[key])
+        source = args.get('source', 'history')
+        if source not in _EXPORT_HISTORY_SOURCES:
+            raise ValueError('source must be history or paths')
+        filters['source'] = source
+    elif kind == 'rollups':
+        for key in ('since', 'until'):
+            if args.get(key):
+                filters[key] = _epoch_param(args[key])
+        name = args.get('resolution')
+        if name:
+            if name not in RTT_RESOLUTIONS:
+                raise ValueError(f"resolution must be one of {', '.join(RTT_RESOLUTIONS)}")
+            filters['resolution'] = RTT_RESOLUTIONS[name]
+    elif kind != 'paths':
+        raise ValueError(f"kind must be one of {', '.join(EXPORT_COLUMNS)}")
+    return filters
+
+
+def _iter_rows(db_path, sql, params, fetch_size):
+    """Строки запроса пачками по fetch_size: курсор SQLite не материализует результат.
+
+    Пока генератор не исчерпан, открыта одна читающая транзакция — выгрузка видит
+    согласованный снимок и не мешает писателям (WAL).
+    """
+    with read_cursor(db_path) as cur:
+        cur.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(fetch_size)
+            if not rows:
+                return
+            yield rows
+
+
+def _where(clauses):
+    return ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+
+
+def iter_history_export(filters, fetch_size=EXPORT_FETCH_SIZE):
+    """Пачки строк (request_id, timestamp, target, command, hops_count, хоп...) в порядке времени.
+
+    Запросы без хопов дают одну строку с пустыми полями хопа.
+    """
+    source = filters.get('source', 'history')
+    requests_table, hops_table = _EXPORT_HISTORY_SOURCES[source]
+    db_path = HISTORY_DB if source == 'history' else PATHS_DB
+    where, params = [], []
+    if 'target' in filters:
+        where.append('r.target = ?')
+        params.append(filters['target'])
+    if 'since' in filters:
+        where.append('r.timestamp >= ?')
+        params.append(filters['since'])
+    if 'until' in filters:
+        where.append('r.timestamp < ?')
+        params.append(filters['until'])
+    # Порядок запросов берется из индекса (timestamp, id); сортируются только хопы внутри запроса
+    sql = f'''
+    SELECT r.id, r.timestamp, r.target, r.command, r.hops_count,
+           h.hop_number, h.hostname, h.ip_address, h.rtt1, h.rtt2, h.rtt3
+    FROM {requests_table} r
+    LEFT JOIN {hops_table} h ON h.request_id = r.id
+    {_where(where)}
+    ORDER BY r.timestamp, r.id, h.hop_number
+    '''
+    return _iter_rows(db_path, sql, params, fetch_size)
+
+
+def iter_paths_export(filters, fetch_size=EXPORT_FETCH_SIZE):
+    """Пачки строк агрегата путей (target, hop_number, kind, value): сначала узлы (node), затем IP (ip).
+
+    Каждая часть читается в порядке уникальных индексов, без сортировки всего агрегата.
+    """
+    where, params = [], []
+    if 'target' in filters:
+        where.append('t.name = ?')
+        params.append(filters['target'])
+    for kind, table, column in (('node', 'hop_nodes', 'hostname'), ('ip', 'hop_ips', 'ip_address')):
+        sql = f'''
+        SELECT t.name, x.hop_number, '{kind}', x.{column}
+        FROM targets t
+        JOIN {table} x ON x.target_id = t.id
+        {_where(where)}
+        ORDER BY t.name, x.hop_number, x.{column}
+        '''
+        yield from _iter_rows(PATHS_DB, sql, params, fetch_size)
+
+
+def iter_rollups_export(filters, fetch_size=EXPORT_FETCH_SIZE):
+    """Пачки строк rtt_rollups в порядке первичного ключа."""
+    where, params = [], []
+    for key, clause in (('target', 'target = ?'), ('resolution', 'resolution = ?'),
+                        ('since', 'bucket >= ?'), ('until', 'bucket < ?')):
+        if key in filters:
+            where.append(clause)
+            params.append(filters[key])
+    sql = f"SELECT {', '.join(_ROLLUP_COLUMNS)} FROM rtt_rollups{_where(where)} ORDER BY target, resolution, hop_number, ip_address, bucket"
+    return _iter_rows(HISTORY_DB, sql, params, fetch_size)
+
+
+_EXPORT_ITERATORS = {
+    'history': iter_history_export,
+    'paths': iter_paths_export,
+    'rollups': iter_rollups_export,
+}
+
+
+def _history_records(batches):
+    """Группирует плоские строки истории в записи {запрос, hops: [...]}, не держа больше одного запроса."""
+    current = None
+    for rows in batches:
+        records = []
+        for row in rows:
+            if current is None or current['id'] != row[0]:
+                if current is not None:
+                    records.append(current)
+                current = {'id': row[0], 'timestamp': row[1], 'target': row[2], 'command': row[3],
+                           'hops_count': row[4], 'hops': []}
+            if row[5] is not None:
+                current['hops'].append(dict(zip(_HOP_COLUMNS, row[5:])))
+        if records:
+            yield records
+    if current is not None:
+        yield [current]
+
+
+def generate_export(kind, fmt, filters, fetch_size=EXPORT_FETCH_SIZE):
+    """Генератор фрагментов выгрузки kind в формате fmt (по фрагменту на пачку строк)."""
+    batches = _EXPORT_ITERATORS[kind](filters, fetch_size)
+    columns = EXPORT_COLUMNS[kind]
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for rows in batches:
+            writer.writerows(rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+        return
+    records = _history_records(batches) if kind == 'history' else (
+        [dict(zip(columns, row)) for row in rows] for rows in batches)
+    for chunk in records:
+        yield ''.join(json.dumps(record, ensure_ascii=False, default=str) + '\n' for record in chunk)
+
+
+# ============================
+# ИМПОРТ СОХРАНЕННЫХ ТРАССИРОВОК
+# ============================
+
+# Процессов разбора (0 — по числу CPU; 1 — разбор в текущем процессе)
+IMPORT_WORKERS = int(os.environ.get('IMPORT_WORKERS', '0'))
+# Файлов на одну задачу пула: меньше накладных расходов на передачу между процессами
+IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', '64'))
+# Трассировок на одну транзакцию писателя
+IMPORT_COMMIT_SIZE = int(os.environ.get('IMPORT_COMMIT_SIZE', '5000'))
+# Процессы разбора запускаются через spawn: fork многопоточного сервера с открытыми
+# соединениями SQLite и захваченными блокировками небезопасен
+_IMPORT_MP_CONTEXT = multiprocessing.get_context('spawn')
+
+_RE_CAPTURE_HEADER = re.compile(
+    r'^\s*(?:traceroute6?\s+to|tracing\s+route\s+to|трассировка\s+маршрута\s+к)\s+(\S+)', re.IGNORECASE)
+
+
+def split_captures(text: str):
+    """Делит текст на отдельные трассировки по строкам-заголовкам: [(target или None, текст), ...].
+
+    Текст без заголовка считается одной трассировкой с неизвестной целью.
+    """
+    captures = []
+    target = None
+    lines = []
+    for line in text.splitlines():
+        m = _RE_CAPTURE_HEADER.match(line)
+        if m:
+            if any(l.strip() for l in lines):
+                captures.append((target, '\n'.join(lines)))
+            target = m.group(1)
+            lines = []
+        lines.append(line)
+    if any(l.strip() for l in lines):
+        captures.append((target, '\n'.join(lines)))
+    return captures
+
+
+def _decode_capture(data: bytes) -> str:
+    # tracert в русской консоли Windows пишет в cp866
+    try:
+        return data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        return data.decode('cp866', errors='replace')
+
+
+def _capture_target_from_name(name: str) -> str:
+    base = os.path.basename(name)
+    for suffix in ('.gz', '.txt', '.log', '.out'):
+        if base.lower().endswith(suffix):
+            base = base[:-len(suffix)]
+    return base or 'unknown'
+
+
+def iter_capture_files(name: str, fileobj, mtime: float):
+    """Файлы трассировок (name, bytes, mtime) из файла или архива (.zip, .tar[.gz], .tgz, .gz).
+
+    Архивы читаются по одному члену, целиком в память попадает только текущий файл.
+    """
+    lower = name.lower()
+    if lower.endswith('.zip'):
+        with zipfile.ZipFile(fileobj) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    yield info.filename, archive.read(info), datetime(*info.date_time).timestamp()
+    elif lower.endswith(('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')):
+        with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+            for member in archive:
+                if member.isfile():
+                    yield member.name, archive.extractfile(member).read(), member.mtime
+    elif lower.endswith('.gz'):
+        with gzip.GzipFile(fileobj=fileobj) as f:
+            yield name[:-3], f.read(), mtime
+    else:
+        yield name, fileobj.read(), mtime
+
+
+def iter_capture_paths(paths):
+    """Файлы трассировок по путям: файлы, архивы и каталоги (рекурсивно, в порядке имен)."""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                yield from iter_capture_paths(os.path.join(root, f) for f in sorted(files))
+            continue
+        with open(path, 'rb') as f:
+            yield from iter_capture_files(path, f, os.path.getmtime(path))
+
+
+def parse_capture_chunk(chunk):
+    """Задача пула: [(name, bytes, mtime), ...] -> (нормализованные трассировки, число пустых).
+
+    Время трассировки — время изменения файла: история и агрегаты RTT попадают в свои корзины.
+    """
+    traces = []
+    empty = 0
+    for name, data, mtime in chunk:
+        when = datetime.fromtimestamp(mtime)
+        for target, text in split_captures(_decode_capture(data)):
+            hops = parse_traceroute(text)
+            if not hops:
+                empty += 1
+                continue
+            trace = normalize_trace(f'traceroute {target or _capture_target_from_name(name)}', hops)
+            trace['timestamp'] = when
+            traces.append(trace)
+    return traces, empty
+
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_import_progress(files, workers=None, chunk_size=None, commit_size=None):
+    """Импорт файлов трассировок: разбор в пуле процессов, запись одним писателем.
+
+    files — итератор (name, bytes, mtime). Задач в полете не больше 2 * workers, поэтому
+    память не зависит от объема импорта. После каждой транзакции отдается снимок прогресса;
+    последний снимок — итог (done=True).
+    """
+    workers = workers if workers is not None else (IMPORT_WORKERS or os.cpu_count() or 1)
+    chunk_size = chunk_size or IMPORT_CHUNK_SIZE
+    commit_size = commit_size or IMPORT_COMMIT_SIZE
+    started = time.monotonic()
+    stats = {'files': 0, 'captures': 0, 'hops': 0, 'empty': 0, 'commits': 0, 'failed_commits': 0}
+    pending = []
+
+    def snapshot(done=False):
+        elapsed = time.monotonic() - started
+        return dict(stats, done=done, elapsed_s=round(elapsed, 3),
+                    captures_per_s=round(stats['captures'] / elapsed, 1) if elapsed > 0 else 0.0)
+
+    def commit():
+        # История и агрегат путей — одна большая транзакция на пачку
+        stats['commits' if store_traces(pending) else 'failed_commits'] += 1
+        pending.clear()
+
+    def collect(result):
+        traces, empty = result
+        stats['captures'] += len(traces)
+        stats['hops'] += sum(len(t['rows']) for t in traces)
+        stats['empty'] += empty
+        pending.extend(traces)
+        if len(pending) >= commit_size:
+            commit()
+            return True
+        return False
+
+    def counted(chunks):
+        for chunk in chunks:
+            stats['files'] += len(chunk)
+            yield chunk
+
+    chunks = counted(_chunks(files, chunk_size))
+    if workers <= 1:
+        for chunk in chunks:
+            if collect(parse_capture_chunk(chunk)):
+                yield snapshot()
+    else:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=_IMPORT_MP_CONTEXT) as executor:
+            inflight = set()
+            for chunk in chunks:
+                inflight.add(executor.submit(parse_capture_chunk, chunk))
+                if len(inflight) < 2 * workers:
+                    continue
+                done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+                if any([collect(f.result()) for f in done]):
+                    yield snapshot()
+            for future in inflight:
+                if collect(future.result()):
+                    yield snapshot()
+    if pending:
+        commit()
+    yield snapshot(done=True)
+
+
+def import_captures(files, workers=None, chunk_size=None, commit_size=None, on_progress=None):
+    """Импорт до конца; возвращает итоговую статистику (см. iter_import_progress)."""
+    result = None
+    for result in iter_import_progress(files, workers, chunk_size, commit_size):
+        if on_progress and not result['done']:
+            on_progress(result)
+    return result
+
+
+def _format_import_progress(stats) -> str:
+    return (f"files={stats['files']} captures={stats['captures']} hops={stats['hops']} "
+            f"empty={stats['empty']} commits={stats['commits']} failed={stats['failed_commits']} "
+            f"elapsed={stats['elapsed_s']}s rate={stats['captures_per_s']}/s")
+
+
+@app.cli.command('import-traces')
+@click.argument('paths', nargs=-1, required=True)
+@click.option('--workers', type=int, default=None, help='Parser processes (default: IMPORT_WORKERS or CPU count).')
+@click.option('--commit-size', type=int, default=None, help='Traces per write transaction.')
+def import_traces_command(paths, workers, commit_size):
+    """Импорт сохраненного вывода traceroute/tracert (файлы, каталоги, .zip/.tar.gz/.gz)."""
+    stats = import_captures(iter_capture_paths(paths), workers=workers, commit_size=commit_size,
+                            on_progress=lambda p: click.echo(_format_import_progress(p)))
+    click.echo('done: ' + _format_import_progress(stats))
+
+
+# ============================
+# СЕТЕВАЯ ИНФОРМАЦИЯ
+# ============================
+
+# Сколько секунд кэшируются интерфейсы и маршрут по умолчанию
+NETWORK_INFO_TTL = float(os.environ.get('NETWORK_INFO_TTL', '30'))
+# Внешний IP запрашивается редко: раз в EXTERNAL_IP_TTL секунд; пустой URL отключает запрос
+EXTERNAL_IP_URL = os.environ.get('EXTERNAL_IP_URL', 'https://ifconfig.me/ip')
+EXTERNAL_IP_TTL = float(os.environ.get('EXTERNAL_IP_TTL', '3600'))
+
+_SIOCGIFFLAGS = 0x8913
+_SIOCGIFADDR = 0x8915
+_SIOCGIFNETMASK = 0x891b
+_IFF_UP = 0x1
+_IFF_LOOPBACK = 0x8
+_IFF_RUNNING = 0x40
+
+
+def _ifreq(sock, ifname, request_code):
+    return fcntl.ioctl(sock.fileno(), request_code, struct.pack('256s', ifname.encode('utf-8')[:15]))
+
+
+def _read_ipv6_addresses(path='/proc/net/if_inet6'):
+    """{ifname: ['addr/prefix', ...]} из /proc/net/if_inet6."""
+    result = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) < 6:
+                    continue
+                addr = ipaddress.IPv6Address(bytes.fromhex(parts[0]))
+                result.setdefault(parts[5], []).append(f'{addr}/{int(parts[2], 16)}')
+    except OSError:
+        pass
+    return result
+
+
+def read_interfaces():
+    """Интерфейсы без запуска процессов: ioctl SIOCGIF* для IPv4 и флагов, /proc/net/if_inet6 для IPv6."""
+    ipv6 = _read_ipv6_addresses()
+    interfaces = []
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for index, name in socket.if_nameindex():
+            item = {'index': index, 'name': name, 'flags': [], 'mtu': None, 'mac': None,
+                    'ipv4': [], 'ipv6': ipv6.get(name, [])}
+            try:
+                flags = struct.unpack('H', _ifreq(sock, name, _SIOCGIFFLAGS)[16:18])[0]
+                item['flags'] = [label for bit, label in ((_IFF_UP, 'UP'), (_IFF_LOOPBACK, 'LOOPBACK'),
+                                                          (_IFF_RUNNING, 'RUNNING')) if flags & bit]
+            except OSError:
+                pass
+            try:
+                addr = socket.inet_ntoa(_ifreq(sock, name, _SIOCGIFADDR)[20:24])
+                mask = socket.inet_ntoa(_ifreq(sock, name, _SIOCGIFNETMASK)[20:24])
+                item['ipv4'].append(f'{addr}/{ipaddress.IPv4Network(f"0.0.0.0/{mask}").prefixlen}')
+            except OSError:
+                pass  # у интерфейса нет IPv4
+            for key, filename in (('mtu', 'mtu'), ('mac', 'address')):
+                try:
+                    with open(f'/sys/class/net/{name}/{filename}') as f:
+                        value = f.read().strip()
+                    item[key] = int(value) if key == 'mtu' else value
+                except (OSError, ValueError):
+                    pass
+            interfaces.append(item)
+    finally:
+        sock.close()
+    return interfaces
+
+
+def read_default_routes(route_path='/proc/net/route', ipv6_route_path='/proc/net/ipv6_route'):
+    """Маршруты по умолчанию из /proc/net/route и /proc/net/ipv6_route: ['default via GW dev IF', ...]."""
+    routes = []
+    try:
+        with open(route_path) as f:
+            next(f, None)
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 8 and parts[1] == '00000000' and parts[7] == '00000000':
+                    gateway = socket.inet_ntoa(struct.pack('<I', int(parts[2], 16)))
+                    metric = int(parts[6])
+                    routes.append(f'default via {gateway} dev {parts[0]}' + (f' metric {metric}' if metric else ''))
+    except OSError:
+        pass
+    try:
+        with open(ipv6_route_path) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 10 and parts[0] == '0' * 32 and parts[1] == '00' and parts[9] != 'lo':
+                    gateway = ipaddress.IPv6Address(bytes.fromhex(parts[4]))
+                    if not gateway.is_unspecified:
+                        routes.append(f'default via {gateway} dev {parts[9]}')
+    except OSError:
+        pass
+    return routes
+
+
+def format_interfaces(interfaces):
+    """Текст в духе `ip addr show` для поля ip_addresses."""
+    lines = []
+    for item in interfaces:
+        lines.append(f"{item['index']}: {item['name']}: <{','.join(item['flags'])}>"
+                     + (f" mtu {item['mtu']}" if item['mtu'] else ''))
+        if item['mac']:
+            lines.append(f"    link {item['mac']}")
+        lines.extend(f'    inet {addr}' for addr in item['ipv4'])
+        lines.extend(f'    inet6 {addr}' for addr in item['ipv6'])
+    return '\n'.join(lines)
+
+
+def _legacy_command_output(commands):
+    """Вывод первой успешной команды (Windows и системы без /proc)."""
+    for args in commands:
+        try:
+            res = subprocess.run(args, capture_output=True, text=True, timeout=5)
+            if res.returncode == 0 and res.stdout:
+                return res.stdout
+        except Exception:
+            continue
+    return ''
 
-#
 
+def _lookup_external_ip():
+    """Внешний IP через HTTP (без curl); None при ошибке или отключенном EXTERNAL_IP_URL."""
+    if not EXTERNAL_IP_URL:
+        return None
+    with urllib.request.urlopen(EXTERNAL_IP_URL, timeout=5) as resp:
+        value = resp.read(64).decode('ascii', 'replace').strip()
+    ipaddress.ip_address(value)
+    return value
 
-# ============================
-# ОС-СПЕЦИФИКА
-# ============================
 
-def is_windows():
-    return os.name == 'nt' or sys.platform.startswith('win')
+class NetworkInfoCache:
+    """Кэш сведений о сети с TTL.
 
-def is_linux():
-    return sys.platform.startswith('linux')
+    Ответы всегда отдаются из памяти: устаревшая запись возвращается как есть и
+    обновляется в фоне (не более одного обновления одновременно). Внешний IP
+    обновляется отдельно и редко, поэтому запрос страницы не ждет внешний сервис.
+    """
 
+    def __init__(self, ttl: float = NETWORK_INFO_TTL, external_ttl: float = EXTERNAL_IP_TTL):
+        self.ttl = ttl
+        self.external_ttl = external_ttl
+        self._lock = threading.Lock()
+        self._local = None
+        self._local_at = 0.0
+        self._external_ip = None
+        self._external_at = None
+        self._refreshing = set()
+        self._stop = threading.Event()
+        self._thread = None
 
-def build_command_args(user_command: str):
-    """Построение аргументов для OS-специфичных команд/флагов (поддерживаются только traceroute/tracert)."""
-    try:
-        tokens = user_command.strip().split()
-        if not tokens:
-            return []
-        cmd = tokens[0].lower()
-        args = tokens[1:]
-        if is_windows():
-            if cmd in ('traceroute', 'tracert'):
-                out = ['tracert']
-                if '-n' in args or '-d' in args:
-                    out.append('-d')
-                if '-m' in args:
-                    try:
-                        i = args.index('-m'); out.extend(['-h', args[i+1]])
-                    except Exception:
-                        pass
-                if '-w' in args:
-                    try:
-                        i = args.index('-w'); val = args[i+1]; ms = max(1, int(float(val) * 1000))
-                        out.extend(['-w', str(ms)])
-                    except Exception:
-                        pass
-                target = next((a for a in args if not a.startswith('-')), None)
-                if target:
-                    out.append(target)
-                return out
+    def refresh_local(self):
+        if is_linux() and fcntl is not None:
+            interfaces = read_interfaces()
+            routes = read_default_routes()
+            local = {
+                'interfaces': interfaces,
+                'ip_addresses': format_interfaces(interfaces) or 'Error getting IP info',
+                'default_route': '\n'.join(routes) or 'No default route'
+            }
         else:
-            if cmd in ('tracert', 'traceroute'):
-                out = ['traceroute']
-                if '-d' in args or '-n' in args:
-                    out.append('-n')
-                if '-h' in args or '-m' in args:
-                    try:
-                        if '-h' in args:
-                            i = args.index('-h'); out.extend(['-m', args[i+1]])
-                        else:
-                            i = args.index('-m'); out.extend(['-m', args[i+1]])
-                    except Exception:
-                        pass
-                if '-w' in args:
-                    try:
-                        i = args.index('-w'); ms = int(args[i+1]); s = max(1, int(round(ms / 1000.0)))
-                        out.extend(['-w', str(s)])
-                    except Exception:
-                        pass
-                target = next((a for a in args if not a.startswith('-')), None)
-                if target:
-                    out.append(target)
-                return out
-        return tokens
-    except Exception:
-        return user_command.strip().split()
+            local = {
+                'interfaces': [],
+                'ip_addresses': _legacy_command_output([['ipconfig', '/all']] if is_windows() else [['ifconfig']])
+                or 'Error getting IP info',
+                'default_route': _legacy_command_output([['route', 'print']] if is_windows() else [['netstat', '-rn']])
+                or 'No default route'
+            }
+        with self._lock:
+            self._local = local
+            self._local_at = time.monotonic()
+        return local
 
+    def refresh_external(self):
+        try:
+            value = _lookup_external_ip()
+        except Exception as e:
+            app.logger.info('external IP lookup failed: %s', e)
+            record_swallowed('external_ip')
+            value = None
+        with self._lock:
+            if value:
+                self._external_ip = value
+            self._external_at = time.monotonic()
+        return value
 
-def run_command(command):
-    """Безопасное выполнение системной команды (Windows/Linux)."""
-    try:
-        args = build_command_args(command)
-        if not args:
-            return "", "Empty command", 1
-        result = subprocess.run(
-            args,
-            capture_output=True,
-            text=True,
-            timeout=120
-        )
-        return result.stdout, result.stderr, result.returncode
-    except subprocess.TimeoutExpired:
-        return None, "Command timed out", -1
-    except Exception as e:
-        return None, str(e), -1
+    def _refresh_async(self, kind):
+        with self._lock:
+            if kind in self._refreshing:
+                return
+            self._refreshing.add(kind)
+
+        def run():
+            try:
+                (self.refresh_local if kind == 'local' else self.refresh_external)()
+            except Exception as e:
+                app.logger.warning('network info refresh failed: %s', e)
+                record_swallowed('network_info')
+            finally:
+                with self._lock:
+                    self._refreshing.discard(kind)
+        threading.Thread(target=run, name=f'netinfo-{kind}', daemon=True).start()
+
+    def get(self):
+        now = time.monotonic()
+        with self._lock:
+            local = self._local
+            local_stale = local is None or now - self._local_at > self.ttl
+            external_stale = self._external_at is None or now - self._external_at > self.external_ttl
+            external_ip = self._external_ip
+        if local is None:
+            # Первое обращение: локальные данные читаются быстро (без процессов и сети)
+            local = self.refresh_local()
+        elif local_stale:
+            self._refresh_async('local')
+        if external_stale and not self.running:
+            self._refresh_async('external')
+        return dict(local, external_ip=external_ip or 'Unknown')
+
+    def invalidate(self):
+        with self._lock:
+            self._local = None
+            self._external_ip = None
+            self._external_at = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Фоновое обновление: локальные данные каждые ttl, внешний IP каждые external_ttl."""
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name='netinfo', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self._thread = None
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh_local()
+                with self._lock:
+                    external_due = self._external_at is None or time.monotonic() - self._external_at > self.external_ttl
+                if external_due:
+                    self.refresh_external()
+            except Exception as e:
+                app.logger.warning('network info refresh failed: %s', e)
+                record_swallowed('network_info')
+            self._stop.wait(self.ttl)
+
+
+NETWORK_INFO = NetworkInfoCache()
+_STARTED_AT = time.monotonic()
 
 
 # ============================
-# ПАРСИНГ ВЫВОДА
+# FLASK ROUTES
 # ============================
 
-def parse_traceroute(output: str):
-    """Парсинг вывода traceroute/tracert для извлечения хопов (Linux/Windows)."""
-    hops = []
-
-    linux_patterns = [
-        re.compile(r'^\s*(\d+)\s+([\w\.-]+)\s+\(([\d\.]+)\)\s+([\d\.]+)\s+ms\s+([\d\.]+)\s+ms\s+([\d\.]+)\s+ms'),
-        re.compile(r'^\s*(\d+)\s+\*\s+\*\s+\*'),
-        re.compile(r'^\s*(\d+)\s+(\*|[\w\.-]+)\s+(\*|\([\d\.]+\)|[\w\.-]+\s+\([\d\.]+\))\s+([\d\.*]+)\s+ms\s+([\d\.*]+)\s+ms\s+([\d\.*]+)\s+ms'),
-        re.compile(r'^\s*(\d+)\s+([\w\.-]+)\s+\(([\d\.]+)\)\s+([\d\.]+)\s+ms'),
-        re.compile(r'^\s*(\d+)\s+([\d\.]+)\s+([\d\.]+)\s+ms'),
-    ]
+def conditional_json(db_path, build, params=None):
+    """Условный GET по версии данных базы: 304 на совпавший If-None-Match.
 
-    for raw_line in output.splitlines():
-        line = raw_line.strip()
-        if not line:
-            continue
-        # Заголовки Linux/Windows
-        if line.startswith('traceroute') or line.lower().startswith('tracing route to') or line.lower().startswith('over a maximum'):
-            continue
+    Пока база не менялась, версия проверяется одной PRAGMA data_version (см.
+    read_data_version). build() возвращает ответ view-функции; заголовки
+    ETag/Last-Modified ставятся на 200. Без версии в базе ответ всегда 200 без валидаторов.
+    params — разрешенные параметры запроса, от которых зависит тело помимо данных
+    (например, окно по умолчанию от текущего времени); их хэш входит в ETag.
+    """
+    etag, last_modified = get_data_version(db_path)
+    if etag is None:
+        return build()
+    if params is not None:
+        etag = f'{etag}-{zlib.crc32(repr(params).encode()):08x}'
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = app.make_response(build())
+        if response.status_code != 200:
+            return response
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
-        # Windows: таймаут строки
-        m_to = re.match(r'^\s*(\d+).*(Request timed out\.|Превышен.*ожидания|Время ожидания истекло)', raw_line, re.IGNORECASE)
-        if m_to:
-            hops.append({
-                'hop': m_to.group(1),
-                'hostname': '*',
-                'ip': 'Таймаут',
-                'rtt1': None,
-                'rtt2': None,
-                'rtt3': None
-            })
-            continue
 
-        # Windows: обычная строка с 3 значениями ms и узлом
-        m_win = re.match(r'^\s*(\d+)\s+([<\d\s]+)ms\s+([<\d\s]+)ms\s+([<\d\s]+)ms\s+(.+)$', raw_line)
-        if m_win:
-            hop_num = m_win.group(1)
-            def _ms_val(s: str):
-                m = re.search(r'(\d+)', s)
-                return m.group(1) if m else None
-            r1 = _ms_val(m_win.group(2))
-            r2 = _ms_val(m_win.group(3))
-            r3 = _ms_val(m_win.group(4))
-            host_part = m_win.group(5).strip()
-            ip = None
-            ip_br = re.search(r'\[([\d\.]+)\]', host_part)
-            if ip_br:
-                ip = ip_br.group(1)
-                hostname = host_part.split('[')[0].strip().rstrip('.')
-                hostname = hostname if hostname else '*'
-            else:
-                ip_m = re.search(r'(\d{1,3}(?:\.\d{1,3}){3})(?!.*\d)', host_part)
-                ip = ip_m.group(1) if ip_m else None
-                if ip and host_part.strip() == ip:
-                    hostname = '*'
-                else:
-                    hostname = host_part.strip()
-            hops.append({
-                'hop': hop_num,
-                'hostname': hostname or '*',
-                'ip': ip or 'N/A',
-                'rtt1': r1,
-                'rtt2': r2,
-                'rtt3': r3
-            })
-            continue
+@app.before_request
+def _trace_request_started():
+    g.trace = _trace_local.trace = RequestTrace()
+    mode = request.headers.get('X-Debug-Profile')
+    if mode and profiling_allowed(request.headers):
+        g.profile = PROFILER.start(mode.strip().lower())
 
-        # Linux: полный таймаут "N  * * *"
-        timeout_only = re.match(r'^\s*(\d+)\s+\*\s+\*\s+\*', line)
-        if timeout_only:
-            hops.append({
-                'hop': timeout_only.group(1),
-                'hostname': '*',
-                'ip': 'Таймаут',
-                'rtt1': None,
-                'rtt2': None,
-                'rtt3': None
-            })
-            continue
 
-        matched = False
-        for pattern in linux_patterns:
-            match = pattern.match(line)
-            if match:
-                matched = True
-                groups = match.groups()
-                hop_num = groups[0]
-                if len(groups) >= 3:
-                    if groups[1] == '*' and (len(groups) < 3 or groups[2] == '*'):
-                        hops.append({
-                            'hop': hop_num,
-                            'hostname': '*',
-                            'ip': 'Таймаут',
-                            'rtt1': None,
-                            'rtt2': None,
-                            'rtt3': None
-                        })
-                    else:
-                        hostname = groups[1] if groups[1] != '*' else '*'
-                        # IP
-                        ip = ''
-                        if len(groups) > 2:
-                            if groups[2].startswith('(') and groups[2].endswith(')'):
-                                ip = groups[2][1:-1]
-                            elif '.' in groups[2] and groups[2] != '*':
-                                ip = groups[2]
-                            else:
-                                ip = 'N/A'
-                        # RTT
-                        rtt_values = []
-                        for i in range(3, min(7, len(groups))):
-                            if i < len(groups) and groups[i] and groups[i] != '*':
-                                rtt_values.append(groups[i])
-                        if not rtt_values and ip and ip != 'N/A':
-                            rtt_values = [None, None, None]
-                        hops.append({
-                            'hop': hop_num,
-                            'hostname': hostname,
-                            'ip': ip,
-                            'rtt1': rtt_values[0] if len(rtt_values) > 0 else None,
-                            'rtt2': rtt_values[1] if len(rtt_values) > 1 else None,
-                            'rtt3': rtt_values[2] if len(rtt_values) > 2 else None
-                        })
-                break
-        if matched:
-            continue
+@app.after_request
+def _trace_request_finished(response):
+    # Для потоковых ответов учитывается время до начала отдачи тела
+    trace = g.get('trace')
+    if trace is None:
+        return response
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile_id, _ = PROFILER.finish(profile)
+        response.headers['X-Debug-Profile-Id'] = profile_id
+    total = time.perf_counter() - trace.started
+    # Шаблон маршрута, а не путь: у /api/history/<id> одна серия, у несуществующих путей — 'unmatched'
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    HTTP_LATENCY.observe(total, request.method, route)
+    HTTP_REQUESTS.inc(request.method, route, str(response.status_code))
+    response.headers['Server-Timing'] = trace.server_timing(total)
+    SLOW_REQUESTS.add(total, {
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'route': route,
+        'status': response.status_code,
+        'duration_ms': round(total * 1000, 3),
+        'spans': {name: {'ms': round(seconds * 1000, 3), 'count': count}
+                  for name, (seconds, count) in trace.spans.items()},
+        'timestamp': datetime.now().isoformat()
+    })
+    return response
 
-        # Универсальный fallback (например traceroute -n)
-        try:
-            m = re.match(r'^\s*(\d+)\s+(.*)$', line)
-            if m:
-                hop_num = m.group(1)
-                rest = m.group(2)
-                if '*' in rest:
-                    hops.append({
-                        'hop': hop_num,
-                        'hostname': '*',
-                        'ip': 'Таймаут',
-                        'rtt1': None,
-                        'rtt2': None,
-                        'rtt3': None
-                    })
-                else:
-                    ip_match = re.search(r'(\d{1,3}(?:\.\d{1,3}){3})', rest)
-                    ip = ip_match.group(1) if ip_match else 'N/A'
-                    rtts = re.findall(r'([\d\.]+)\s*ms', rest)
-                    hops.append({
-                        'hop': hop_num,
-                        'hostname': ip if ip != 'N/A' else '*',
-                        'ip': ip,
-                        'rtt1': rtts[0] if len(rtts) > 0 else None,
-                        'rtt2': rtts[1] if len(rtts) > 1 else None,
-                        'rtt3': rtts[2] if len(rtts) > 2 else None
-                    })
-        except Exception:
-            pass
 
-    return hops
+@app.teardown_request
+def _trace_request_teardown(error=None):
+    _trace_local.trace = None
+    # after_request не вызывается при необработанном исключении — профиль все равно закрываем
+    profile = g.pop('profile', None)
+    if profile is not None:
+        PROFILER.finish(profile)
 
 
+def _collect_cache_metrics():
+    """Попадания и промахи кэшей процесса (снимаются при выдаче /metrics)."""
+    caches = {
+        'paths_aggregate': (PATHS_CACHE.hits, PATHS_CACHE.misses),
+        'paths_layout': (PATHS_LAYOUT.hits, PATHS_LAYOUT.misses),
+        'trace_results': tuple(TRACE_RESULTS.stats()[k] for k in ('hits', 'misses')),
+        'reverse_dns': tuple(RDNS.cache.stats()[k] for k in ('hits', 'misses')),
+    }
+    return [
+        ('cache_hits_total', 'counter', 'Cache lookups answered from memory.',
+         [({'cache': name}, hits) for name, (hits, _) in caches.items()]),
+        ('cache_misses_total', 'counter', 'Cache lookups that went to the source.',
+         [({'cache': name}, misses) for name, (_, misses) in caches.items()]),
+        ('cache_hit_ratio', 'gauge', 'Hits / (hits + misses) since start or the last clear.',
+         [({'cache': name}, hits / (hits + misses) if hits + misses else 0.0) for name, (hits, misses) in caches.items()]),
+        ('trace_coalesced_total', 'counter', 'Traces that waited for an identical in-flight trace.',
+         [({}, TRACE_FLIGHTS.coalesced)]),
+    ]
 
 
-# ============================
-# FLASK ROUTES
-# ============================
+METRICS.register_collector(_collect_cache_metrics)
 
 @app.route('/')
 def index():
@@ -766,21 +4682,20 @@ def api_run_command():
         if not is_allowed:
             return jsonify({'error': 'Command not allowed', 'allowed_commands': allowed_commands}), 403
 
-        stdout, stderr, returncode = run_command(user_command)
-
         parsed_data = None
         command_type = None
 
         if user_command.startswith(('traceroute', 'tracert')):
             command_type = 'traceroute'
-            if stdout:
-                parsed_data = parse_traceroute(stdout)
-                if parsed_data:
-                    save_request_to_db(user_command, parsed_data)
-        elif user_command.startswith(('dig', 'nslookup', 'whois')):
-            command_type = 'dns'
-            if stdout:
-                parsed_data = {'raw_output': stdout[:1000] + '...' if len(stdout) > 1000 else stdout}
+            stdout, stderr, returncode, parsed_data, fresh = run_traceroute(user_command)
+            if parsed_data and fresh:
+                save_request_to_db(user_command, parsed_data)
+        else:
+            stdout, stderr, returncode = run_command(user_command)
+            if user_command.startswith(('dig', 'nslookup', 'whois')):
+                command_type = 'dns'
+                if stdout:
+                    parsed_data = {'raw_output': stdout[:1000] + '...' if len(stdout) > 1000 else stdout}
         
         response = {
             'command': user_command,
@@ -795,15 +4710,70 @@ def api_run_command():
     except Exception as e:
         return jsonify({'error': f'Internal server error: {str(e)}'}), 500
 
+def _sse_event(event: str, payload) -> str:
+    """Форматирует одно событие Server-Sent Events."""
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+@app.route('/api/run_command/stream', methods=['GET'])
+def api_run_command_stream():
+    """Потоковая трассировка: каждый хоп отправляется клиенту как SSE-событие.
+
+    События: line (сырая строка), hop (распарсенный хоп), hostname (PTR-имя хопа,
+    разрешенное после его отправки), done (итог), error.
+    Опции нормализуются так же, как в /api/run_command (см. stream_traceroute), и
+    итоговый список хопов сохраняется в историю, если трассировка выполнена этим
+    запросом, а не взята из кэша (shared в событии done).
+    """
+    user_command = (request.args.get('command') or '').strip()
+    if not user_command:
+        return jsonify({'error': 'No command provided'}), 400
+    if len(user_command) > 1024:
+        return jsonify({'error': 'Command too long'}), 400
+    allowed_commands = ['tracert'] if is_windows() else ['traceroute']
+    if not any(user_command.startswith(cmd) for cmd in allowed_commands):
+        return jsonify({'error': 'Command not allowed', 'allowed_commands': allowed_commands}), 403
+
+    def generate():
+        try:
+            for kind, value in stream_traceroute(user_command):
+                if kind == 'line':
+                    yield _sse_event('line', {'text': value})
+                elif kind in ('hop', 'hostname'):
+                    yield _sse_event(kind, value)
+                else:
+                    stdout, stderr, returncode, hops, fresh = value
+                    saved = bool(hops) and fresh and save_request_to_db(user_command, hops)
+                    yield _sse_event('done', {
+                        'command': user_command,
+                        'command_type': 'traceroute',
+                        'raw_stdout': stdout,
+                        'raw_stderr': stderr,
+                        'returncode': returncode,
+                        'hops_count': len(hops or []),
+                        'saved': saved,
+                        'shared': not fresh
+                    })
+        except Exception as e:
+            yield _sse_event('error', {'error': f'Internal server error: {str(e)}'})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @app.route('/api/batch_traceroute', methods=['POST'])
 def api_batch_traceroute():
-    """Выполняет traceroute для списка целей последовательно и сохраняет результаты в историю.
+    """Выполняет traceroute для списка целей параллельно и сохраняет результаты в историю.
     Формат запроса:
     {
       "targets": ["8.8.8.8", "1.1.1.1"],
-      "options": { "numeric": true, "max_hops": 30, "wait_ms": 3000 }
+      "options": { "numeric": true, "max_hops": 30, "wait_ms": 3000,
+                   "concurrency": 8, "deadline_s": 120 }
     }
     Также поддерживает ключ "ips" как синоним "targets".
+    С параметром ?async=1 возвращает 202 и id фонового задания (см. /api/jobs/<id>).
+    concurrency ограничен BATCH_MAX_WORKERS, deadline_s — BATCH_DEADLINE.
     """
     try:
         data = request.get_json() or {}
@@ -823,85 +4793,302 @@ def api_batch_traceroute():
             return jsonify({'error': 'Too many targets (max 50)'}), 400
 
         options = data.get('options') or {}
-        numeric = bool(options.get('numeric'))
-        max_hops = options.get('max_hops')
-        wait_ms = options.get('wait_ms')
-
-        results = []
-        for target in targets:
-            parts = ['traceroute']
-            if numeric:
-                parts.append('-n')
-            if isinstance(max_hops, int) and max_hops > 0:
-                parts.extend(['-m', str(max_hops)])
-            if isinstance(wait_ms, int) and wait_ms > 0:
-                parts.extend(['-w', str(wait_ms)])
-            parts.append(target)
-            user_command = ' '.join(parts)
+        concurrency = options.get('concurrency')
+        if not (isinstance(concurrency, int) and concurrency > 0):
+            concurrency = None
+        deadline = options.get('deadline_s')
+        if not (isinstance(deadline, (int, float)) and deadline > 0):
+            deadline = None
 
-            stdout, stderr, returncode = run_command(user_command)
+        jobs = [(target, build_batch_command(target, options)) for target in targets]
 
-            parsed = None
-            if stdout:
-                parsed = parse_traceroute(stdout)
-                if parsed:
-                    # Сохраняем в основную историю
-                    save_request_to_db(user_command, parsed)
-                    # Обновляем агрегированное дерево путей (без сохранения per-request в PATHS DB)
-                    try:
-                        update_paths_aggregate(user_command, parsed)
-                    except Exception:
-                        pass
+        # Асинхронный режим: сразу возвращаем id задания
+        if request.args.get('async') in ('1', 'true', 'yes'):
+            job = submit_batch_job(jobs, max_workers=concurrency, deadline=deadline)
+            if job is None:
+                return jsonify({'error': 'Too many active jobs'}), 429
+            return jsonify({
+                'job_id': job.id,
+                'status': job.status,
+                'total': len(jobs),
+                'status_url': f'/api/jobs/{job.id}',
+                'results_url': f'/api/jobs/{job.id}/results'
+            }), 202
 
-            results.append({
-                'target': target,
-                'command': user_command,
-                'raw_stdout': stdout,
-                'raw_stderr': stderr,
-                'returncode': returncode,
-                'hops': parsed
-            })
+        started = time.monotonic()
+        results, timed_out = run_batch_traceroute(jobs, max_workers=concurrency, deadline=deadline)
 
-        return jsonify({'count': len(results), 'results': results})
+        return jsonify({
+            'count': len(results),
+            'completed': sum(1 for r in results if r['status'] == 'done'),
+            'timed_out': timed_out,
+            'elapsed_ms': int((time.monotonic() - started) * 1000),
+            'results': results
+        })
     except Exception as e:
         return jsonify({'error': f'Internal server error: {str(e)}'}), 500
 
+@app.route('/api/jobs', methods=['GET'])
+def api_jobs():
+    """Список фоновых пакетных заданий."""
+    try:
+        with JOBS_LOCK:
+            jobs = list(JOBS.values())
+        items = []
+        for job in jobs:
+            snap = job.snapshot()
+            snap.pop('targets', None)
+            items.append(snap)
+        return jsonify({'jobs': items})
+    except Exception as e:
+        return jsonify({'error': f'Error listing jobs: {str(e)}'}), 500
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def api_job_status(job_id):
+    """Статус фонового задания и краткая сводка по завершенным целям."""
+    job = get_batch_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.snapshot())
+
+@app.route('/api/jobs/<job_id>/results', methods=['GET'])
+def api_job_results(job_id):
+    """Потоковая выдача результатов задания в NDJSON: одна строка на цель по мере завершения."""
+    job = get_batch_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+
+    def generate():
+        for item in job.iter_results():
+            yield json.dumps(item, ensure_ascii=False) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def api_job_cancel(job_id):
+    """Отмена задания: цели из очереди не запускаются, выполняющиеся дорабатывают."""
+    job = get_batch_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    job.cancel()
+    return jsonify({'message': 'Job cancellation requested', 'job_id': job.id, 'status': job.status})
+
+@app.route('/api/monitor', methods=['GET'])
+def api_monitor_list():
+    """Состояние планировщика и список целей мониторинга."""
+    return jsonify({'running': MONITOR.running, 'targets': MONITOR.list()})
+
+@app.route('/api/monitor/targets', methods=['POST'])
+def api_monitor_add():
+    """Добавление (или обновление) цели мониторинга.
+    Формат: { "target": "8.8.8.8", "interval_s": 60, "options": { "numeric": true } }
+    """
+    try:
+        data = request.get_json() or {}
+        target = str(data.get('target') or '').strip()
+        if not target:
+            return jsonify({'error': 'No target provided'}), 400
+        if target.startswith('-') or any(c.isspace() for c in target):
+            return jsonify({'error': 'Invalid target'}), 400
+        interval = data.get('interval_s', 60)
+        if not isinstance(interval, (int, float)) or interval <= 0:
+            return jsonify({'error': 'interval_s must be a positive number'}), 400
+        options = data.get('options') or {}
+        if not isinstance(options, dict):
+            return jsonify({'error': 'options must be an object'}), 400
+        item = MONITOR.add(target, float(interval), options)
+        return jsonify(item.to_dict()), 201
+    except Exception as e:
+        return jsonify({'error': f'Error adding monitor target: {str(e)}'}), 500
+
+@app.route('/api/monitor/targets/<path:target>', methods=['DELETE'])
+def api_monitor_remove(target):
+    """Удаление цели мониторинга."""
+    if not MONITOR.remove(target):
+        return jsonify({'error': 'Target not found'}), 404
+    return jsonify({'message': 'Target removed', 'target': target})
+
+@app.route('/api/monitor/start', methods=['POST'])
+def api_monitor_start():
+    MONITOR.start()
+    return jsonify({'running': MONITOR.running})
+
+@app.route('/api/monitor/stop', methods=['POST'])
+def api_monitor_stop():
+    MONITOR.stop()
+    return jsonify({'running': MONITOR.running})
+
 @app.route('/api/history', methods=['GET'])
 def api_history():
-    """API для получения истории запросов."""
+    """API для получения истории запросов.
+
+    Query: target, since, until, min_hops, max_hops, limit, cursor (next_cursor предыдущей страницы).
+    """
     try:
-        history = get_request_history()
-        return jsonify({'history': history})
-    except Exception as e:
-        return jsonify({'error': f'Error getting history: {str(e)}'}), 500
+        filters, cursor, limit = parse_history_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': f'Invalid query: {str(e)}'}), 400
+
+    def build():
+        try:
+            history, next_cursor = get_request_history_page(filters, cursor, limit)
+            return jsonify({'history': history, 'next_cursor': next_cursor})
+        except Exception as e:
+            return jsonify({'error': f'Error getting history: {str(e)}'}), 500
+    return conditional_json(HISTORY_DB, build)
 
 @app.route('/api/history/<int:request_id>', methods=['GET'])
 def api_history_details(request_id):
     """API для получения деталей конкретного запроса."""
+    def build():
+        try:
+            details = get_request_details(request_id)
+            if not details:
+                return jsonify({'error': 'Request not found'}), 404
+            return jsonify(details)
+        except Exception as e:
+            return jsonify({'error': f'Error getting request details: {str(e)}'}), 500
+    return conditional_json(HISTORY_DB, build)
+
+@app.route('/api/hops/prefix', methods=['GET'])
+def api_hops_by_prefix():
+    """Хопы с IP внутри префикса: ?prefix=2001:db8::/32&source=history|paths&limit=N."""
+    prefix = (request.args.get('prefix') or '').strip()
+    source = request.args.get('source', 'history')
+    if source not in ('history', 'paths'):
+        return jsonify({'error': 'source must be history or paths'}), 400
     try:
-        details = get_request_details(request_id)
-        if not details:
-            return jsonify({'error': 'Request not found'}), 404
-        return jsonify(details)
-    except Exception as e:
-        return jsonify({'error': f'Error getting request details: {str(e)}'}), 500
+        ip_prefix_range(prefix)
+    except ValueError:
+        return jsonify({'error': 'Invalid prefix'}), 400
+    try:
+        limit = max(1, min(int(request.args.get('limit', 500)), 5000))
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+
+    def build():
+        try:
+            if source == 'paths':
+                return jsonify({'prefix': prefix, 'source': source, 'ips': find_path_ips_by_prefix(prefix, limit)})
+            return jsonify({'prefix': prefix, 'source': source, 'hops': find_hops_by_prefix(prefix, limit)})
+        except Exception as e:
+            return jsonify({'error': f'Error querying prefix: {str(e)}'}), 500
+    return conditional_json(PATHS_DB if source == 'paths' else HISTORY_DB, build)
+
+@app.route('/api/rtt_series', methods=['GET'])
+def api_rtt_series():
+    """Ряды RTT по цели из агрегатов: ?target=&since=&until=&resolution=1m|1h|1d&hop=&ip=.
+
+    По умолчанию — последние сутки; без resolution разрешение выбирается по длине интервала.
+    """
+    target = (request.args.get('target') or '').strip()
+    if not target:
+        return jsonify({'error': 'target is required'}), 400
+    try:
+        until = _epoch_param(request.args['until']) if request.args.get('until') else int(time.time())
+        since = _epoch_param(request.args['since']) if request.args.get('since') else until - 86400
+        name = request.args.get('resolution')
+        if name and name not in RTT_RESOLUTIONS:
+            raise ValueError(f"resolution must be one of {', '.join(RTT_RESOLUTIONS)}")
+        resolution = RTT_RESOLUTIONS[name] if name else _auto_resolution(since, until)
+        hop_number = int(request.args['hop']) if request.args.get('hop') else None
+    except ValueError as e:
+        return jsonify({'error': f'Invalid query: {str(e)}'}), 400
+    ip = request.args.get('ip') or None
+
+    def build():
+        try:
+            series = get_rtt_series(target, since, until, resolution, hop_number, ip)
+            return jsonify({'target': target, 'since': since, 'until': until,
+                            'resolution': resolution, 'series': series})
+        except Exception as e:
+            return jsonify({'error': f'Error getting RTT series: {str(e)}'}), 500
+    # Окно по умолчанию отсчитывается от текущего времени: ETag зависит и от него
+    return conditional_json(HISTORY_DB, build, (target, since, until, resolution, hop_number, ip))
+
+@app.route('/api/retention', methods=['GET'])
+def api_retention():
+    """Правила хранения и итоги последнего прохода."""
+    return jsonify(RETENTION.status())
+
+@app.route('/api/retention/run', methods=['POST'])
+def api_retention_run():
+    """Внеочередной проход ретеншна (по умолчанию — с настроенными правилами)."""
+    data = request.get_json(silent=True) or {}
+    policies = data.get('policies')
+    if policies is not None:
+        try:
+            validate_retention_policies(policies)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    record = RETENTION.run_once(policies)
+    if record.get('error'):
+        return jsonify({'error': f"Retention failed: {record['error']}"}), 500
+    return jsonify(record)
+
+@app.route('/api/export/<kind>', methods=['GET'])
+def api_export(kind):
+    """Потоковая выгрузка history|paths|rollups: ?format=ndjson|csv&target=&since=&until=.
+
+    Ответ отдается по мере чтения курсора, память процесса не зависит от объема выгрузки.
+    """
+    fmt = request.args.get('format', 'ndjson')
+    try:
+        if kind not in _EXPORT_ITERATORS:
+            raise ValueError(f"kind must be one of {', '.join(_EXPORT_ITERATORS)}")
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"format must be one of {', '.join(EXPORT_FORMATS)}")
+        filters = parse_export_filters(kind, request.args)
+    except ValueError as e:
+        return jsonify({'error': f'Invalid query: {str(e)}'}), 400
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    filename = f"{kind}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{fmt}"
+    return Response(
+        stream_with_context(generate_export(kind, fmt, filters)),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename="{filename}"', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/import', methods=['POST'])
+def api_import():
+    """Загрузка файлов трассировок (multipart, поле file, можно несколько; архивы распаковываются).
+
+    Ответ — NDJSON со снимками прогресса по мере коммитов; последняя строка — итог (done=true).
+    """
+    uploads = [f for f in request.files.getlist('file') if f.filename]
+    if not uploads:
+        return jsonify({'error': 'No files uploaded (multipart field "file")'}), 400
+    try:
+        workers = int(request.args['workers']) if request.args.get('workers') else None
+    except ValueError as e:
+        return jsonify({'error': f'Invalid query: {str(e)}'}), 400
+    now = time.time()
+
+    def files():
+        for upload in uploads:
+            yield from iter_capture_files(upload.filename, upload.stream, now)
+
+    def generate():
+        try:
+            for progress in iter_import_progress(files(), workers=workers):
+                yield json.dumps(progress) + '\n'
+        except Exception as e:
+            yield json.dumps({'done': True, 'error': f'Import failed: {str(e)}'}) + '\n'
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'X-Accel-Buffering': 'no'})
 
 @app.route('/api/history/<int:request_id>', methods=['DELETE'])
 def api_history_delete(request_id):
     """Удаление одной записи истории по ID (включая ее хопы)."""
     try:
-        conn = sqlite3.connect(HISTORY_DB)
-        cursor = conn.cursor()
-        cursor.execute('PRAGMA foreign_keys = ON;')
-        cursor.execute('SELECT 1 FROM requests WHERE id = ?', (request_id,))
-        exists = cursor.fetchone() is not None
+        with write_transaction(HISTORY_DB) as cursor:
+            cursor.execute('SELECT 1 FROM requests WHERE id = ?', (request_id,))
+            exists = cursor.fetchone() is not None
+            if exists:
+                cursor.execute('DELETE FROM hops WHERE request_id = ?', (request_id,))
+                cursor.execute('DELETE FROM requests WHERE id = ?', (request_id,))
         if not exists:
-            conn.close()
             return jsonify({'error': 'Request not found'}), 404
-        cursor.execute('DELETE FROM hops WHERE request_id = ?', (request_id,))
-        cursor.execute('DELETE FROM requests WHERE id = ?', (request_id,))
-        conn.commit()
-        conn.close()
         return jsonify({'message': 'Request deleted successfully', 'id': request_id})
     except Exception as e:
         return jsonify({'error': f'Error deleting request: {str(e)}'}), 500
@@ -923,23 +5110,20 @@ def api_paths_run_command():
             allowed_commands = ['traceroute', 'dig', 'nslookup', 'whois']
         if not any(user_command.startswith(cmd) for cmd in allowed_commands):
             return jsonify({'error': 'Command not allowed', 'allowed_commands': allowed_commands}), 403
-        stdout, stderr, returncode = run_command(user_command)
         parsed_data = None
         command_type = None
         if user_command.startswith(('traceroute', 'tracert')):
             command_type = 'traceroute'
-            if stdout:
-                parsed_data = parse_traceroute(stdout)
-                if parsed_data:
-                    save_path_request_to_db(user_command, parsed_data)
-                    try:
-                        update_paths_aggregate(user_command, parsed_data)
-                    except Exception:
-                        pass
-        elif user_command.startswith(('dig', 'nslookup', 'whois')):
-            command_type = 'dns'
-            if stdout:
-                parsed_data = {'raw_output': stdout[:1000] + '...' if len(stdout) > 1000 else stdout}
+            stdout, stderr, returncode, parsed_data, fresh = run_traceroute(user_command)
+            if parsed_data and fresh:
+                # История путей и агрегат — одна транзакция в paths_tree.db
+                store_traces([normalize_trace(user_command, parsed_data)], history=False, path_history=True)
+        else:
+            stdout, stderr, returncode = run_command(user_command)
+            if user_command.startswith(('dig', 'nslookup', 'whois')):
+                command_type = 'dns'
+                if stdout:
+                    parsed_data = {'raw_output': stdout[:1000] + '...' if len(stdout) > 1000 else stdout}
         return jsonify({
             'command': user_command,
             'command_type': command_type,
@@ -954,35 +5138,41 @@ def api_paths_run_command():
 @app.route('/api/paths_history', methods=['GET'])
 def api_paths_history():
     try:
-        return jsonify({'history': get_path_request_history()})
-    except Exception as e:
-        return jsonify({'error': f'Error getting paths history: {str(e)}'}), 500
+        filters, cursor, limit = parse_history_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': f'Invalid query: {str(e)}'}), 400
+
+    def build():
+        try:
+            history, next_cursor = get_path_request_history_page(filters, cursor, limit)
+            return jsonify({'history': history, 'next_cursor': next_cursor})
+        except Exception as e:
+            return jsonify({'error': f'Error getting paths history: {str(e)}'}), 500
+    return conditional_json(PATHS_DB, build)
 
 @app.route('/api/paths_history/<int:request_id>', methods=['GET'])
 def api_paths_history_details(request_id):
-    try:
-        details = get_path_request_details(request_id)
-        if not details:
-            return jsonify({'error': 'Request not found'}), 404
-        return jsonify(details)
-    except Exception as e:
-        return jsonify({'error': f'Error getting request details: {str(e)}'}), 500
+    def build():
+        try:
+            details = get_path_request_details(request_id)
+            if not details:
+                return jsonify({'error': 'Request not found'}), 404
+            return jsonify(details)
+        except Exception as e:
+            return jsonify({'error': f'Error getting request details: {str(e)}'}), 500
+    return conditional_json(PATHS_DB, build)
 
 @app.route('/api/paths_history/<int:request_id>', methods=['DELETE'])
 def api_paths_history_delete(request_id):
     try:
-        conn = sqlite3.connect(PATHS_DB)
-        cursor = conn.cursor()
-        cursor.execute('PRAGMA foreign_keys = ON;')
-        cursor.execute('SELECT 1 FROM path_requests WHERE id = ?', (request_id,))
-        exists = cursor.fetchone() is not None
+        with write_transaction(PATHS_DB) as cursor:
+            cursor.execute('SELECT 1 FROM path_requests WHERE id = ?', (request_id,))
+            exists = cursor.fetchone() is not None
+            if exists:
+                cursor.execute('DELETE FROM path_hops WHERE request_id = ?', (request_id,))
+                cursor.execute('DELETE FROM path_requests WHERE id = ?', (request_id,))
         if not exists:
-            conn.close()
             return jsonify({'error': 'Request not found'}), 404
-        cursor.execute('DELETE FROM path_hops WHERE request_id = ?', (request_id,))
-        cursor.execute('DELETE FROM path_requests WHERE id = ?', (request_id,))
-        conn.commit()
-        conn.close()
         return jsonify({'message': 'Request deleted successfully', 'id': request_id})
     except Exception as e:
         return jsonify({'error': f'Error deleting request: {str(e)}'}), 500
@@ -990,97 +5180,119 @@ def api_paths_history_delete(request_id):
 @app.route('/api/paths', methods=['GET'])
 def api_paths():
     """API для получения всех путей для построения дерева."""
+    def build():
+        try:
+            paths = get_all_paths()
+            return jsonify({'paths': paths})
+        except Exception as e:
+            return jsonify({'error': f'Error getting paths: {str(e)}'}), 500
+    return conditional_json(PATHS_DB, build)
+
+
+@app.route('/api/paths/layout', methods=['GET'])
+def api_paths_layout():
+    """Готовая к отрисовке раскладка дерева путей: ?x_gap=&y_gap=&group_gap= (пиксели)."""
     try:
-        paths = get_all_paths()
-        return jsonify({'paths': paths})
-    except Exception as e:
-        return jsonify({'error': f'Error getting paths: {str(e)}'}), 500
+        params = parse_layout_params(request.args)
+    except ValueError as e:
+        return jsonify({'error': f'Invalid query: {str(e)}'}), 400
 
+    def build():
+        try:
+            return jsonify(get_paths_layout(params))
+        except Exception as e:
+            return jsonify({'error': f'Error getting paths layout: {str(e)}'}), 500
+    return conditional_json(PATHS_DB, build)
 
 
+@app.route('/api/topology', methods=['GET'])
+def api_topology():
+    """Граф связей между IP: ?target=a,b&node=ip&depth=1&min_degree=&min_count=&limit=.
 
-@app.route('/api/network_info', methods=['GET'])
-def api_network_info():
-    """API для получения информации о сетевых интерфейсах (Windows/Linux, с fallback)."""
+    Без параметров — весь граф (с ограничением limit ребер по весу).
+    """
     try:
-        # IP info
-        ip_info = ''
-        try:
-            res = subprocess.run(['ip', 'addr', 'show'], capture_output=True, text=True)
-            if res.returncode == 0:
-                ip_info = res.stdout
-        except Exception:
-            pass
-        if not ip_info and is_windows():  # Windows fallback
-            try:
-                res = subprocess.run(['ipconfig', '/all'], capture_output=True, text=True)
-                if res.returncode == 0:
-                    ip_info = res.stdout
-            except Exception:
-                pass
-        if not ip_info:
-            ip_info = 'Error getting IP info'
+        targets = [t.strip() for t in request.args.get('target', '').split(',') if t.strip()] or None
+        node = (request.args.get('node') or '').strip() or None
+        depth = int(request.args.get('depth', 1))
+        if not 0 <= depth <= TOPOLOGY_MAX_DEPTH:
+            raise ValueError(f'depth must be between 0 and {TOPOLOGY_MAX_DEPTH}')
+        min_degree = int(request.args.get('min_degree', 0))
+        min_count = int(request.args.get('min_count', 1))
+        limit = int(request.args.get('limit', TOPOLOGY_DEFAULT_LIMIT))
+        if not 1 <= limit <= TOPOLOGY_MAX_LIMIT:
+            raise ValueError(f'limit must be between 1 and {TOPOLOGY_MAX_LIMIT}')
+    except ValueError as e:
+        return jsonify({'error': f'Invalid query: {str(e)}'}), 400
 
-        # Default route
-        default_route = ''
+    def build():
         try:
-            res = subprocess.run(['ip', 'route', 'show', 'default'], capture_output=True, text=True)
-            if res.returncode == 0:
-                default_route = res.stdout
-        except Exception:
-            pass
-        if not default_route and is_windows():
-            try:
-                res = subprocess.run(['route', 'print'], capture_output=True, text=True)
-                if res.returncode == 0:
-                    default_route = res.stdout
-            except Exception:
-                pass
-        if not default_route:
-            default_route = 'No default route'
+            graph = TOPOLOGY.query(os.path.abspath(PATHS_DB), targets=targets, node=node, depth=depth,
+                                   min_degree=min_degree, min_count=min_count, limit=limit)
+            return jsonify(graph)
+        except Exception as e:
+            return jsonify({'error': f'Error getting topology: {str(e)}'}), 500
+    return conditional_json(PATHS_DB, build)
 
-        # External IP
-        external_ip = 'Unknown'
-        try:
-            res = subprocess.run(['curl', '-s', 'ifconfig.me'], capture_output=True, text=True, timeout=5)
-            if res.returncode == 0 and res.stdout.strip():
-                external_ip = res.stdout.strip()
-        except Exception:
-            pass
-        if external_ip == 'Unknown' and is_windows():
-            try:
-                res = subprocess.run(['powershell', '-Command', '(Invoke-WebRequest -UseBasicParsing ifconfig.me).Content'], capture_output=True, text=True, timeout=8)
-                if res.returncode == 0 and res.stdout.strip():
-                    external_ip = res.stdout.strip()
-            except Exception:
-                pass
 
+@app.route('/api/network_info', methods=['GET'])
+def api_network_info():
+    """API для получения информации о сетевых интерфейсах (из кэша, без запуска процессов на Linux)."""
+    try:
+        info = NETWORK_INFO.get()
         try:
             hostname = os.uname().nodename
         except Exception:
             hostname = platform.node()
 
         return jsonify({
-            'ip_addresses': ip_info,
-            'default_route': default_route,
-            'external_ip': external_ip,
+            'ip_addresses': info['ip_addresses'],
+            'interfaces': info['interfaces'],
+            'default_route': info['default_route'],
+            'external_ip': info['external_ip'],
             'hostname': hostname,
             'timestamp': datetime.now().isoformat()
         })
     except Exception as e:
         return jsonify({'error': f'Error getting network info: {str(e)}'}), 500
 
+@app.route('/api/health', methods=['GET'])
+def api_health():
+    """Проверка доступности сервера для опроса статуса: без обращений к БД, сети и процессам."""
+    return jsonify({
+        'status': 'ok',
+        'uptime_s': round(time.monotonic() - _STARTED_AT, 1),
+        'timestamp': datetime.now().isoformat()
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Метрики процесса в текстовом формате Prometheus."""
+    return Response(METRICS.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/debug/slow', methods=['GET'])
+def api_debug_slow():
+    """Самые медленные запросы с разбивкой по этапам (по убыванию длительности)."""
+    return jsonify({'size': SLOW_REQUESTS.size, 'requests': SLOW_REQUESTS.snapshot()})
+
+@app.route('/api/debug/profile/<profile_id>', methods=['GET'])
+def api_debug_profile(profile_id):
+    """Статистика профилирования запроса по id из заголовка X-Debug-Profile-Id."""
+    if not profiling_allowed(request.headers):
+        return jsonify({'error': 'Profiling is not enabled'}), 403
+    result = PROFILER.get(profile_id)
+    if result is None:
+        return jsonify({'error': 'Profile not found'}), 404
+    return Response(result['stats'], content_type='text/plain; charset=utf-8')
+
 @app.route('/api/clear_history', methods=['POST'])
 def api_clear_history():
     """API для очистки истории."""
     try:
-        conn = sqlite3.connect(HISTORY_DB)
-        cursor = conn.cursor()
-        cursor.execute('PRAGMA foreign_keys = ON;')
-        cursor.execute('DELETE FROM hops')
-        cursor.execute('DELETE FROM requests')
-        conn.commit()
-        conn.close()
+        with write_transaction(HISTORY_DB) as cursor:
+            cursor.execute('DELETE FROM hops')
+            cursor.execute('DELETE FROM requests')
+            cursor.execute('DELETE FROM rtt_rollups')
         return jsonify({'message': 'History cleared successfully'})
     except Exception as e:
         return jsonify({'error': f'Error clearing history: {str(e)}'}), 500
@@ -1089,16 +5301,16 @@ def api_clear_history():
 def api_clear_paths():
     """Очистка независимой БД дерева путей."""
     try:
-        conn = sqlite3.connect(PATHS_DB)
-        cursor = conn.cursor()
-        cursor.execute('PRAGMA foreign_keys = ON;')
-        cursor.execute('DELETE FROM path_hops')
-        cursor.execute('DELETE FROM path_requests')
-        cursor.execute('DELETE FROM hop_nodes')
-        cursor.execute('DELETE FROM hop_ips')
-        cursor.execute('DELETE FROM targets')
-        conn.commit()
-        conn.close()
+        with write_transaction(PATHS_DB) as cursor:
+            cursor.execute('DELETE FROM path_hops')
+            cursor.execute('DELETE FROM path_requests')
+            cursor.execute('DELETE FROM hop_nodes')
+            cursor.execute('DELETE FROM hop_ips')
+            cursor.execute('DELETE FROM hop_edges')
+            cursor.execute('DELETE FROM targets')
+        PATHS_CACHE.invalidate()
+        TOPOLOGY.invalidate()
+        PATHS_LAYOUT.invalidate()
         return jsonify({'message': 'Paths DB cleared successfully'})
     except Exception as e:
         return jsonify({'error': f'Error clearing paths: {str(e)}'}), 500
@@ -1121,9 +5333,45 @@ def internal_error(error):
 # ИНИЦИАЛИЗАЦИЯ И ��АПУСК
 # ============================
 
-# Инициализация при импорте
-init_database()
-init_paths_database()
+# Фоновые потоки процесса стартуют один раз, при первом запросе в обслуживающем процессе.
+# Так они не дублируются под перезагрузчиком Werkzeug (наблюдающий процесс запросов не
+# обслуживает) и запускаются под WSGI-сервером, где блок __main__ не выполняется: каждый
+# рабочий процесс запускает свои потоки после fork. С несколькими рабочими процессами
+# задайте BACKGROUND_WORKERS=0 и запускайте `flask retention` по расписанию из одного места;
+# сведения о сети тогда обновляются по запросу (NetworkInfoCache.get).
+BACKGROUND_WORKERS = os.environ.get('BACKGROUND_WORKERS', '1') not in ('0', 'false', 'no', '')
+_background_lock = threading.Lock()
+_background_started = False
+
+
+def start_background_workers():
+    """Запускает фоновые потоки процесса (сведения о сети, ретеншн); повторные вызовы ничего не делают.
+
+    True — потоки запущены этим вызовом.
+    """
+    global _background_started
+    with _background_lock:
+        if _background_started:
+            return False
+        _background_started = True
+    NETWORK_INFO.start()
+    # Фоновый ретеншн работает, только если заданы правила
+    if RETENTION_POLICIES:
+        RETENTION.start()
+    return True
+
+
+@app.before_request
+def _start_background_workers():
+    # В тестах потоки запускаются явно
+    if BACKGROUND_WORKERS and not _background_started and not app.testing:
+        start_background_workers()
+
+
+# Инициализация при импорте; процессы пула разбора (spawn импортирует модуль заново) базы не трогают
+if multiprocessing.parent_process() is None:
+    init_database()
+    init_paths_database()
 
 if __name__ == '__main__':
     # Создаем папки если они не существуют (внутри пакета APP)
@@ -1132,5 +5380,5 @@ if __name__ == '__main__':
     os.makedirs(os.path.join(base_dir, 'static', 'css'), exist_ok=True)
     os.makedirs(os.path.join(base_dir, 'static', 'js'), exist_ok=True)
     
-    # Запускаем сервер
+    # Запускаем сервер (фоновые потоки стартуют при первом запросе, см. start_background_workers)
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -206,6 +206,12 @@ async function handleCommandSubmit(event) {
 }
 
 async function executeCommand(command) {
+    // traceroute/tracert выполняем потоково: хопы появляются по мере ответа
+    if (window.EventSource && /^(traceroute|tracert)\b/.test(command)) {
+        executeTracerouteStream(command);
+        return;
+    }
+
     showLoading(`Выполнение: ${command}`);
     
     try {
@@ -247,6 +253,62 @@ async function executeCommand(command) {
     }
 }
 
+function executeTracerouteStream(command) {
+    showLoading(`Выполнение: ${command}`);
+
+    const startTime = Date.now();
+    const hops = [];
+    const lines = [];
+    const source = new EventSource(`/api/run_command/stream?command=${encodeURIComponent(command)}`);
+
+    source.addEventListener('line', (event) => {
+        const data = JSON.parse(event.data);
+        lines.push(data.text);
+        elements.rawOutputDiv.textContent = lines.join('\n');
+    });
+
+    source.addEventListener('hop', (event) => {
+        hops.push(JSON.parse(event.data));
+        if (hops.length === 1) hideLoading();
+        updateCommandMeta(command, Date.now() - startTime);
+        visualizeTraceroute(hops.slice(), command);
+    });
+
+    // Имя хопа приходит позже самого хопа, когда завершится обратный DNS
+    source.addEventListener('hostname', (event) => {
+        const data = JSON.parse(event.data);
+        const hop = hops.find(h => h.hop === data.hop && h.ip === data.ip);
+        if (!hop) return;
+        hop.hostname = data.hostname;
+        visualizeTraceroute(hops.slice(), command);
+    });
+
+    source.addEventListener('done', (event) => {
+        source.close();
+        const data = JSON.parse(event.data);
+        updateCommandMeta(command, Date.now() - startTime);
+        displayRawOutput(data);
+        if (hops.length === 0) {
+            visualizeCommandData({ ...data, parsed_data: null });
+        }
+        if (data.saved) {
+            setTimeout(loadHistory, 500);
+        }
+        hideLoading();
+    });
+
+    source.addEventListener('error', (event) => {
+        source.close();
+        let message = 'соединение прервано';
+        try {
+            if (event.data) message = JSON.parse(event.data).error || message;
+        } catch (e) { /* событие ошибки соединения без данных */ }
+        console.error('❌ Ошибка потоковой трассировки:', message);
+        showError(`Ошибка при выполнении команды: ${message}`);
+        hideLoading();
+    });
+}
+
 function handleBatchRun() {
     const raw = elements.ipListInput ? (elements.ipListInput.value || '') : '';
     const list = raw.split(/[\n\r,; \t]+/).map(s => s.trim()).filter(Boolean);
@@ -889,21 +951,21 @@ async function loadPaths() {
     showLoading("Построение дерева путей...");
     
     try {
-        const response = await fetch('/api/paths');
-        const data = await response.json();
+        // Позиции узлов считает и кэширует сервер
+        const response = await fetch('/api/paths/layout');
+        const layout = await response.json();
         
         if (!response.ok) {
-            throw new Error(data.error || 'Ошибка загрузки путей');
+            throw new Error(layout.error || 'Ошибка загрузки путей');
         }
         
-        networkPaths = data.paths || {};
-        visualizePaths(networkPaths);
+        networkPaths = pathsFromLayout(layout);
+        visualizePaths(layout);
         
         // Обновляем счетчики
-        const targets = Object.keys(networkPaths).length;
+        const targets = layout.groups.length;
         const hops = Object.values(networkPaths).reduce((acc, path) => acc + path.length, 0);
-        const ips = Object.values(networkPaths).reduce((acc, path) => 
-            acc + path.reduce((ipAcc, hop) => ipAcc + hop.ips.length, 0), 0);
+        const ips = layout.nodes.length;
         
         elements.totalTargets.textContent = targets;
         elements.totalHops.textContent = hops;
@@ -918,8 +980,24 @@ async function loadPaths() {
     }
 }
 
-function visualizePaths(paths) {
-    if (Object.keys(paths).length === 0) {
+// Пути по целям из раскладки (для экспорта): {target: [{hop_number, nodes, ips}]}
+function pathsFromLayout(layout) {
+    const paths = {};
+    layout.nodes.forEach(([group, hopNumber, ip, label]) => {
+        const hops = paths[layout.groups[group][0]] = paths[layout.groups[group][0]] || [];
+        let hop = hops[hops.length - 1];
+        if (!hop || hop.hop_number !== hopNumber) {
+            hop = { hop_number: hopNumber, nodes: [], ips: [] };
+            hops.push(hop);
+        }
+        hop.ips.push(ip);
+        if (label && !hop.nodes.includes(label)) hop.nodes.push(label);
+    });
+    return paths;
+}
+
+function visualizePaths(layout) {
+    if (layout.nodes.length === 0) {
         elements.pathsContainer.innerHTML = `
             <div class="placeholder">
                 <div class="placeholder-icon">🌍</div>
@@ -932,60 +1010,60 @@ function visualizePaths(paths) {
 
     elements.pathsContainer.innerHTML = '';
     
-    Object.entries(paths).forEach(([target, hops]) => {
-        const targetContainer = d3.select(elements.pathsContainer)
-            .append('div')
-            .attr('class', 'path-target');
-        
-        targetContainer.append('h4')
-            .text(`🎯 Цель: ${target}`)
-            .style('color', '#2c3e50')
-            .style('margin-bottom', '15px');
-        
-        const treeContainer = targetContainer.append('div')
-            .attr('class', 'path-tree');
-        
-        // Сортируем хопы по номеру
-        hops.sort((a, b) => a.hop_number - b.hop_number);
-        
-        hops.forEach(hop => {
-            const hopNode = treeContainer.append('div')
-                .attr('class', 'path-hop')
-                .style('margin-left', `${(hop.hop_number - 1) * 30}px`);
-            
-            hopNode.append('div')
-                .attr('class', 'hop-header')
-                .html(`<strong>Хоп ${hop.hop_number}</strong>`);
-            
-            if (hop.nodes.length > 0 || hop.ips.length > 0) {
-                const contentNode = hopNode.append('div')
-                    .attr('class', 'hop-content');
-                
-                if (hop.nodes.length > 0) {
-                    contentNode.append('div')
-                        .attr('class', 'hop-hosts')
-                        .html(`<strong>Хосты:</strong> ${hop.nodes.join(', ')}`);
-                }
-                
-                if (hop.ips.length > 0) {
-                    contentNode.append('div')
-                        .attr('class', 'hop-ips')
-                        .html(`<strong>IP:</strong> ${hop.ips.join(', ')}`);
-                }
-            } else {
-                hopNode.append('div')
-                    .attr('class', 'hop-empty')
-                    .text('❌ Таймаут или неизвестный узел');
-            }
-            
-            // Добавляем соединительную линию
-            if (hop.hop_number > 1) {
-                hopNode.style('border-left', '2px dashed #3498db')
-                       .style('padding-left', '15px')
-                       .style('margin-top', '10px');
-            }
-        });
-    });
+    const margin = { top: 30, right: 140, bottom: 20, left: 160 };
+    const width = Math.max(elements.pathsContainer.clientWidth || 800, layout.width + margin.left + margin.right);
+    const svg = d3.select(elements.pathsContainer)
+        .append('svg')
+        .attr('class', 'path-tree')
+        .attr('width', width)
+        .attr('height', layout.height + margin.top + margin.bottom);
+    const zoomGroup = svg.append('g');
+    const g = zoomGroup.append('g').attr('transform', `translate(${margin.left},${margin.top})`);
+    svg.call(d3.zoom().scaleExtent([0.2, 4]).on('zoom', (event) => zoomGroup.attr('transform', event.transform)));
+    
+    // Подписи целей слева от своих групп
+    g.selectAll('.path-target')
+        .data(layout.groups)
+        .enter().append('text')
+        .attr('class', 'path-target')
+        .attr('x', -20)
+        .attr('y', d => d[1] + d[2] / 2)
+        .attr('text-anchor', 'end')
+        .attr('dominant-baseline', 'middle')
+        .style('fill', '#2c3e50')
+        .style('font-weight', 'bold')
+        .text(d => `🎯 ${d[0]}`);
+    
+    const link = d3.linkHorizontal().x(d => d[4]).y(d => d[5]);
+    g.selectAll('.path-link')
+        .data(layout.links)
+        .enter().append('path')
+        .attr('class', 'path-link')
+        .attr('fill', 'none')
+        .attr('stroke', '#3498db')
+        .attr('stroke-width', 1.5)
+        .attr('d', d => link({ source: layout.nodes[d[0]], target: layout.nodes[d[1]] }));
+    
+    const node = g.selectAll('.path-hop')
+        .data(layout.nodes)
+        .enter().append('g')
+        .attr('class', 'path-hop')
+        .attr('transform', d => `translate(${d[4]},${d[5]})`);
+    
+    node.append('circle')
+        .attr('r', 4)
+        .attr('fill', '#3498db')
+        .attr('stroke', '#2c3e50');
+    
+    node.append('text')
+        .attr('y', -8)
+        .attr('text-anchor', 'middle')
+        .style('font-size', '11px')
+        .style('fill', '#2c3e50')
+        .text(d => d[3] && d[3] !== d[2] ? d[3] : d[2]);
+    
+    node.append('title')
+        .text(d => `Хоп ${d[1]}: ${d[2]}${d[3] && d[3] !== d[2] ? ` (${d[3]})` : ''}`);
 }
 
 // ===== HISTORY ITEM LOADING =====
@@ -1196,10 +1274,8 @@ function updateUptime() {
 
 async function checkSystemStatus() {
     try {
-        const response = await fetch('/api/network_info', { 
-            method: 'HEAD',
-            timeout: 5000 
-        });
+        // Легкая проверка без обращения к сети и процессам на сервере
+        const response = await fetch('/api/health', { cache: 'no-store' });
         
         if (response.ok) {
             updateNetworkStatus('✅ Работает нормально');
@@ -0,0 +1,267 @@
+"""Бенчмарк парсера traceroute/tracert на версионированном корпусе.
+
+Запуск из корня репозитория:
+
+    python tests/bench_parser.py                    # сравнить с сохраненной базой
+    python tests/bench_parser.py --update-baseline  # перезаписать базу
+    python tests/bench_parser.py --threshold 0.1    # допустимая деградация 10%
+
+Сначала разобранные хопы сверяются с ожидаемыми (файлы *.expected.json рядом
+с трассами, для синтетики — ожидания от генератора). Затем для каждой трассы
+печатаются строки в секунду, скорость относительно опорного разбора (одна
+регулярка на строку, замеряется в том же запуске вперемешку с парсером) и
+число аллокаций (tracemalloc) на один разбор. С базой сравнивается только
+относительная скорость: абсолютные строки/с зависят от машины.
+
+Код выхода 1 — хопы не совпали с ожидаемыми или есть регрессия относительно базы.
+"""
+import os
+import sys
+import json
+import time
+import re
+import random
+import argparse
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from APP.app import parse_traceroute  # noqa: E402
+
+CORPUS_DIR = os.path.join(ROOT, 'tests', 'parser_corpus')
+DEFAULT_CORPUS_VERSION = os.environ.get('PARSER_BENCH_CORPUS', 'v1')
+DEFAULT_THRESHOLD = float(os.environ.get('PARSER_BENCH_THRESHOLD', '0.25'))
+
+
+# ============================
+# КОРПУС
+# ============================
+
+def _synthetic_ip(rnd):
+    return '.'.join(str(rnd.randint(1, 254)) for _ in range(4))
+
+
+def _synthetic_rtt(rnd):
+    return f'{rnd.uniform(0.2, 250.0):.3f}'
+
+
+def _synthetic_hop(n, hostname, ip, rtts):
+    return {'hop': str(n), 'hostname': hostname, 'ip': ip, 'rtt1': rtts[0], 'rtt2': rtts[1], 'rtt3': rtts[2]}
+
+
+def generate_synthetic_trace(kind: str, lines: int, seed: int):
+    """Детерминированная длинная трасса заданного формата (~10% таймаутов).
+
+    Возвращает (текст, ожидаемые хопы).
+    """
+    rnd = random.Random(seed)
+    out = []
+    expected = []
+    if kind == 'windows':
+        out.append('Tracing route to synthetic.example [203.0.113.1]')
+        out.append(f'over a maximum of {lines} hops:')
+        out.append('')
+    else:
+        out.append(f'traceroute to synthetic.example (203.0.113.1), {lines} hops max, 60 byte packets')
+    for n in range(1, lines + 1):
+        if rnd.random() < 0.1:
+            if kind == 'windows':
+                out.append(f'{n:3}     *        *        *     Request timed out.')
+            else:
+                out.append(f'{n:3}  * * *')
+            expected.append(_synthetic_hop(n, '*', 'Таймаут', (None, None, None)))
+            continue
+        ip = _synthetic_ip(rnd)
+        if kind == 'windows':
+            rtts = [str(rnd.randint(1, 250)) for _ in range(3)]
+            ms = ' '.join(f'{rtt:>5} ms' for rtt in rtts)
+            out.append(f'{n:3} {ms}  r{n}.synthetic.example [{ip}]')
+            hostname = f'r{n}.synthetic.example'
+        elif kind == 'linux_numeric':
+            rtts = [_synthetic_rtt(rnd) for _ in range(3)]
+            ms = '  '.join(f'{rtt} ms' for rtt in rtts)
+            out.append(f'{n:3}  {ip}  {ms}')
+            hostname = ip
+        else:
+            rtts = [_synthetic_rtt(rnd) for _ in range(3)]
+            ms = '  '.join(f'{rtt} ms' for rtt in rtts)
+            out.append(f'{n:3}  r{n}.synthetic.example ({ip})  {ms}')
+            hostname = f'r{n}.synthetic.example'
+        expected.append(_synthetic_hop(n, hostname, ip, rtts))
+    return '\n'.join(out) + '\n', expected
+
+
+def load_corpus(version: str = DEFAULT_CORPUS_VERSION):
+    """Возвращает (manifest, [(запись манифеста, текст трассы, ожидаемые хопы), ...])."""
+    base = os.path.join(CORPUS_DIR, version)
+    with open(os.path.join(base, 'manifest.json'), encoding='utf-8') as f:
+        manifest = json.load(f)
+    traces = []
+    for entry in manifest['traces']:
+        if 'synthetic' in entry:
+            text, expected = generate_synthetic_trace(entry['synthetic'], entry['lines'], entry['seed'])
+        else:
+            with open(os.path.join(base, entry['file']), encoding='utf-8') as f:
+                text = f.read()
+            with open(os.path.join(base, entry['expected']), encoding='utf-8') as f:
+                expected = json.load(f)
+        traces.append((entry, text, expected))
+    return manifest, traces
+
+
+def check_expected(traces):
+    """Список расхождений разобранных хопов с ожидаемыми (по первому отличию на трассу)."""
+    mismatches = []
+    for entry, text, expected in traces:
+        hops = parse_traceroute(text)
+        if len(hops) != len(expected):
+            mismatches.append(f"{entry['name']}: parsed {len(hops)} hops, expected {len(expected)}")
+            continue
+        for hop, want in zip(hops, expected):
+            got = {key: hop.get(key) for key in want}
+            if got != want:
+                mismatches.append(f"{entry['name']}: hop {want.get('hop')} parsed as {got}, expected {want}")
+                break
+    return mismatches
+
+
+# ============================
+# ИЗМЕРЕНИЯ
+# ============================
+
+_REFERENCE_LINE_RE = re.compile(r'\s*(\d+)\s+(\S+)')
+
+
+def reference_parse(text: str):
+    """Опорный разбор: одна регулярка на строку, без разбора RTT и форматов.
+
+    Нужен только как мерило скорости интерпретатора и re на текущей машине.
+    """
+    hops = []
+    for line in text.splitlines():
+        m = _REFERENCE_LINE_RE.match(line)
+        if m:
+            hops.append({'hop': m.group(1), 'hostname': m.group(2)})
+    return hops
+
+
+def _best_rate(fn, text, lines, budget):
+    iterations = 0
+    started = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < budget or iterations < 3:
+        fn(text)
+        iterations += 1
+        elapsed = time.perf_counter() - started
+    return lines * iterations / elapsed
+
+
+def measure_trace(text: str, min_time: float = 0.5, rounds: int = 5):
+    """Скорость (строк/с, и относительно опорного разбора) и аллокации одного разбора."""
+    lines = len(text.splitlines())
+    parse_traceroute(text)  # прогрев
+    reference_parse(text)
+
+    # Лучший из нескольких раундов: меньше шума от планировщика и частоты CPU.
+    # Опорный разбор меряется вперемешку с парсером, чтобы оба видели одну и ту же нагрузку
+    best_rate = 0.0
+    best_reference = 0.0
+    budget = min_time / rounds / 2
+    for _ in range(rounds):
+        best_rate = max(best_rate, _best_rate(parse_traceroute, text, lines, budget))
+        best_reference = max(best_reference, _best_rate(reference_parse, text, lines, budget))
+
+    # Аллокации считаем отдельно: tracemalloc сильно замедляет интерпретатор
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        hops = parse_traceroute(text)
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    diff = after.compare_to(before, 'filename')
+    return {
+        'lines': lines,
+        'hops': len(hops),
+        'lines_per_sec': round(best_rate, 1),
+        'relative_speed': round(best_rate / best_reference, 4),
+        'alloc_blocks': sum(max(stat.count_diff, 0) for stat in diff),
+        'alloc_peak_bytes': peak,
+    }
+
+
+def run_benchmark(version: str = DEFAULT_CORPUS_VERSION, min_time: float = 0.5):
+    _, traces = load_corpus(version)
+    return {entry['name']: measure_trace(text, min_time) for entry, text, _ in traces}
+
+
+def compare_with_baseline(results, baseline, threshold: float):
+    """Список регрессий: скорость относительно опорного разбора упала или аллокаций
+    стало больше, чем на threshold.
+
+    Изменившееся число хопов считается регрессией при любом пороге.
+    """
+    regressions = []
+    for name, cur in results.items():
+        ref = baseline.get(name)
+        if not ref:
+            continue
+        if cur['hops'] != ref['hops']:
+            regressions.append(f"{name}: parsed {cur['hops']} hops, baseline {ref['hops']}")
+        if cur['relative_speed'] < ref['relative_speed'] * (1 - threshold):
+            regressions.append(f"{name}: relative speed {cur['relative_speed']} < baseline {ref['relative_speed']}")
+        if cur['alloc_blocks'] > ref['alloc_blocks'] * (1 + threshold):
+            regressions.append(f"{name}: alloc blocks {cur['alloc_blocks']} > baseline {ref['alloc_blocks']}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Parser benchmark over the traceroute corpus')
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS_VERSION, help='corpus version directory')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='allowed relative regression (0.25 = 25%%)')
+    parser.add_argument('--min-time', type=float, default=0.5, help='seconds of timing per trace')
+    parser.add_argument('--baseline', default=None, help='baseline JSON path')
+    parser.add_argument('--update-baseline', action='store_true', help='store results as the new baseline')
+    args = parser.parse_args(argv)
+
+    baseline_path = args.baseline or os.path.join(CORPUS_DIR, args.corpus, 'baseline.json')
+    _, traces = load_corpus(args.corpus)
+    mismatches = check_expected(traces)
+    for line in mismatches:
+        print(f'MISMATCH {line}')
+    if mismatches:
+        return 1
+    results = run_benchmark(args.corpus, args.min_time)
+
+    print(f"{'trace':28} {'lines':>6} {'hops':>6} {'lines/sec':>12} {'relative':>9} {'allocs':>8} {'peak KiB':>9}")
+    for name, r in results.items():
+        print(f"{name:28} {r['lines']:>6} {r['hops']:>6} {r['lines_per_sec']:>12.0f} {r['relative_speed']:>9.3f} "
+              f"{r['alloc_blocks']:>8} {r['alloc_peak_bytes'] / 1024:>9.1f}")
+
+    if args.update_baseline:
+        with open(baseline_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'Baseline written to {baseline_path}')
+        return 0
+
+    if not os.path.exists(baseline_path):
+        print(f'No baseline at {baseline_path}; run with --update-baseline')
+        return 0
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions = compare_with_baseline(results, baseline, args.threshold)
+    for line in regressions:
+        print(f'REGRESSION {line}')
+    if not regressions:
+        print(f'OK: no regressions beyond {args.threshold:.0%}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,11 @@
+import io
+import csv
 import os
+import json
+import time
+import sqlite3
 import types
+import threading
 import tempfile
 import unittest
 from unittest.mock import patch
@@ -18,6 +24,20 @@ class NetworkVisualizerAPITests(unittest.TestCase):
         self.addCleanup(lambda: (os.path.exists(self.tmp_db.name) and os.unlink(self.tmp_db.name)))
         app_module.HISTORY_DB = self.tmp_db.name
         app_module.init_database()
+        self.tmp_paths_db = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        self.addCleanup(lambda: (os.path.exists(self.tmp_paths_db.name) and os.unlink(self.tmp_paths_db.name)))
+        app_module.PATHS_DB = self.tmp_paths_db.name
+        app_module.init_paths_database()
+        self.addCleanup(app_module.close_connections)
+        app_module.PATHS_CACHE.invalidate()
+        app_module.TOPOLOGY.invalidate()
+        app_module.PATHS_LAYOUT.invalidate()
+        # Одинаковые команды в разных тестах не должны получать кэшированный результат
+        app_module.TRACE_RESULTS.clear()
+        # Обратный DNS в тестах не ходит в сеть; тесты резолвера включают его явно
+        rdns = patch.object(app_module, 'RDNS_ENABLED', False)
+        rdns.start()
+        self.addCleanup(rdns.stop)
 
         self.app = app_module.app
         self.app.testing = True
@@ -147,21 +167,15 @@ class NetworkVisualizerAPITests(unittest.TestCase):
         hist_resp2 = self.client.get('/api/history')
         self.assertEqual(len(hist_resp2.get_json()['history']), 0)
 
-    # 8) Network info: fields present, external IP Unknown when curl fails
+    # 8) Network info: fields present, external IP Unknown when the lookup fails, no subprocesses
     @patch('APP.app.subprocess.run')
     def test_api_network_info_fields_and_external_ip_unknown_on_error(self, mock_run):
-        def side_effect(args, capture_output=True, text=True, timeout=None):
-            if args[:2] == ['ip', 'addr']:
-                return make_completed(stdout='IP INFO', stderr='', returncode=0)
-            if args[:3] == ['ip', 'route', 'show']:
-                return make_completed(stdout='default via 192.168.1.1 dev eth0', stderr='', returncode=0)
-            if args[:2] == ['curl', '-s']:
-                raise Exception('curl failed')
-            return make_completed(stdout='', stderr='unknown', returncode=1)
-
-        mock_run.side_effect = side_effect
-
-        resp = self.client.get('/api/network_info')
+        mock_run.side_effect = AssertionError('network info must not fork')
+        app_module.NETWORK_INFO.invalidate()
+        self.addCleanup(app_module.NETWORK_INFO.invalidate)
+        with patch.object(app_module, '_lookup_external_ip', side_effect=Exception('lookup failed')):
+            app_module.NETWORK_INFO.refresh_external()
+            resp = self.client.get('/api/network_info')
         self.assertEqual(resp.status_code, 200)
         data = resp.get_json()
         self.assertIn('ip_addresses', data)
@@ -170,6 +184,8 @@ class NetworkVisualizerAPITests(unittest.TestCase):
         self.assertEqual(data['external_ip'], 'Unknown')
         self.assertIn('hostname', data)
         self.assertIn('timestamp', data)
+        self.assertIn('lo', [i['name'] for i in data['interfaces']])
+        mock_run.assert_not_called()
 
     # 9) run_command timeout handling
     @patch('APP.app.subprocess.run')
@@ -189,6 +205,1384 @@ class NetworkVisualizerAPITests(unittest.TestCase):
         self.assertEqual(rc, -1)
         self.assertIn('boom', stderr)
 
+    # 11) Batch traceroute runs targets concurrently and keeps input order
+    @patch('APP.app.subprocess.run')
+    def test_api_batch_traceroute_concurrent_keeps_order(self, mock_run):
+        lock = threading.Lock()
+        state = {'active': 0, 'peak': 0}
+
+        def side_effect(args, capture_output=True, text=True, timeout=None):
+            with lock:
+                state['active'] += 1
+                state['peak'] = max(state['peak'], state['active'])
+            time.sleep(0.05)
+            with lock:
+                state['active'] -= 1
+            target = args[-1]
+            return make_completed(stdout=f" 1  {target} ({target})  1.0 ms  1.0 ms  1.0 ms\n")
+
+        mock_run.side_effect = side_effect
+        targets = ['10.0.0.%d' % i for i in range(1, 7)]
+        resp = self.client.post('/api/batch_traceroute', json={'targets': targets, 'options': {'concurrency': 3}})
+        self.assertEqual(resp.status_code, 200)
+        data = resp.get_json()
+        self.assertEqual([r['target'] for r in data['results']], targets)
+        self.assertEqual(data['completed'], len(targets))
+        self.assertFalse(data['timed_out'])
+        self.assertGreater(state['peak'], 1)
+        self.assertLessEqual(state['peak'], 3)
+
+    # 12) Batch deadline returns partial results; the target still running is saved when it finishes
+    @patch('APP.app.subprocess.run')
+    def test_run_batch_traceroute_deadline_partial(self, mock_run):
+        def side_effect(args, capture_output=True, text=True, timeout=None):
+            if args[-1] == 'slow.example':
+                time.sleep(0.5)
+            return make_completed(stdout=f" 1  {args[-1]} (10.0.0.1)  1.0 ms  1.0 ms  1.0 ms\n")
+
+        mock_run.side_effect = side_effect
+        jobs = [('fast.example', 'traceroute fast.example'), ('slow.example', 'traceroute slow.example')]
+        results, timed_out = app_module.run_batch_traceroute(jobs, max_workers=2, deadline=0.2)
+        self.assertTrue(timed_out)
+        self.assertEqual(results[0]['status'], 'done')
+        self.assertEqual(results[1]['status'], 'deadline_exceeded')
+        self.assertEqual(results[1]['target'], 'slow.example')
+        # Медленная цель досчитывает после дедлайна и тоже сохраняется
+        for _ in range(100):
+            history = self.client.get('/api/history').get_json()['history']
+            if len(history) == 2:
+                break
+            time.sleep(0.02)
+        self.assertEqual(sorted(h['command'] for h in history),
+                         ['traceroute fast.example', 'traceroute slow.example'])
+
+    # 13) Async batch job: 202 with job id, status polling and NDJSON results
+    @patch('APP.app.subprocess.run')
+    def test_api_batch_traceroute_async_job(self, mock_run):
+        def side_effect(args, capture_output=True, text=True, timeout=None):
+            target = args[-1]
+            return make_completed(stdout=f" 1  {target} ({target})  1.0 ms  1.0 ms  1.0 ms\n")
+
+        mock_run.side_effect = side_effect
+        targets = ['10.0.1.1', '10.0.1.2', '10.0.1.3']
+        resp = self.client.post('/api/batch_traceroute?async=1', json={'targets': targets})
+        self.assertEqual(resp.status_code, 202)
+        job_id = resp.get_json()['job_id']
+
+        stream = self.client.get(f'/api/jobs/{job_id}/results')
+        self.assertEqual(stream.status_code, 200)
+        self.assertEqual(stream.mimetype, 'application/x-ndjson')
+        lines = [json.loads(l) for l in stream.get_data(as_text=True).splitlines() if l.strip()]
+        self.assertEqual(sorted(l['target'] for l in lines), sorted(targets))
+        self.assertEqual(sorted(l['index'] for l in lines), [0, 1, 2])
+
+        status = self.client.get(f'/api/jobs/{job_id}').get_json()
+        self.assertEqual(status['status'], 'done')
+        self.assertEqual(status['completed'], 3)
+        self.assertEqual(self.client.get('/api/jobs/unknown').status_code, 404)
+
+    # 14) Cancelling a job skips queued targets
+    @patch('APP.app.subprocess.run')
+    def test_api_job_cancel(self, mock_run):
+        release = threading.Event()
+
+        def side_effect(args, capture_output=True, text=True, timeout=None):
+            release.wait(2)
+            return make_completed(stdout='')
+
+        mock_run.side_effect = side_effect
+        job = app_module.submit_batch_job([('t%d' % i, 'traceroute t%d' % i) for i in range(4)], max_workers=1)
+        self.addCleanup(release.set)
+        resp = self.client.post(f'/api/jobs/{job.id}/cancel')
+        self.assertEqual(resp.status_code, 200)
+        results = list(job.iter_results())
+        self.assertEqual(job.status, 'cancelled')
+        self.assertEqual(len(results), 4)
+        self.assertIn('cancelled', [r['status'] for r in results])
+
+    # 15) Streaming traceroute over SSE: one hop event per parsed line, final hops saved
+    @patch('APP.app.subprocess.Popen')
+    def test_api_run_command_stream_sse(self, mock_popen):
+        traceroute_output = (
+            "traceroute to example.com (93.184.216.34), 30 hops max\n"
+            " 1  router (192.168.1.1)  1.123 ms  1.234 ms  1.345 ms\n"
+            " 2  * * *\n"
+            " 3  example.com (93.184.216.34)  10.234 ms  10.345 ms  10.456 ms\n"
+        )
+        mock_popen.return_value = types.SimpleNamespace(
+            stdout=io.StringIO(traceroute_output),
+            stderr=io.StringIO(''),
+            wait=lambda: 0,
+            poll=lambda: 0,
+            kill=lambda: None
+        )
+
+        resp = self.client.get('/api/run_command/stream', query_string={'command': 'traceroute example.com'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+        events = []
+        for block in resp.get_data(as_text=True).split('\n\n'):
+            if not block.strip():
+                continue
+            name, data = block.split('\n', 1)
+            events.append((name[len('event: '):], json.loads(data[len('data: '):])))
+        hop_events = [payload for name, payload in events if name == 'hop']
+        self.assertEqual(hop_events, app_module.parse_traceroute(traceroute_output))
+        self.assertEqual(events[-1][0], 'done')
+        self.assertEqual(events[-1][1]['hops_count'], 3)
+        self.assertTrue(events[-1][1]['saved'])
+
+        hist = self.client.get('/api/history').get_json()['history']
+        self.assertEqual(len(hist), 1)
+        self.assertEqual(hist[0]['hops_count'], 3)
+
+        forbidden = self.client.get('/api/run_command/stream', query_string={'command': 'ls'})
+        self.assertEqual(forbidden.status_code, 403)
+
+    # 16) Probe engine over a simulated topology returns parse_traceroute-style hops
+    def test_probe_engine_simulated_topology(self):
+        topology = {
+            'example.com': {
+                'ip': '93.184.216.34',
+                'hops': ['192.168.1.1', None, '10.0.0.1', '93.184.216.34'],
+                'rtt_ms': [1.0, 2.0, 5.5, 10.25]
+            }
+        }
+        engine = app_module.ProbeEngine(app_module.SimulatedProbeBackend(topology), timeout=0.3)
+        hops = engine.trace('example.com', max_hops=30)
+        self.assertEqual([h['hop'] for h in hops], ['1', '2', '3', '4'])
+        self.assertEqual(hops[0], {'hop': '1', 'hostname': '192.168.1.1', 'ip': '192.168.1.1',
+                                   'rtt1': '1.000', 'rtt2': '1.000', 'rtt3': '1.000'})
+        self.assertEqual(hops[1]['ip'], 'Таймаут')
+        self.assertIsNone(hops[1]['rtt1'])
+        self.assertEqual(hops[3]['ip'], '93.184.216.34')
+        self.assertEqual(hops[3]['rtt1'], '10.250')
+
+    # 17) TRACE_ENGINE=probe serves /api/run_command without forking traceroute
+    @patch('APP.app.subprocess.run')
+    def test_api_run_command_probe_engine(self, mock_run):
+        topology = {'example.com': {'ip': '93.184.216.34', 'hops': ['192.168.1.1', '93.184.216.34']}}
+        with patch.object(app_module, 'TRACE_ENGINE', 'probe'), \
+                patch.object(app_module, 'PROBE_BACKEND', 'simulated'), \
+                patch.object(app_module, 'SIMULATED_TOPOLOGY', topology):
+            resp = self.client.post('/api/run_command', json={'command': 'traceroute -w 300 example.com'})
+        self.assertEqual(resp.status_code, 200)
+        data = resp.get_json()
+        mock_run.assert_not_called()
+        self.assertEqual([h['ip'] for h in data['parsed_data']], ['192.168.1.1', '93.184.216.34'])
+        self.assertEqual(app_module.parse_traceroute(data['raw_stdout'])[1]['ip'], '93.184.216.34')
+        hist = self.client.get('/api/history').get_json()['history']
+        self.assertEqual(hist[0]['hops_count'], 2)
+
+    # 18) Monitoring scheduler: spread first runs, save results, skip overrunning slots
+    @patch('APP.app.subprocess.run')
+    def test_monitor_scheduler_runs_and_skips_overruns(self, mock_run):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def side_effect(args, capture_output=True, text=True, timeout=None):
+            release.wait(2)
+            return make_completed(stdout=" 1  router (192.168.1.1)  1.0 ms  1.0 ms  1.0 ms\n")
+
+        mock_run.side_effect = side_effect
+        scheduler = app_module.MonitorScheduler(max_workers=2)
+        self.addCleanup(scheduler.stop)
+        item = scheduler.add('example.com', 60)
+        self.assertGreaterEqual(item.next_run, time.monotonic() - 1)
+        self.assertLess(item.next_run, time.monotonic() + 60)
+
+        now = item.next_run
+        scheduler.run_pending(now)
+        self.assertTrue(item.running)
+        # Следующий слот наступил, а прогон еще идет — слот пропускается
+        scheduler.run_pending(now + 60)
+        self.assertEqual(item.overruns, 1)
+        self.assertEqual(item.next_run, now + 120)
+
+        release.set()
+        for _ in range(100):
+            if item.last_run:
+                break
+            time.sleep(0.02)
+        self.assertEqual(item.last_run['hops_count'], 1)
+        self.assertFalse(item.running)
+        hist = self.client.get('/api/history').get_json()['history']
+        self.assertEqual(hist[0]['target'], 'example.com')
+
+    # 19) Monitoring endpoints: add, list, remove
+    def test_api_monitor_targets(self):
+        resp = self.client.post('/api/monitor/targets', json={'target': '8.8.8.8', 'interval_s': 30})
+        self.assertEqual(resp.status_code, 201)
+        self.addCleanup(app_module.MONITOR.remove, '8.8.8.8')
+        listing = self.client.get('/api/monitor').get_json()
+        self.assertFalse(listing['running'])
+        self.assertIn('8.8.8.8', [t['target'] for t in listing['targets']])
+        self.assertEqual(self.client.post('/api/monitor/targets', json={'target': '-x'}).status_code, 400)
+        self.assertEqual(self.client.delete('/api/monitor/targets/8.8.8.8').status_code, 200)
+        self.assertEqual(self.client.delete('/api/monitor/targets/8.8.8.8').status_code, 404)
+
+    # 20) Connection manager: per-thread reuse, WAL, read-only readers
+    def test_connection_manager_wal_and_readonly(self):
+        conn = app_module.get_connection(app_module.HISTORY_DB)
+        self.assertIs(conn, app_module.get_connection(app_module.HISTORY_DB))
+        self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        self.assertEqual(conn.execute('PRAGMA synchronous').fetchone()[0], 1)
+
+        other = []
+        t = threading.Thread(target=lambda: other.append(app_module.get_connection(app_module.HISTORY_DB)))
+        t.start()
+        t.join()
+        self.assertIsNot(other[0], conn)
+
+        with self.assertRaises(app_module.sqlite3.OperationalError):
+            with app_module.read_cursor(app_module.HISTORY_DB) as cursor:
+                cursor.execute("INSERT INTO requests (command) VALUES ('x')")
+
+        # Вложенная транзакция присоединяется к внешней и откатывается вместе с ней
+        with self.assertRaises(RuntimeError):
+            with app_module.write_transaction(app_module.HISTORY_DB) as cursor:
+                cursor.execute("INSERT INTO requests (command) VALUES ('a')")
+                with app_module.write_transaction(app_module.HISTORY_DB) as inner:
+                    inner.execute("INSERT INTO requests (command) VALUES ('b')")
+                raise RuntimeError('rollback')
+        self.assertEqual(app_module.get_request_history(), [])
+
+        # Параллельные писатели не теряют записи из-за "database is locked"
+        hops = [{'hop': '1', 'hostname': 'r', 'ip': '10.0.0.1', 'rtt1': '1.0', 'rtt2': None, 'rtt3': None}]
+        outcomes = []
+
+        def writer():
+            for _ in range(10):
+                outcomes.append(app_module.save_request_to_db('traceroute example.com', hops))
+            app_module.close_connections()
+
+        threads = [threading.Thread(target=writer) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertTrue(all(outcomes))
+        with app_module.read_cursor(app_module.HISTORY_DB) as cursor:
+            cursor.execute('SELECT COUNT(*) FROM requests')
+            self.assertEqual(cursor.fetchone()[0], 80)
+
+    # 21) Batch sweep is persisted in one bulk write; aggregate filled via executemany
+    @patch('APP.app.subprocess.run')
+    def test_batch_sweep_persists_in_single_bulk_write(self, mock_run):
+        def side_effect(args, capture_output=True, text=True, timeout=None):
+            target = args[-1]
+            return make_completed(stdout=(
+                " 1  router (192.168.1.1)  1.0 ms  1.0 ms  1.0 ms\n"
+                " 2  * * *\n"
+                f" 3  {target} ({target})  5.0 ms  5.0 ms  5.0 ms\n"
+            ))
+
+        mock_run.side_effect = side_effect
+        targets = ['10.0.2.%d' % i for i in range(1, 6)]
+        real_persist = app_module.persist_traces
+        with patch.object(app_module, 'persist_traces', side_effect=real_persist) as persist:
+            resp = self.client.post('/api/batch_traceroute', json={'targets': targets})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(persist.call_count, 1)
+        self.assertEqual(len(persist.call_args[0][0]), len(targets))
+
+        hist = self.client.get('/api/history').get_json()['history']
+        self.assertEqual(len(hist), len(targets))
+        details = self.client.get(f"/api/history/{hist[0]['id']}").get_json()
+        self.assertEqual(len(details['hops']), 3)
+        paths = self.client.get('/api/paths').get_json()['paths']
+        self.assertEqual(sorted(paths), sorted(targets))
+        self.assertEqual(paths['10.0.2.1'][0]['ips'], ['192.168.1.1'])
+
+    # 22) Paths aggregate is cached and updated incrementally on writes
+    def test_paths_cache_incremental_update_and_clear(self):
+        hops = [
+            {'hop': '1', 'hostname': 'router', 'ip': '192.168.1.1', 'rtt1': '1.0', 'rtt2': None, 'rtt3': None},
+            {'hop': '2', 'hostname': '*', 'ip': 'Таймаут', 'rtt1': None, 'rtt2': None, 'rtt3': None},
+        ]
+        app_module.update_paths_aggregate('traceroute a.example', hops)
+        first = app_module.get_all_paths()
+        self.assertEqual(first['a.example'], [{'hop_number': 1, 'nodes': ['router'], 'ips': ['192.168.1.1']}])
+
+        with patch.object(app_module, '_load_all_paths', side_effect=AssertionError('cache miss')):
+            app_module.update_paths_aggregate('traceroute a.example', [
+                {'hop': '1', 'hostname': 'router2', 'ip': '192.168.1.2', 'rtt1': '1.0', 'rtt2': None, 'rtt3': None},
+                {'hop': '3', 'hostname': 'a.example', 'ip': '10.0.0.3', 'rtt1': '2.0', 'rtt2': None, 'rtt3': None},
+            ])
+            cached = app_module.get_all_paths()
+        self.assertEqual(first['a.example'][0]['nodes'], ['router'])
+        self.assertEqual(cached['a.example'][0]['nodes'], ['router', 'router2'])
+        self.assertEqual([h['hop_number'] for h in cached['a.example']], [1, 3])
+        self.assertEqual(cached, app_module._load_all_paths())
+
+        self.client.post('/api/clear_paths')
+        self.assertEqual(self.client.get('/api/paths').get_json()['paths'], {})
+
+    # 23) Conditional GET: ETag bumps on writes, If-None-Match answered with 304 without reading the data
+    def test_history_and_paths_conditional_get(self):
+        first = self.client.get('/api/history')
+        etag = first.headers.get('ETag')
+        self.assertTrue(etag)
+        self.assertIn('Last-Modified', first.headers)
+
+        # Пока база не менялась, 304 стоит одной PRAGMA data_version, без запросов к таблицам
+        statements = []
+        app_module.get_connection(app_module.HISTORY_DB, readonly=True).set_trace_callback(statements.append)
+        with patch.object(app_module, 'get_request_history_page', side_effect=AssertionError('db read')):
+            cached = self.client.get('/api/history', headers={'If-None-Match': etag})
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached.headers.get('ETag'), etag)
+        self.assertEqual(statements, ['PRAGMA data_version'])
+
+        hops = [{'hop': '1', 'hostname': 'r', 'ip': '10.0.0.1', 'rtt1': '1.0', 'rtt2': None, 'rtt3': None}]
+        app_module.save_request_to_db('traceroute example.com', hops)
+        fresh = self.client.get('/api/history', headers={'If-None-Match': etag})
+        self.assertEqual(fresh.status_code, 200)
+        self.assertNotEqual(fresh.headers.get('ETag'), etag)
+        self.assertEqual(len(fresh.get_json()['history']), 1)
+
+        paths_etag = self.client.get('/api/paths').headers.get('ETag')
+        self.assertEqual(self.client.get('/api/paths', headers={'If-None-Match': paths_etag}).status_code, 304)
+        app_module.update_paths_aggregate('traceroute example.com', hops)
+        self.assertEqual(self.client.get('/api/paths', headers={'If-None-Match': paths_etag}).status_code, 200)
+        self.assertEqual(self.client.get('/api/history/999').status_code, 404)
+
+    # 24) Parser detects the output format and gives the same hops in any rule order
+    def test_parser_format_detection_and_equivalence(self):
+        named = (
+            "traceroute to example.com (93.184.216.34), 30 hops max, 60 byte packets\n"
+            " 1  gw.local (192.168.0.1)  0.512 ms  0.498 ms  0.470 ms\n"
+            " 2  * * *\n"
+            " 3  core.isp (10.0.0.1)  5.1 ms * 5.3 ms\n"
+        )
+        numeric = (
+            "traceroute to 93.184.216.34 (93.184.216.34), 30 hops max, 60 byte packets\n"
+            " 1  192.168.0.1  0.512 ms  0.498 ms  0.470 ms\n"
+            " 2  * * *\n"
+        )
+        windows = (
+            "Tracing route to example.com [93.184.216.34]\n"
+            "over a maximum of 30 hops:\n\n"
+            "  1    <1 ms    <1 ms    <1 ms  router.local [192.168.0.1]\n"
+            "  2     *        *        *     Request timed out.\n"
+            "  3    12 ms    11 ms    13 ms  93.184.216.34\n"
+        )
+        windows_ru = (
+            "Трассировка маршрута к example.com [93.184.216.34]\n"
+            "  1    <1 мс    <1 мс    <1 мс  192.168.0.1\n"
+            "  2     *        *        *     Превышен интервал ожидания для запроса.\n"
+        )
+        cases = [(named, 'linux'), (numeric, 'linux_numeric'), (windows, 'windows'), (windows_ru, 'windows_ru')]
+        for output, fmt in cases:
+            self.assertEqual(app_module.detect_traceroute_format(output), fmt)
+            hops = app_module.parse_traceroute(output)
+            for other in app_module.TRACEROUTE_FORMATS:
+                again = [h for h in (app_module.parse_traceroute_line(l, other) for l in output.splitlines()) if h]
+                self.assertEqual(again, hops)
+
+        hops = app_module.parse_traceroute(named)
+        self.assertEqual([h['hop'] for h in hops], ['1', '2', '3'])
+        self.assertEqual(hops[0]['ip'], '192.168.0.1')
+        self.assertEqual(hops[1]['ip'], 'Таймаут')
+        self.assertEqual((hops[2]['ip'], hops[2]['rtt1']), ('10.0.0.1', '5.1'))
+        win = app_module.parse_traceroute(windows)
+        self.assertEqual((win[0]['hostname'], win[0]['ip'], win[0]['rtt1']), ('router.local', '192.168.0.1', '1'))
+        self.assertEqual(win[1]['ip'], 'Таймаут')
+        self.assertEqual((win[2]['hostname'], win[2]['ip']), ('*', '93.184.216.34'))
+        self.assertEqual(app_module.parse_traceroute(windows_ru)[1]['ip'], 'Таймаут')
+
+    # 25) Benchmark corpus parses to the hops and formats recorded alongside it; speed is relative to a reference parse
+    def test_parser_benchmark_corpus_manifest(self):
+        from tests import bench_parser
+        _, traces = bench_parser.load_corpus('v1')
+        self.assertTrue(any('synthetic' in entry for entry, _, _ in traces))
+        for entry, text, _ in traces:
+            self.assertEqual(app_module.detect_traceroute_format(text), entry['format'], entry['name'])
+            self.assertEqual(len(app_module.parse_traceroute(text)), entry['hops'], entry['name'])
+        self.assertEqual(bench_parser.check_expected(traces), [])
+        entry, text, expected = traces[0]
+        broken = [dict(expected[0], ip='10.9.9.9')] + expected[1:]
+        self.assertEqual(len(bench_parser.check_expected([(entry, text, broken)])), 1)
+
+        result = bench_parser.measure_trace(text, min_time=0.01, rounds=1)
+        self.assertGreater(result['lines_per_sec'], 0)
+        self.assertGreater(result['relative_speed'], 0)
+        self.assertGreater(result['alloc_blocks'], 0)
+        baseline = {traces[0][0]['name']: dict(result, relative_speed=result['relative_speed'] * 10)}
+        self.assertEqual(len(bench_parser.compare_with_baseline({traces[0][0]['name']: result}, baseline, 0.25)), 1)
+
+    # 26) IPv6 hops are parsed and stored with packed keys; prefix queries use the ip_key index
+    def test_ipv6_parse_and_prefix_queries(self):
+        output = (
+            "traceroute6 to example.net (2001:db8:1::66), 30 hops max, 80 byte packets\n"
+            " 1  gw.lan (2001:db8::1)  0.512 ms  0.471 ms  0.455 ms\n"
+            " 2  * * *\n"
+            " 3  2001:db8:1::66  18.4 ms  18.3 ms  18.2 ms\n"
+        )
+        hops = app_module.parse_traceroute(output)
+        self.assertEqual([(h['hostname'], h['ip']) for h in hops],
+                         [('gw.lan', '2001:db8::1'), ('*', 'Таймаут'), ('2001:db8:1::66', '2001:db8:1::66')])
+        win = app_module.parse_traceroute("  1    <1 ms    <1 ms    <1 ms  router.lan [2001:db8::1]\n")
+        self.assertEqual((win[0]['hostname'], win[0]['ip']), ('router.lan', '2001:db8::1'))
+
+        self.assertEqual(len(app_module.ip_key('2001:db8::1')), 16)
+        self.assertEqual(app_module.ip_key('10.0.0.1'), app_module.ip_key('::ffff:10.0.0.1'))
+        self.assertIsNone(app_module.ip_key('Таймаут'))
+
+        app_module.persist_traces([('traceroute -6 example.net', hops),
+                                   ('traceroute example.com', [{'hop': '1', 'hostname': 'r', 'ip': '10.1.2.3',
+                                                                'rtt1': '1', 'rtt2': None, 'rtt3': None}])])
+        resp = self.client.get('/api/hops/prefix?prefix=2001:db8::/48')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([h['ip'] for h in resp.get_json()['hops']], ['2001:db8::1'])
+        v4 = self.client.get('/api/hops/prefix?prefix=10.0.0.0/8').get_json()['hops']
+        self.assertEqual([(h['ip'], h['target']) for h in v4], [('10.1.2.3', 'example.com')])
+        paths = self.client.get('/api/hops/prefix?prefix=2001:db8::/32&source=paths').get_json()['ips']
+        self.assertEqual(sorted(p['ip'] for p in paths), ['2001:db8:1::66', '2001:db8::1'])
+        self.assertEqual(self.client.get('/api/hops/prefix?prefix=nope').status_code, 400)
+
+        with app_module.read_cursor(app_module.HISTORY_DB) as cursor:
+            plan = ' '.join(str(r) for r in cursor.execute(
+                'EXPLAIN QUERY PLAN SELECT id FROM hops WHERE ip_key BETWEEN ? AND ?', app_module.ip_prefix_range('10.0.0.0/8')))
+        self.assertIn('idx_hops_ip_key', plan)
+
+    # 27) Existing databases gain the ip_key column and get it backfilled on init
+    def test_ip_key_migration_backfills_existing_rows(self):
+        app_module.close_connections()
+        os.unlink(self.tmp_db.name)
+        import sqlite3
+        conn = sqlite3.connect(self.tmp_db.name)
+        conn.executescript('''
+            CREATE TABLE requests (id INTEGER PRIMARY KEY AUTOINCREMENT, command TEXT NOT NULL,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP, target TEXT, hops_count INTEGER);
+            CREATE TABLE hops (id INTEGER PRIMARY KEY AUTOINCREMENT, request_id INTEGER, hop_number INTEGER,
+                hostname TEXT, ip_address TEXT, rtt1 REAL, rtt2 REAL, rtt3 REAL);
+            INSERT INTO requests (command, target, hops_count) VALUES ('traceroute a', 'a', 2);
+            INSERT INTO hops (request_id, hop_number, hostname, ip_address) VALUES (1, 1, 'r', '192.0.2.1');
+            INSERT INTO hops (request_id, hop_number, hostname, ip_address) VALUES (1, 2, '*', 'Таймаут');
+        ''')
+        conn.commit()
+        conn.close()
+        app_module.init_database()
+        self.assertEqual([h['ip'] for h in app_module.find_hops_by_prefix('192.0.2.0/24')], ['192.0.2.1'])
+
+    # 28) History APIs page by (timestamp, id) keyset with filters and a next_cursor token
+    def test_history_keyset_pagination_and_filters(self):
+        with app_module.write_transaction(app_module.HISTORY_DB) as cursor:
+            for i in range(7):
+                # Пары записей с одинаковым временем проверяют порядок по id
+                cursor.execute(
+                    'INSERT INTO requests (command, target, hops_count, timestamp) VALUES (?, ?, ?, ?)',
+                    (f'traceroute t{i % 2}', f't{i % 2}', i, f'2024-01-0{1 + i // 2}T10:00:00'))
+
+        seen = []
+        url = '/api/history?limit=3'
+        while url:
+            data = self.client.get(url).get_json()
+            self.assertLessEqual(len(data['history']), 3)
+            seen.extend(item['id'] for item in data['history'])
+            url = f"/api/history?limit=3&cursor={data['next_cursor']}" if data['next_cursor'] else None
+        self.assertEqual(seen, [7, 6, 5, 4, 3, 2, 1])
+
+        data = self.client.get('/api/history?target=t0&since=2024-01-02&until=2024-01-04T00:00:00&min_hops=3').get_json()
+        self.assertEqual([(h['target'], h['hops_count']) for h in data['history']], [('t0', 4)])
+        self.assertIsNone(data['next_cursor'])
+        self.assertEqual(self.client.get('/api/history?cursor=@@').status_code, 400)
+        self.assertEqual(self.client.get('/api/history?limit=0').status_code, 400)
+
+        app_module.save_path_request_to_db('traceroute a', [{'hop': '1', 'hostname': 'r', 'ip': '10.0.0.1'}])
+        app_module.save_path_request_to_db('traceroute b', [{'hop': '1', 'hostname': 'r', 'ip': '10.0.0.1'}])
+        first = self.client.get('/api/paths_history?limit=1').get_json()
+        self.assertEqual([h['target'] for h in first['history']], ['b'])
+        second = self.client.get(f"/api/paths_history?limit=1&cursor={first['next_cursor']}").get_json()
+        self.assertEqual([h['target'] for h in second['history']], ['a'])
+        self.assertIsNone(second['next_cursor'])
+
+    # 29) RTT rollups are updated on save and /api/rtt_series reads only the rollups; its ETag follows the window
+    def test_rtt_rollups_and_series(self):
+        hops_a = [{'hop': '1', 'hostname': 'gw', 'ip': '10.0.0.1', 'rtt1': '1.0', 'rtt2': '3.0', 'rtt3': None},
+                  {'hop': '2', 'hostname': '*', 'ip': 'Таймаут', 'rtt1': None, 'rtt2': None, 'rtt3': None}]
+        hops_b = [{'hop': '1', 'hostname': 'gw', 'ip': '10.0.0.1', 'rtt1': '2.0', 'rtt2': '2.0', 'rtt3': '2.0'}]
+        from datetime import datetime
+        when = datetime(2024, 5, 1, 12, 30, 15)
+        for hops in (hops_a, hops_b):
+            trace = app_module.normalize_trace('traceroute example.com', hops)
+            trace['timestamp'] = when
+            app_module.store_traces([trace], aggregate=False)
+
+        def fetch():
+            resp = self.client.get('/api/rtt_series?target=example.com&resolution=1m'
+                                   '&since=2024-05-01T12:00:00&until=2024-05-01T13:00:00')
+            self.assertEqual(resp.status_code, 200)
+            return resp.get_json()
+
+        data = fetch()
+        self.assertEqual(data['resolution'], 60)
+        by_hop = {s['hop_number']: s for s in data['series']}
+        point = by_hop[1]['points'][0]
+        self.assertEqual(by_hop[1]['ip'], '10.0.0.1')
+        self.assertEqual((point['count'], point['loss'], point['min'], point['max'], point['avg']), (5, 1, 1.0, 3.0, 2.0))
+        self.assertAlmostEqual(point['stddev'], (0.4) ** 0.5, places=3)
+        self.assertEqual((by_hop[2]['ip'], by_hop[2]['points'][0]['loss']), (None, 3))
+
+        # Ряды строятся только по агрегатам; пересчет из hops дает те же значения
+        with app_module.write_transaction(app_module.HISTORY_DB) as cursor:
+            app_module.rebuild_rtt_rollups(cursor)
+        self.assertEqual(fetch()['series'], data['series'])
+        with app_module.write_transaction(app_module.HISTORY_DB) as cursor:
+            cursor.execute('DELETE FROM hops')
+        self.assertEqual(fetch()['series'], data['series'])
+
+        self.assertEqual(self.client.get('/api/rtt_series').status_code, 400)
+        self.assertEqual(self.client.get('/api/rtt_series?target=x&resolution=5m').status_code, 400)
+        self.assertEqual(self.client.get('/api/rtt_series?target=nobody').get_json()['series'], [])
+
+        # Окно по умолчанию сдвигается со временем: без записей между запросами 304 не отдается
+        with patch.object(app_module.time, 'time', return_value=1714566615.0):
+            first = self.client.get('/api/rtt_series?target=example.com')
+            self.assertEqual(self.client.get('/api/rtt_series?target=example.com',
+                                             headers={'If-None-Match': first.headers['ETag']}).status_code, 304)
+        with patch.object(app_module.time, 'time', return_value=1714566616.0):
+            later = self.client.get('/api/rtt_series?target=example.com', headers={'If-None-Match': first.headers['ETag']})
+        self.assertEqual(later.status_code, 200)
+        self.assertEqual(later.get_json()['until'], first.get_json()['until'] + 1)
+        self.assertNotEqual(later.headers['ETag'], first.headers['ETag'])
+
+    # 30) Retention expires rows in batches, archives them as gzip NDJSON and re-imports them
+    def test_retention_batches_archive_and_reimport(self):
+        archive_dir = tempfile.mkdtemp()
+        self.addCleanup(lambda: __import__('shutil').rmtree(archive_dir, ignore_errors=True))
+        with app_module.write_transaction(app_module.HISTORY_DB) as cursor:
+            for day in range(1, 6):
+                cursor.execute('INSERT INTO requests (command, target, hops_count, timestamp) VALUES (?, ?, 1, ?)',
+                               ('traceroute old', 'old', f'2024-01-0{day}T10:00:00'))
+                cursor.execute('INSERT INTO hops (request_id, hop_number, hostname, ip_address, rtt1) VALUES (?, 1, ?, ?, ?)',
+                               (cursor.lastrowid, 'gw', '10.0.0.1', 1.5))
+        app_module.save_request_to_db('traceroute new', [{'hop': '1', 'hostname': 'gw', 'ip': '10.0.0.1', 'rtt1': '2.0'}])
+        for target in ('a', 'b', 'c'):
+            app_module.save_path_request_to_db(f'traceroute {target}', [{'hop': '1', 'hostname': 'r', 'ip': '10.0.0.2'}])
+
+        policies = {'requests': {'max_age_days': 30}, 'path_requests': {'max_rows': 1}, 'rtt_rollups_1m': {'max_age_days': 30}}
+        with patch.object(app_module, 'RETENTION_ARCHIVE_DIR', archive_dir), \
+                patch.object(app_module, 'RETENTION_BATCH_PAUSE', 0):
+            result = app_module.apply_retention(policies, batch_size=2)
+        self.assertEqual(result['deleted'], {'requests': 5, 'path_requests': 2, 'rtt_rollups_1m': 0})
+        from datetime import datetime, timedelta
+        later = app_module.apply_retention({'rtt_rollups_1m': {'max_age_days': 1}}, now=datetime.now() + timedelta(days=2))
+        self.assertEqual(later['deleted'], {'rtt_rollups_1m': 1})
+        self.assertEqual([h['target'] for h in app_module.get_request_history()], ['new'])
+        self.assertEqual([h['target'] for h in app_module.get_path_request_history()], ['c'])
+        with app_module.read_cursor(app_module.HISTORY_DB) as cursor:
+            self.assertEqual(cursor.execute('SELECT COUNT(*) FROM hops').fetchone()[0], 1)
+        self.assertEqual(app_module.get_connection(app_module.HISTORY_DB).execute('PRAGMA auto_vacuum').fetchone()[0], 2)
+
+        archives = sorted(os.listdir(os.path.join(archive_dir, 'requests')))
+        self.assertEqual(archives, [f'2024-01-0{d}.ndjson.gz' for d in range(1, 6)])
+        for name in archives:
+            self.assertEqual(app_module.import_archive(os.path.join(archive_dir, 'requests', name)), {'requests': 1})
+        self.assertEqual(app_module.import_archive(os.path.join(archive_dir, 'requests', archives[0])), {'requests': 0})
+        history = app_module.get_request_history()
+        self.assertEqual(len(history), 6)
+        restored = app_module.get_request_details(history[-1]['id'])
+        self.assertEqual((restored['hops'][0]['ip'], restored['hops'][0]['rtt1']), ('10.0.0.1', '1.5'))
+
+        self.assertEqual(self.client.post('/api/retention/run', json={'policies': {'nope': {}}}).status_code, 400)
+        resp = self.client.post('/api/retention/run', json={'policies': {'requests': {'max_rows': 10}}})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()['deleted'], {'requests': 0})
+        self.assertIn('policies', self.client.get('/api/retention').get_json())
+
+    # 31) Network info is cached with a TTL, the external IP is looked up once; /api/health does no I/O
+    def test_network_info_cache_and_health(self):
+        cache = app_module.NetworkInfoCache(ttl=60, external_ttl=3600)
+        with patch.object(app_module, 'read_interfaces', return_value=[]) as interfaces, \
+                patch.object(app_module, 'read_default_routes', return_value=['default via 192.0.2.1 dev eth0']), \
+                patch.object(app_module, '_lookup_external_ip', return_value='203.0.113.7') as lookup:
+            cache.refresh_external()
+            for _ in range(5):
+                info = cache.get()
+        self.assertEqual(interfaces.call_count, 1)
+        self.assertEqual(lookup.call_count, 1)
+        self.assertEqual(info['external_ip'], '203.0.113.7')
+        self.assertEqual(info['default_route'], 'default via 192.0.2.1 dev eth0')
+
+        with tempfile.NamedTemporaryFile('w', suffix='.route', delete=False) as f:
+            f.write('Iface\tDestination\tGateway\tFlags\tRefCnt\tUse\tMetric\tMask\n'
+                    'eth0\t00000000\t010200C0\t0003\t0\t0\t0\t00000000\n'
+                    'eth0\t000200C0\t00000000\t0001\t0\t0\t0\t00FFFFFF\n')
+        self.addCleanup(os.unlink, f.name)
+        self.assertEqual(app_module.read_default_routes(f.name, f.name + '.missing'), ['default via 192.0.2.1 dev eth0'])
+
+        with patch.object(app_module, 'NETWORK_INFO', side_effect=AssertionError('no I/O')), \
+                patch.object(app_module, 'get_connection', side_effect=AssertionError('no db')):
+            resp = self.client.get('/api/health')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()['status'], 'ok')
+
+    # 32) Reverse DNS: traces run with -n, PTR names come from one batched lookup and a shared cache
+    def test_reverse_dns_batched_with_cache(self):
+        import socket
+        import struct
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        self.addCleanup(server.close)
+        queries = []
+
+        def serve():
+            while True:
+                try:
+                    message, addr = server.recvfrom(512)
+                except OSError:
+                    return
+                question = message[12:]
+                labels, i = [], 0
+                while question[i]:
+                    labels.append(question[i + 1:i + 1 + question[i]].decode())
+                    i += 1 + question[i]
+                name = '.'.join(labels)
+                queries.append(name)
+                if name == '1.0.0.10.in-addr.arpa':
+                    rdata = b''.join(bytes([len(p)]) + p.encode() for p in 'r1.example.net'.split('.')) + b'\x00'
+                    answer = b'\xc0\x0c' + struct.pack('!HHIH', 12, 1, 60, len(rdata)) + rdata
+                    header = struct.pack('!HHHHHH', struct.unpack('!H', message[:2])[0], 0x8180, 1, 1, 0, 0)
+                else:
+                    answer = b''
+                    header = struct.pack('!HHHHHH', struct.unpack('!H', message[:2])[0], 0x8183, 1, 0, 0, 0)
+                server.sendto(header + question[:i + 5] + answer, addr)
+
+        threading.Thread(target=serve, daemon=True).start()
+        resolver = app_module.ReverseDNSResolver(server=f'127.0.0.1:{server.getsockname()[1]}', timeout=2.0)
+
+        names = resolver.resolve_many(['10.0.0.1', '10.0.0.2', '10.0.0.1'])
+        self.assertEqual(names, {'10.0.0.1': 'r1.example.net', '10.0.0.2': None})
+        self.assertEqual(len(queries), 2)
+        # Положительный и отрицательный ответы берутся из кэша
+        self.assertEqual(resolver.resolve_many(['10.0.0.2', '10.0.0.1']), names)
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(resolver.cache.stats()['hits'], 2)
+
+        output = ("traceroute to example.com (10.0.0.9), 30 hops max\n"
+                  " 1  10.0.0.1  0.512 ms  0.498 ms  0.470 ms\n"
+                  " 2  * * *\n"
+                  " 3  10.0.0.2  5.1 ms  5.2 ms  5.3 ms\n")
+        with patch.object(app_module, 'RDNS_ENABLED', True), patch.object(app_module, 'RDNS', resolver), \
+                patch('APP.app.subprocess.run', return_value=make_completed(stdout=output)) as mock_run:
+            _, _, rc, hops, _ = app_module.run_traceroute('traceroute example.com')
+            self.assertIn('-n', mock_run.call_args[0][0])
+            app_module.run_traceroute('traceroute -n example.com')
+        self.assertEqual(rc, 0)
+        self.assertEqual([(h['hostname'], h['ip']) for h in hops],
+                         [('r1.example.net', '10.0.0.1'), ('*', 'Таймаут'), ('10.0.0.2', '10.0.0.2')])
+        self.assertEqual(hops[0]['rtt1'], '0.512')
+        self.assertEqual(len(queries), 2)
+
+
+    # 33) Identical concurrent traces share one subprocess run; results are reused for TRACE_CACHE_TTL
+    @patch('APP.app.subprocess.run')
+    def test_trace_single_flight_and_result_cache(self, mock_run):
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_trace(args, **kwargs):
+            started.set()
+            release.wait(5)
+            return make_completed(stdout=" 1  router (192.168.1.1)  1.0 ms  1.0 ms  1.0 ms\n")
+        mock_run.side_effect = slow_trace
+
+        now = [1000.0]
+        cache = app_module.TTLCache(16, 10, clock=lambda: now[0])
+        with patch.object(app_module, 'TRACE_RESULTS', cache):
+            coalesced = app_module.TRACE_FLIGHTS.coalesced
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(app_module.run_traceroute('traceroute example.com')))
+                       for _ in range(4)]
+            threads[0].start()
+            started.wait(5)
+            for t in threads[1:]:
+                t.start()
+            while app_module.TRACE_FLIGHTS.coalesced < coalesced + 3:
+                time.sleep(0.01)
+            release.set()
+            for t in threads:
+                t.join(5)
+            self.assertEqual(mock_run.call_count, 1)
+            self.assertEqual(len(results), 4)
+            self.assertTrue(all(r[3] == results[0][3] for r in results))
+            # Свежий результат только у выполнившего трассировку
+            self.assertEqual(sorted(r[4] for r in results), [False, False, False, True])
+            # Каждому вызывающему — своя копия хопов
+            results[0][3][0]['ip'] = 'changed'
+            self.assertEqual(results[1][3][0]['ip'], '192.168.1.1')
+
+            # Те же аргументы с лишними пробелами — попадание в кэш
+            self.assertFalse(app_module.run_traceroute('traceroute   example.com')[4])
+            self.assertEqual(mock_run.call_count, 1)
+            # Результат из кэша в историю повторно не пишется
+            for _ in range(2):
+                resp = self.client.post('/api/run_command', json={'command': 'traceroute example.com'})
+                self.assertEqual(resp.status_code, 200)
+            self.assertEqual(mock_run.call_count, 1)
+            self.assertEqual(self.client.get('/api/history').get_json()['history'], [])
+            resp = self.client.post('/api/batch_traceroute', json={'targets': ['example.com']})
+            self.assertTrue(resp.get_json()['results'][0]['shared'])
+            self.assertEqual(self.client.get('/api/history').get_json()['history'], [])
+            # Разные цели с одинаковыми флагами — разные ключи
+            self.assertNotEqual(app_module._trace_key('traceroute -m 30 8.8.8.8'),
+                                app_module._trace_key('traceroute -m 30 1.1.1.1'))
+            # Монитор не читает кэш
+            app_module.run_traceroute('traceroute example.com', cache=False)
+            self.assertEqual(mock_run.call_count, 2)
+            now[0] += 11
+            app_module.run_traceroute('traceroute example.com')
+            self.assertEqual(mock_run.call_count, 3)
+
+    # 34) /metrics: Prometheus text with route, subprocess, parser, DB and cache series
+    @patch('APP.app.subprocess.run')
+    def test_metrics_endpoint_exposes_pipeline_stages(self, mock_run):
+        mock_run.return_value = make_completed(stdout=" 1  router (192.168.1.1)  1.0 ms  1.0 ms  1.0 ms\n")
+        swallowed = app_module.SWALLOWED_EXCEPTIONS.value('store_traces')
+        self.client.post('/api/run_command', json={'command': 'traceroute -n example.com'})
+        self.client.get('/api/paths')
+        self.client.get('/api/paths')
+        with patch('APP.app.update_rtt_rollups', side_effect=RuntimeError('boom')):
+            self.assertFalse(app_module.save_request_to_db('traceroute x', [{'hop': '1', 'ip': '10.0.0.1'}]))
+        self.assertEqual(app_module.SWALLOWED_EXCEPTIONS.value('store_traces'), swallowed + 1)
+
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain; version=0.0.4'))
+        text = resp.get_data(as_text=True)
+        self.assertIn('# TYPE netvis_http_request_duration_seconds histogram', text)
+        self.assertRegex(text, r'netvis_http_requests_total\{method="POST",route="/api/run_command",status="200"\} \d+')
+        self.assertRegex(text, r'netvis_subprocess_exits_total\{command="traceroute",code="0"\} \d+')
+        self.assertIn('netvis_subprocess_duration_seconds_bucket{command="traceroute",le="+Inf"}', text)
+        self.assertRegex(text, r'netvis_parse_duration_seconds_count\{format="\w+"\} [1-9]')
+        self.assertRegex(text, r'netvis_parse_hops_bucket\{le="1.0"\} \d+')
+        self.assertRegex(text, r'netvis_db_rows_written_total\{db="[^"]+"\} \d+')
+        self.assertIn('netvis_db_write_duration_seconds_sum{db=', text)
+        self.assertIn('netvis_cache_hit_ratio{cache="paths_aggregate"}', text)
+        self.assertRegex(text, r'netvis_swallowed_exceptions_total\{site="store_traces"\} [1-9]')
+
+        # Упавший коллектор пропускается, ошибка пишется в лог и учитывается
+        def broken_collector():
+            raise RuntimeError('collector boom')
+
+        registry = app_module.MetricsRegistry()
+        registry.register_collector(broken_collector)
+        failed = app_module.SWALLOWED_EXCEPTIONS.value('metrics_collector')
+        with self.assertLogs(app_module.app.logger, level='WARNING') as logs:
+            self.assertEqual(registry.render(), '\n')
+        self.assertIn('broken_collector failed: collector boom', logs.output[0])
+        self.assertEqual(app_module.SWALLOWED_EXCEPTIONS.value('metrics_collector'), failed + 1)
+        # Все строки образцов — "имя{метки} число"
+        for line in text.splitlines():
+            if not line.startswith('#'):
+                float(line.rsplit(' ', 1)[1].replace('+Inf', 'inf'))
+
+    # 35) Server-Timing per stage, slowest-requests log and token-gated profiling
+    @patch('APP.app.subprocess.run')
+    def test_request_tracing_and_profiling(self, mock_run):
+        mock_run.return_value = make_completed(stdout=" 1  router (192.168.1.1)  1.0 ms  1.0 ms  1.0 ms\n")
+        app_module.SLOW_REQUESTS.clear()
+        resp = self.client.post('/api/run_command', json={'command': 'traceroute -n example.com'})
+        timing = resp.headers['Server-Timing']
+        for stage in ('args;', 'subprocess;', 'parse;', 'db;', 'json;', 'total;'):
+            self.assertIn(stage, timing)
+
+        slow = self.client.get('/api/debug/slow').get_json()
+        self.assertEqual(slow['requests'][0]['route'], '/api/run_command')
+        self.assertLessEqual({'subprocess', 'parse', 'db'}, set(slow['requests'][0]['spans']))
+
+        log = app_module.SlowRequestLog(size=2)
+        for duration in (0.3, 0.1, 0.5, 0.2):
+            log.add(duration, {'d': duration})
+        self.assertEqual([r['d'] for r in log.snapshot()], [0.5, 0.3])
+
+        # Без доверенного токена заголовок профилирования игнорируется
+        resp = self.client.get('/api/health', headers={'X-Debug-Profile': 'cpu'})
+        self.assertNotIn('X-Debug-Profile-Id', resp.headers)
+        with patch.object(app_module, 'DEBUG_PROFILE_TOKEN', 'secret'):
+            headers = {'X-Debug-Token': 'secret'}
+            for mode, marker in (('cpu', 'function calls'), ('memory', 'traced current=')):
+                resp = self.client.get('/api/health', headers=dict(headers, **{'X-Debug-Profile': mode}))
+                profile_id = resp.headers['X-Debug-Profile-Id']
+                stats = self.client.get(f'/api/debug/profile/{profile_id}', headers=headers)
+                self.assertEqual(stats.status_code, 200)
+                self.assertIn(marker, stats.get_data(as_text=True))
+            self.assertEqual(self.client.get(f'/api/debug/profile/{profile_id}').status_code, 403)
+
+    # 36) Streaming export: NDJSON/CSV for history with hops, the paths aggregate and rollups
+    def test_export_streams_ndjson_and_csv(self):
+        from datetime import datetime, timedelta
+        hops = [{'hop': '1', 'hostname': 'gw', 'ip': '10.0.0.1', 'rtt1': '1.0', 'rtt2': '2.0', 'rtt3': '3.0'},
+                {'hop': '2', 'hostname': '*', 'ip': 'Таймаут', 'rtt1': None, 'rtt2': None, 'rtt3': None}]
+        for target in ('a.example', 'b.example', 'a.example'):
+            app_module.persist_traces([(f'traceroute {target}', hops)])
+        app_module.save_request_to_db('traceroute empty.example', [])
+
+        resp = self.client.get('/api/export/history?target=a.example')
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        self.assertIn('attachment', resp.headers['Content-Disposition'])
+        records = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertEqual(len(records), 2)
+        self.assertLess(records[0]['id'], records[1]['id'])
+        self.assertEqual([h['hop_number'] for h in records[0]['hops']], [1, 2])
+        self.assertEqual(records[0]['hops'][0]['rtt3'], 3.0)
+
+        # Малый fetch_size: запрос на границе пачек не дробится
+        chunks = list(app_module.generate_export('history', 'ndjson', {}, fetch_size=3))
+        self.assertGreater(len(chunks), 1)
+        records = [json.loads(line) for line in ''.join(chunks).splitlines()]
+        self.assertEqual([len(r['hops']) for r in records], [2, 2, 2, 0])
+
+        resp = self.client.get('/api/export/history?format=csv')
+        self.assertEqual(resp.mimetype, 'text/csv')
+        rows = list(csv.reader(io.StringIO(resp.get_data(as_text=True))))
+        self.assertEqual(rows[0][:3], ['request_id', 'timestamp', 'target'])
+        self.assertEqual(len(rows), 1 + 6 + 1)
+
+        lines = self.client.get('/api/export/paths?target=b.example').get_data(as_text=True).splitlines()
+        self.assertEqual([json.loads(line) for line in lines],
+                         [{'target': 'b.example', 'hop_number': 1, 'kind': 'node', 'value': 'gw'},
+                          {'target': 'b.example', 'hop_number': 1, 'kind': 'ip', 'value': '10.0.0.1'}])
+
+        lines = self.client.get('/api/export/rollups?resolution=1d&target=a.example').get_data(as_text=True).splitlines()
+        rollups = [json.loads(line) for line in lines]
+        self.assertEqual([(r['hop_number'], r['count'], r['loss']) for r in rollups], [(1, 6, 0), (2, 0, 6)])
+
+        future = (datetime.now() + timedelta(days=1)).isoformat()
+        self.assertEqual(self.client.get(f'/api/export/history?since={future}').get_data(as_text=True), '')
+        self.assertEqual(self.client.get('/api/export/history?format=xml').status_code, 400)
+        self.assertEqual(self.client.get('/api/export/unknown').status_code, 400)
+
+    # 37) Bulk import: files and archives, parsed in a process pool, written in large transactions
+    def test_bulk_import_files_archives_and_upload(self):
+        import tarfile
+        import zipfile
+        linux = ("traceroute to a.example (10.0.0.9), 30 hops max, 60 byte packets\n"
+                 " 1  gw (10.0.0.1)  1.0 ms  1.1 ms  1.2 ms\n"
+                 " 2  10.0.0.9 (10.0.0.9)  5.0 ms  5.1 ms  5.2 ms\n")
+        windows = ("Tracing route to b.example [10.1.0.9]\n"
+                   "over a maximum of 30 hops:\n\n"
+                   "  1    <1 ms    <1 ms    <1 ms  10.1.0.1\n"
+                   "  2     2 ms     2 ms     2 ms  b.example [10.1.0.9]\n")
+        workdir = tempfile.mkdtemp()
+        with open(os.path.join(workdir, 'two.txt'), 'w') as f:
+            f.write(linux + "\n" + linux.replace('a.example', 'c.example'))
+        os.utime(os.path.join(workdir, 'two.txt'), (1714560000, 1714560000))
+        with open(os.path.join(workdir, 'empty.txt'), 'w') as f:
+            f.write('no hops here\n')
+        with zipfile.ZipFile(os.path.join(workdir, 'win.zip'), 'w') as z:
+            z.writestr('win/b.txt', windows)
+        with tarfile.open(os.path.join(workdir, 'more.tar.gz'), 'w:gz') as t:
+            data = linux.encode()
+            info = tarfile.TarInfo('d/a2.txt')
+            info.size = len(data)
+            info.mtime = 1714560000
+            t.addfile(info, io.BytesIO(data))
+
+        progress = []
+        paths_etag, _ = app_module.get_data_version(app_module.PATHS_DB)
+        with patch.object(app_module, 'ProcessPoolExecutor', wraps=app_module.ProcessPoolExecutor) as pool:
+            stats = app_module.import_captures(app_module.iter_capture_paths([workdir]), workers=2, chunk_size=1,
+                                               commit_size=2, on_progress=progress.append)
+        # Пул разбора не форкает процесс сервера
+        self.assertEqual(pool.call_args.kwargs['mp_context'].get_start_method(), 'spawn')
+        # Импорт меняет версию базы: ETag и кэши других процессов увидят новые данные
+        self.assertNotEqual(app_module.get_data_version(app_module.PATHS_DB)[0], paths_etag)
+        self.assertEqual((stats['files'], stats['captures'], stats['hops'], stats['empty']), (4, 4, 8, 1))
+        self.assertEqual(stats['failed_commits'], 0)
+        self.assertGreaterEqual(stats['commits'], 2)
+        self.assertTrue(progress and not progress[0]['done'])
+
+        items, _ = app_module.get_request_history_page(limit=10)
+        self.assertEqual(sorted(i['target'] for i in items), ['a.example', 'a.example', 'b.example', 'c.example'])
+        c_item = next(i for i in items if i['target'] == 'c.example')
+        self.assertTrue(str(c_item['timestamp']).startswith(
+            app_module.datetime.fromtimestamp(1714560000).isoformat()[:10]))
+        paths = app_module.get_all_paths()
+        self.assertEqual([h['ips'] for h in paths['b.example']], [['10.1.0.1'], ['10.1.0.9']])
+
+        # Загрузка через API: тот же конвейер, прогресс в NDJSON
+        resp = self.client.post('/api/import?workers=1', data={'file': (io.BytesIO(windows.encode()), 'up.txt')},
+                                content_type='multipart/form-data')
+        lines = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertTrue(lines[-1]['done'])
+        self.assertEqual(lines[-1]['captures'], 1)
+        self.assertEqual(self.client.post('/api/import').status_code, 400)
+
+    # 38) History, path history and aggregate writes share one attached transaction and roll back together
+    def test_store_traces_single_attached_transaction(self):
+        hops = [{'hop': '1', 'hostname': 'gw', 'ip': '10.0.0.1', 'rtt1': '1.0'}]
+        trace = app_module.normalize_trace('traceroute a.example', hops)
+        history_db = os.path.basename(app_module.HISTORY_DB)
+        paths_db = os.path.basename(app_module.PATHS_DB)
+        history_writes = app_module.DB_WRITE_LATENCY.count(history_db)
+        paths_writes = app_module.DB_WRITE_LATENCY.count(paths_db)
+        history_etag, _ = app_module.get_data_version(app_module.HISTORY_DB)
+        paths_etag, _ = app_module.get_data_version(app_module.PATHS_DB)
+
+        self.assertTrue(app_module.store_traces([trace], history=True, path_history=True))
+        self.assertEqual(app_module.DB_WRITE_LATENCY.count(history_db), history_writes + 1)
+        self.assertEqual(app_module.DB_WRITE_LATENCY.count(paths_db), paths_writes)
+        self.assertNotEqual(app_module.get_data_version(app_module.HISTORY_DB)[0], history_etag)
+        self.assertNotEqual(app_module.get_data_version(app_module.PATHS_DB)[0], paths_etag)
+        self.assertEqual(len(app_module.get_request_history()), 1)
+        self.assertEqual(len(app_module.get_path_request_history()), 1)
+        self.assertEqual(app_module.get_all_paths()['a.example'][0]['ips'], ['10.0.0.1'])
+
+        # Ошибка записи агрегата откатывает и историю
+        with patch('APP.app._insert_aggregate', side_effect=sqlite3.OperationalError('disk I/O error')):
+            self.assertFalse(app_module.persist_traces([('traceroute b.example', hops)]))
+        self.assertEqual(len(app_module.get_request_history()), 1)
+
+        # Запись, вложенная в откатившуюся внешнюю транзакцию, не остается в кэше агрегата
+        with self.assertRaises(RuntimeError):
+            with app_module.write_transaction(app_module.PATHS_DB):
+                self.assertTrue(app_module.update_paths_aggregate('traceroute n.example', hops))
+                raise RuntimeError('rollback')
+        self.assertNotIn('n.example', app_module.get_all_paths())
+        self.assertNotIn('b.example', app_module.get_all_paths())
+
+        # Маршрут дерева путей: история путей и агрегат одной транзакцией в paths_tree.db
+        paths_writes = app_module.DB_WRITE_LATENCY.count(paths_db)
+        with patch('APP.app.subprocess.run', return_value=make_completed(
+                stdout=" 1  r1 (10.0.0.7)  1.0 ms  1.0 ms  1.0 ms\n")):
+            self.client.post('/api/paths_run_command', json={'command': 'traceroute -n c.example'})
+        self.assertEqual(app_module.DB_WRITE_LATENCY.count(paths_db), paths_writes + 1)
+        self.assertEqual(len(app_module.get_path_request_history()), 2)
+
+    # 39) Topology: hop edges with counts/last_seen, adjacency index queries and backfill
+    def test_topology_edges_and_queries(self):
+        def hops(*ips):
+            return [{'hop': str(n), 'hostname': ip, 'ip': ip} for n, ip in enumerate(ips, 1)]
+        app_module.persist_traces([
+            ('traceroute a.example', hops('10.0.0.1', '10.0.1.1', '10.0.2.1', '192.0.2.1')),
+            ('traceroute a.example', hops('10.0.0.1', '10.0.1.1', '10.0.2.2', '192.0.2.1')),
+            ('traceroute b.example', hops('10.0.0.1', '10.0.1.1', 'Таймаут', '198.51.100.1')),
+        ])
+        with app_module.read_cursor(app_module.PATHS_DB) as cursor:
+            cursor.execute("SELECT count, last_seen FROM hop_edges e JOIN targets t ON t.id = e.target_id "
+                           "WHERE t.name = 'a.example' AND src_ip = '10.0.0.1' AND dst_ip = '10.0.1.1'")
+            count, last_seen = cursor.fetchone()
+        self.assertEqual(count, 2)
+        self.assertTrue(last_seen)
+
+        graph = self.client.get('/api/topology').get_json()
+        edges = {(e['source'], e['target']): e for e in graph['edges']}
+        # Через таймаут связь не проводится
+        self.assertNotIn(('10.0.1.1', '198.51.100.1'), edges)
+        self.assertEqual(edges[('10.0.0.1', '10.0.1.1')]['count'], 3)
+        self.assertEqual(edges[('10.0.0.1', '10.0.1.1')]['targets'], ['a.example', 'b.example'])
+        self.assertEqual(graph['edges'][0]['source'], '10.0.0.1')
+        self.assertEqual(len(edges), 5)
+
+        graph = self.client.get('/api/topology?target=b.example').get_json()
+        self.assertEqual([(e['source'], e['target'], e['count']) for e in graph['edges']],
+                         [('10.0.0.1', '10.0.1.1', 1)])
+
+        graph = self.client.get('/api/topology?node=10.0.1.1&depth=1').get_json()
+        self.assertEqual({n['id'] for n in graph['nodes']}, {'10.0.0.1', '10.0.1.1', '10.0.2.1', '10.0.2.2'})
+
+        # k-ядро степени 2: остается только ромб 10.0.1.1 -> 10.0.2.x -> 192.0.2.1
+        graph = self.client.get('/api/topology?min_degree=2').get_json()
+        self.assertEqual({n['id'] for n in graph['nodes']}, {'10.0.1.1', '10.0.2.1', '10.0.2.2', '192.0.2.1'})
+        graph = self.client.get('/api/topology?limit=2').get_json()
+        self.assertTrue(graph['truncated'])
+        self.assertEqual(self.client.get('/api/topology?depth=99').status_code, 400)
+
+        # Индекс обновляется инкрементально и сбрасывается вместе с базой путей
+        app_module.persist_traces([('traceroute c.example', hops('10.9.0.1', '10.9.0.2'))])
+        graph = self.client.get('/api/topology?node=10.9.0.1').get_json()
+        self.assertEqual(len(graph['edges']), 1)
+        self.client.post('/api/clear_paths')
+        self.assertEqual(self.client.get('/api/topology').get_json()['edges'], [])
+
+        # Существующая база без hop_edges заполняется из path_hops при инициализации
+        app_module.save_path_request_to_db('traceroute d.example', hops('10.5.0.1', '10.5.0.2'))
+        with app_module.write_transaction(app_module.PATHS_DB) as cursor:
+            cursor.execute('DROP TABLE hop_edges')
+        app_module.init_paths_database()
+        app_module.TOPOLOGY.invalidate()
+        graph = self.client.get('/api/topology?target=d.example').get_json()
+        self.assertEqual([(e['source'], e['target']) for e in graph['edges']], [('10.5.0.1', '10.5.0.2')])
+
+    # 40) Paths layout: server-side positions cached by data version and params, updated per target
+    def test_paths_layout_cached_and_incremental(self):
+        def hops(*ips):
+            return [{'hop': str(n), 'hostname': ip, 'ip': ip} for n, ip in enumerate(ips, 1)]
+        app_module.persist_traces([
+            ('traceroute a.example', hops('10.0.0.1', '10.0.1.1', '192.0.2.1')),
+            ('traceroute a.example', hops('10.0.0.1', '10.0.1.2', '192.0.2.1')),
+            ('traceroute b.example', hops('10.0.0.1', 'Таймаут', '198.51.100.1')),
+        ])
+        resp = self.client.get('/api/paths/layout?x_gap=100&y_gap=20&group_gap=50')
+        self.assertEqual(resp.status_code, 200)
+        layout = resp.get_json()
+        self.assertEqual(layout['groups'], [['a.example', 0, 40], ['b.example', 90, 20]])
+        nodes = {(layout['groups'][g][0], hop, ip): (x, y) for g, hop, ip, _, x, y in layout['nodes']}
+        self.assertEqual(len(nodes), 6)
+        # Колонка — номер хопа, одиночные узлы центрируются по высоте группы
+        self.assertEqual(nodes[('a.example', 1, '10.0.0.1')], (0, 20))
+        self.assertEqual(nodes[('a.example', 2, '10.0.1.1')], (100, 10))
+        self.assertEqual(nodes[('a.example', 2, '10.0.1.2')], (100, 30))
+        self.assertEqual(nodes[('b.example', 3, '198.51.100.1')], (200, 100))
+        links = {(layout['nodes'][s][2], layout['nodes'][d][2]) for s, d in layout['links']}
+        # Через таймаут связь не проводится
+        self.assertEqual(len(layout['links']), 4)
+        self.assertNotIn(('10.0.0.1', '198.51.100.1'), links)
+
+        # Та же версия и параметры — готовый ответ; условный GET — 304
+        self.assertEqual(self.client.get('/api/paths/layout?x_gap=100&y_gap=20&group_gap=50').get_json(), layout)
+        self.assertEqual(app_module.PATHS_LAYOUT.hits, 1)
+        resp = self.client.get('/api/paths/layout', headers={'If-None-Match': resp.headers['ETag']})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(self.client.get('/api/paths/layout?y_gap=5').status_code, 400)
+
+        # Новая трассировка перестраивает только свою цель, узлы сохраняют порядок
+        computed = app_module.PATHS_LAYOUT.targets_computed
+        app_module.persist_traces([('traceroute a.example', hops('10.0.0.1', '10.0.1.0', '192.0.2.1'))])
+        layout = self.client.get('/api/paths/layout?x_gap=100&y_gap=20&group_gap=50').get_json()
+        self.assertEqual(app_module.PATHS_LAYOUT.targets_computed, computed + 1)
+        column = [ip for _, hop, ip, _, _, _ in layout['nodes'] if hop == 2]
+        self.assertEqual(column, ['10.0.1.1', '10.0.1.2', '10.0.1.0'])
+
+        self.client.post('/api/clear_paths')
+        layout = self.client.get('/api/paths/layout').get_json()
+        self.assertEqual((layout['groups'], layout['nodes']), ([], []))
+
+    # 41) Batch and monitor commands with -m/-w keep the target as the last argument
+    @patch('APP.app.subprocess.run')
+    def test_batch_and_monitor_options_keep_target(self, mock_run):
+        seen = []
+
+        def side_effect(args, capture_output=True, text=True, timeout=None):
+            seen.append(list(args))
+            return make_completed(stdout=f" 1  {args[-1]} ({args[-1]})  1.0 ms  1.0 ms  1.0 ms\n")
+
+        mock_run.side_effect = side_effect
+        targets = ['8.8.8.8', '1.1.1.1']
+        options = {'numeric': True, 'max_hops': 30, 'wait_ms': 3000}
+        resp = self.client.post('/api/batch_traceroute', json={'targets': targets, 'options': options})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([r['target'] for r in resp.get_json()['results']], targets)
+        self.assertEqual(sorted(args[-1] for args in seen), sorted(targets))
+        self.assertIn(['-m', '30'], [args[i:i + 2] for args in seen for i in range(len(args))])
+
+        # Цель мониторинга проходит через ту же сборку команды
+        seen.clear()
+        scheduler = app_module.MonitorScheduler(max_workers=1)
+        self.addCleanup(scheduler.stop)
+        item = scheduler.add('9.9.9.9', 60, {'max_hops': 20, 'wait_ms': 3000})
+        self.assertEqual(app_module.build_command_args(item.command)[-1], '9.9.9.9')
+        scheduler.run_pending(item.next_run)
+        for _ in range(100):
+            if item.last_run:
+                break
+            time.sleep(0.02)
+        self.assertEqual(seen[0][-1], '9.9.9.9')
+        self.assertEqual(app_module._probe_options_from_command(item.command), ('9.9.9.9', 20, 3.0))
+
+    # 42) Data version is stored in the database: writes from another process refresh ETags and caches
+    def test_data_version_tracks_external_writes(self):
+        hops = [{'hop': '1', 'hostname': 'gw', 'ip': '10.0.0.1'}, {'hop': '2', 'hostname': 'r', 'ip': '10.0.0.2'}]
+        app_module.persist_traces([('traceroute a.example', hops)])
+        etag = self.client.get('/api/paths').headers['ETag']
+        self.assertEqual(self.client.get('/api/topology').get_json()['edges'][0]['source'], '10.0.0.1')
+        self.client.get('/api/paths/layout')
+        # Своя запись дополняет кэши без перечитывания базы
+        misses = app_module.PATHS_CACHE.misses
+        app_module.persist_traces([('traceroute a.example', hops[:1] + [{'hop': '2', 'ip': '10.0.0.3'}])])
+        self.assertEqual(app_module.get_all_paths()['a.example'][1]['ips'], ['10.0.0.2', '10.0.0.3'])
+        self.assertEqual(app_module.PATHS_CACHE.misses, misses)
+
+        # Другой процесс (CLI-импорт, второй воркер) пишет в базу напрямую
+        conn = sqlite3.connect(app_module.PATHS_DB)
+        self.addCleanup(conn.close)
+        with conn:
+            conn.execute("INSERT INTO targets (name) VALUES ('b.example')")
+            conn.execute("INSERT INTO hop_ips (target_id, hop_number, ip_address) "
+                         "SELECT id, 1, '10.9.0.1' FROM targets WHERE name = 'b.example'")
+            conn.execute("INSERT INTO hop_ips (target_id, hop_number, ip_address) "
+                         "SELECT id, 2, '10.9.0.2' FROM targets WHERE name = 'b.example'")
+            conn.execute("INSERT INTO hop_edges (target_id, src_ip, dst_ip, count, last_seen) "
+                         "SELECT id, '10.9.0.1', '10.9.0.2', 1, '2024-01-01' FROM targets WHERE name = 'b.example'")
+            conn.execute('UPDATE data_version SET counter = counter + 1')
+        resp = self.client.get('/api/paths', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('b.example', resp.get_json()['paths'])
+        graph = self.client.get('/api/topology?target=b.example').get_json()
+        self.assertEqual([(e['source'], e['target']) for e in graph['edges']], [('10.9.0.1', '10.9.0.2')])
+        layout = self.client.get('/api/paths/layout').get_json()
+        self.assertEqual([g[0] for g in layout['groups']], ['a.example', 'b.example'])
+
+        # ETag не зависит от процесса: тот же файл базы — та же версия
+        etag = self.client.get('/api/paths').headers['ETag']
+        self.assertEqual(app_module.get_data_version(app_module.PATHS_DB)[0], etag.strip('"'))
+
+    # 43) Incremental vacuum setup is best-effort at init; existing databases are converted by `flask vacuum`
+    def test_incremental_vacuum_setup_outside_schema_init(self):
+        path = tempfile.NamedTemporaryFile(suffix='.db', delete=False).name
+        self.addCleanup(os.unlink, path)
+        with patch.object(app_module, 'PATHS_DB', path), \
+                patch.object(app_module, '_ensure_incremental_vacuum',
+                             side_effect=sqlite3.OperationalError('database is locked')):
+            app_module.init_paths_database()
+        # Схема создана, несмотря на ошибку настройки vacuum
+        with app_module.read_cursor(path) as cursor:
+            tables = {row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        self.assertTrue({'targets', 'hop_ips', 'hop_edges', 'data_version'} <= tables)
+        # Существующая база без режима: инициализация не запускает VACUUM
+        self.assertEqual(app_module.get_connection(path).execute('PRAGMA auto_vacuum').fetchone()[0], 0)
+        with patch.object(app_module, 'PATHS_DB', path):
+            app_module.init_paths_database()
+            self.assertEqual(app_module.get_connection(path).execute('PRAGMA auto_vacuum').fetchone()[0], 0)
+            result = self.app.test_cli_runner().invoke(args=['vacuum'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn(f'{path}: auto_vacuum=INCREMENTAL', result.output)
+        self.assertEqual(app_module.get_connection(path).execute('PRAGMA auto_vacuum').fetchone()[0], 2)
+
+    # 44) Cancelling a batch while a target is running keeps that trace and saves it when it finishes
+    @patch('APP.app.subprocess.run')
+    def test_batch_cancel_while_running_saves_late_result(self, mock_run):
+        started = threading.Event()
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def side_effect(args, capture_output=True, text=True, timeout=None):
+            started.set()
+            release.wait(5)
+            return make_completed(stdout=f" 1  {args[-1]} (10.0.4.1)  1.0 ms  1.0 ms  1.0 ms\n")
+
+        mock_run.side_effect = side_effect
+        cancel = threading.Event()
+        jobs = [('running.example', 'traceroute running.example'), ('queued.example', 'traceroute queued.example')]
+        outcome = {}
+        worker = threading.Thread(target=lambda: outcome.update(result=app_module.run_batch_traceroute(
+            jobs, max_workers=1, cancel_event=cancel)))
+        worker.start()
+        self.assertTrue(started.wait(2))
+        cancel.set()
+        worker.join(5)
+        results, timed_out = outcome['result']
+        self.assertFalse(timed_out)
+        self.assertEqual([r['status'] for r in results], ['cancelled', 'cancelled'])
+        self.assertIn('still running', results[0]['raw_stderr'])
+        self.assertNotIn('still running', results[1]['raw_stderr'])
+        self.assertEqual(self.client.get('/api/history').get_json()['history'], [])
+
+        # Запущенная трассировка досчитывает и попадает в историю; цель из очереди не запускалась
+        release.set()
+        for _ in range(100):
+            history = self.client.get('/api/history').get_json()['history']
+            if history:
+                break
+            time.sleep(0.02)
+        self.assertEqual([h['command'] for h in history], ['traceroute running.example'])
+        self.assertEqual(mock_run.call_count, 1)
+
+    # 45) Paths layout is computed outside the cache lock; identical concurrent requests compute once
+    def test_paths_layout_computed_outside_lock(self):
+        cache = app_module.PathsLayoutCache()
+        params = dict(app_module.PATHS_LAYOUT_DEFAULTS)
+        paths = {'a.example': [{'hop_number': 1, 'ips': ['10.0.0.1'], 'nodes': ['gw']}]}
+        ready = cache.get('db', 1, params, paths, lambda target: [])
+
+        entered = threading.Event()
+        release = threading.Event()
+        self.addCleanup(release.set)
+        edge_calls = []
+
+        def slow_edges(target):
+            edge_calls.append(target)
+            entered.set()
+            release.wait(5)
+            return []
+
+        newer = {'a.example': [{'hop_number': 1, 'ips': ['10.0.0.2'], 'nodes': ['gw']}]}
+        payloads = []
+        workers = [threading.Thread(target=lambda: payloads.append(cache.get('db', 2, params, newer, slow_edges)))
+                   for _ in range(2)]
+        for worker in workers:
+            worker.start()
+        self.assertTrue(entered.wait(2))
+        # Пока идет расчет версии 2, готовый ответ версии 1 отдается без ожидания
+        cached = []
+        reader = threading.Thread(target=lambda: cached.append(cache.get('db', 1, params, paths, slow_edges)))
+        reader.start()
+        reader.join(1)
+        self.assertEqual(cached, [ready])
+
+        release.set()
+        for worker in workers:
+            worker.join(5)
+        self.assertEqual(len(payloads), 2)
+        self.assertIs(payloads[0], payloads[1])
+        self.assertEqual(payloads[0]['nodes'][0][2], '10.0.0.2')
+        self.assertEqual(edge_calls, ['a.example'])
+        self.assertEqual((cache.misses, cache.targets_computed), (2, 2))
+
+    # 46) SSE stream normalizes options like /api/run_command: -n with rDNS, result cache, probe engine
+    @patch('APP.app.subprocess.Popen')
+    def test_api_run_command_stream_normalizes_like_run_command(self, mock_popen):
+        output = ("traceroute to example.com (10.0.0.9), 30 hops max\n"
+                  " 1  10.0.0.1  0.512 ms  0.498 ms  0.470 ms\n"
+                  " 2  * * *\n")
+        mock_popen.side_effect = lambda args, **kwargs: types.SimpleNamespace(
+            stdout=io.StringIO(output), stderr=io.StringIO(''), wait=lambda: 0, poll=lambda: 0, kill=lambda: None)
+        resolver = types.SimpleNamespace(resolve_many=lambda ips: {ip: 'r1.example.net' for ip in ips}, timeout=2.0)
+
+        names = []
+
+        def stream(command):
+            body = self.client.get('/api/run_command/stream', query_string={'command': command}).get_data(as_text=True)
+            events = []
+            for block in body.split('\n\n'):
+                if block.strip():
+                    name, data = block.split('\n', 1)
+                    events.append((name[len('event: '):], json.loads(data[len('data: '):])))
+            names[:] = [payload for name, payload in events if name == 'hostname']
+            return [payload for name, payload in events if name == 'hop'], events[-1][1]
+
+        with patch.object(app_module, 'RDNS_ENABLED', True), patch.object(app_module, 'RDNS', resolver):
+            hops, done = stream('traceroute example.com')
+            self.assertIn('-n', mock_popen.call_args[0][0])
+            # Хоп уходит сразу с IP, имя — отдельным событием hostname
+            self.assertEqual([(h['hostname'], h['ip']) for h in hops], [('10.0.0.1', '10.0.0.1'), ('*', 'Таймаут')])
+            self.assertEqual((done['saved'], done['shared']), (True, False))
+            self.assertEqual(names, [{'hop': '1', 'ip': '10.0.0.1', 'hostname': 'r1.example.net'}])
+            details = self.client.get('/api/history').get_json()['history'][0]
+            saved = self.client.get(f"/api/history/{details['id']}").get_json()['hops']
+            self.assertEqual(saved[0]['hostname'], 'r1.example.net')
+            # Та же команда в пределах TRACE_CACHE_TTL — готовый результат без нового процесса и без записи
+            cached_hops, done = stream('traceroute example.com')
+        self.assertEqual([(h['hostname'], h['ip']) for h in cached_hops], [('r1.example.net', '10.0.0.1'), ('*', 'Таймаут')])
+        self.assertEqual((done['saved'], done['shared']), (False, True))
+        self.assertEqual(mock_popen.call_count, 1)
+        self.assertEqual(len(self.client.get('/api/history').get_json()['history']), 1)
+
+        topology = {'probe.example': {'ip': '93.184.216.34', 'hops': ['192.168.1.1', '93.184.216.34']}}
+        with patch.object(app_module, 'TRACE_ENGINE', 'probe'), \
+                patch.object(app_module, 'PROBE_BACKEND', 'simulated'), \
+                patch.object(app_module, 'SIMULATED_TOPOLOGY', topology):
+            hops, done = stream('traceroute -w 300 probe.example')
+        self.assertEqual(mock_popen.call_count, 1)
+        self.assertEqual([h['ip'] for h in hops], ['192.168.1.1', '93.184.216.34'])
+        self.assertEqual((done['hops_count'], done['saved']), (2, True))
+
+    # 47) Nested write transactions join the outer one or fail fast instead of waiting on their own lock
+    def test_nested_write_transaction_joins_or_fails_fast(self):
+        paths = {'paths': app_module.PATHS_DB}
+        with app_module.write_transaction(app_module.HISTORY_DB, attach=paths) as outer:
+            with app_module.write_transaction(app_module.HISTORY_DB) as inner:
+                self.assertIs(inner.connection, outer.connection)
+            started = time.monotonic()
+            with self.assertRaises(RuntimeError):
+                with app_module.write_transaction(app_module.PATHS_DB):
+                    pass
+            with self.assertRaises(RuntimeError):
+                with app_module.write_transaction(app_module.HISTORY_DB, attach=dict(paths, other=os.path.join(tempfile.gettempdir(), 'other.db'))):
+                    pass
+            self.assertLess(time.monotonic() - started, 0.5)
+            outer.execute("INSERT INTO requests (command, target, hops_count, timestamp) "
+                          "VALUES ('traceroute a', 'a', 0, '2024-01-01')")
+        # После внешней транзакции базы снова доступны по отдельности
+        with app_module.write_transaction(app_module.PATHS_DB) as cursor:
+            cursor.execute('SELECT COUNT(*) FROM targets')
+        self.assertEqual(len(self.client.get('/api/history').get_json()['history']), 1)
+
+    # 48) A database without its data_version row gets no validators instead of a constant ETag
+    def test_conditional_get_without_data_version_row(self):
+        def drop_version():
+            with sqlite3.connect(app_module.HISTORY_DB) as conn:
+                conn.execute('DELETE FROM data_version')
+            with sqlite3.connect(app_module.PATHS_DB) as conn:
+                conn.execute('DELETE FROM data_version')
+
+        drop_version()
+        resp = self.client.get('/api/history', headers={'If-None-Match': '"none"'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('ETag', resp.headers)
+        self.assertNotIn('Last-Modified', resp.headers)
+        self.assertEqual(self.client.get('/api/paths').get_json()['paths'], {})
+
+        # Данные меняются в обход счетчика — без версии ответы не берутся из кэшей
+        hops = [{'hop': '1', 'hostname': 'r', 'ip': '10.0.0.1', 'rtt1': '1.0', 'rtt2': None, 'rtt3': None}]
+        app_module.persist_traces([('traceroute example.com', hops)])
+        drop_version()
+        self.assertEqual(len(self.client.get('/api/history').get_json()['history']), 1)
+        self.assertEqual(list(self.client.get('/api/paths').get_json()['paths']), ['example.com'])
+        layout = self.client.get('/api/paths/layout').get_json()
+        self.assertEqual([g[0] for g in layout['groups']], ['example.com'])
+
+        # Инициализация восстанавливает строку, и условный GET снова работает
+        app_module.init_database()
+        etag = self.client.get('/api/history').headers['ETag']
+        self.assertEqual(self.client.get('/api/history', headers={'If-None-Match': etag}).status_code, 304)
+
+    # 49) Background workers start once, on the first served request; `flask retention` runs one pass
+    def test_background_workers_start_once_on_first_request(self):
+        with patch.object(app_module, 'RETENTION_POLICIES', {'requests': {'max_age_days': 90}}), \
+                patch.object(app_module, '_background_started', False), \
+                patch.object(app_module.NETWORK_INFO, 'start') as netinfo_start, \
+                patch.object(app_module.RETENTION, 'start') as start:
+            self.client.get('/api/history')
+            start.assert_not_called()
+            netinfo_start.assert_not_called()
+            self.app.testing = False
+            try:
+                clients = [threading.Thread(target=lambda: self.app.test_client().get('/api/history')) for _ in range(4)]
+                for client in clients:
+                    client.start()
+                for client in clients:
+                    client.join(5)
+                self.client.get('/api/history')
+            finally:
+                self.app.testing = True
+            self.assertEqual(start.call_count, 1)
+            self.assertEqual(netinfo_start.call_count, 1)
+            self.assertFalse(app_module.start_background_workers())
+
+            runner = self.app.test_cli_runner()
+            result = runner.invoke(args=['retention'])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIsNone(json.loads(result.output)['error'])
+            with patch.object(app_module, 'apply_retention', side_effect=sqlite3.OperationalError('database is locked')):
+                result = runner.invoke(args=['retention'])
+            self.assertEqual(result.exit_code, 1)
+            self.assertIn('Retention failed: database is locked', result.output)
+
+    # 50) Streamed hops are not delayed by reverse DNS: lookups run concurrently, names follow as events
+    @patch('APP.app.subprocess.Popen')
+    def test_stream_hostnames_resolved_concurrently(self, mock_popen):
+        output = ''.join(f" {n}  10.0.7.{n}  1.0 ms  1.0 ms  1.0 ms\n" for n in range(1, 5))
+        mock_popen.return_value = types.SimpleNamespace(
+            stdout=io.StringIO(output), stderr=io.StringIO(''), wait=lambda: 0, poll=lambda: 0, kill=lambda: None)
+        calls = []
+
+        def slow_lookup(ips):
+            calls.append(list(ips))
+            time.sleep(0.3)
+            return {ip: f'r{ip.rsplit(".", 1)[1]}.example.net' for ip in ips if not ip.endswith('.4')}
+
+        resolver = types.SimpleNamespace(resolve_many=slow_lookup, timeout=2.0)
+        events = []
+        started = time.monotonic()
+        with patch.object(app_module, 'RDNS_ENABLED', True), patch.object(app_module, 'RDNS', resolver):
+            for kind, value in app_module.stream_traceroute('traceroute example.com'):
+                events.append((kind, value, time.monotonic() - started))
+        hop_times = [at for kind, _, at in events if kind == 'hop']
+        self.assertEqual(len(hop_times), 4)
+        # Все хопы отданы раньше, чем завершился первый медленный запрос имени
+        self.assertLess(max(hop_times), 0.2)
+        # Четыре запроса по 0.3 с идут параллельно, а не друг за другом
+        self.assertLess(events[-1][2], 0.9)
+        self.assertEqual(sorted(calls), [['10.0.7.1'], ['10.0.7.2'], ['10.0.7.3'], ['10.0.7.4']])
+        names = sorted((v['hop'], v['hostname']) for kind, v, _ in events if kind == 'hostname')
+        self.assertEqual(names, [('1', 'r1.example.net'), ('2', 'r2.example.net'), ('3', 'r3.example.net')])
+        kind, (_, _, returncode, hops, fresh), _ = events[-1]
+        self.assertEqual((kind, returncode, fresh), ('exit', 0, True))
+        self.assertEqual([h['hostname'] for h in hops], ['r1.example.net', 'r2.example.net', 'r3.example.net', '10.0.7.4'])
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)